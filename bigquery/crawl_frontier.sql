@@ -0,0 +1,36 @@
+-- Crawl frontier of Reddit posts discovered through reddit_data.related_posts
+-- One row per Reddit post ID; the crawl-frontier function harvests new rows,
+-- scores pending posts and emits the best ones to the scrape initiator
+-- Clustered by status so pending-post selection scans little data
+CREATE TABLE IF NOT EXISTS `social-listening-sense.social_listening_data.crawl_frontier` (
+    -- Post identification
+    post_key STRING NOT NULL,         -- Lowercased Reddit post ID (the base-36 ID in /comments/<id>/)
+    url STRING,                       -- Canonical post URL sent to Bright Data
+    title STRING,                     -- Title shown in related_posts
+    community STRING,                 -- Subreddit of the related post
+
+    -- Discovery signals
+    num_comments INT64,               -- Highest comment count seen in related_posts
+    num_upvotes INT64,                -- Highest upvote count seen in related_posts
+    times_seen INT64,                 -- Number of scraped posts that listed it as related
+    source_communities ARRAY<STRING>, -- Subreddits of the posts that referenced it
+    first_seen_at TIMESTAMP,          -- When it was first harvested
+    last_seen_at TIMESTAMP,           -- When it was last harvested
+
+    -- Scheduling state
+    status STRING,                    -- 'pending', 'emitted', 'already_scraped' or 'skipped_recent'
+    score FLOAT64,                    -- Priority score at emission time
+    emitted_at TIMESTAMP,             -- When it was sent to the scrape initiator
+    emit_batch_id STRING,             -- Frontier run that emitted it
+
+    -- Constraints
+    PRIMARY KEY(post_key) NOT ENFORCED
+)
+CLUSTER BY status, community
+OPTIONS(
+    description="Reddit posts discovered via related_posts of scraped posts, with engagement signals and scheduling state for the crawl-frontier function."
+);
+
+-- Harvest watermark (the crawl-frontier function creates it on first run if missing)
+-- INSERT INTO `social-listening-sense.social_listening_data.nlp_processing_watermark` (table_name, last_processed_timestamp, updated_at)
+-- VALUES ('crawl_frontier:reddit_data', TIMESTAMP('1970-01-01 00:00:00 UTC'), CURRENT_TIMESTAMP());
@@ -0,0 +1,30 @@
+-- Table recording every snapshot delivery processed by the deliverer functions
+-- Partitioned by date for efficient querying of recent deliveries
+-- Clustered by snapshot_id for fast duplicate lookups
+CREATE TABLE IF NOT EXISTS `social-listening-sense.social_listening_data.delivery_ledger` (
+    -- Delivery identification
+    delivery_key STRING NOT NULL,     -- snapshot_id, plus '@<generation>' for GCS deliveries
+    snapshot_id STRING NOT NULL,      -- Bright Data snapshot ID
+    object_generation STRING,         -- GCS object generation (NULL for Pub/Sub deliveries)
+    dataset_id STRING,                -- Bright Data dataset ID (Reddit or Quora)
+    trigger STRING,                   -- 'gcs' or 'pubsub'
+    ingestion_mode STRING,            -- 'streaming' or 'load_job'
+
+    -- Outcome
+    status STRING,                    -- e.g., 'completed', 'completed_with_failures'
+    row_count INT64,                  -- Number of rows written for this snapshot
+
+    -- Timings
+    started_at TIMESTAMP,             -- When the delivery was claimed
+    finished_at TIMESTAMP,            -- When processing finished
+    duration_ms INT64,                -- Total processing time
+    timings_ms JSON,                  -- Per-phase timings (download, transform, insert, merge)
+
+    -- Constraints
+    PRIMARY KEY(delivery_key) NOT ENFORCED
+)
+PARTITION BY DATE(started_at)
+CLUSTER BY snapshot_id
+OPTIONS(
+    description="One row per snapshot delivery processed by the deliverer. Claims themselves are GCS marker objects under the ledger prefix; this table records row counts and timings."
+);
@@ -0,0 +1,6 @@
+-- Fingerprint of the normalized text an item was enriched from (see
+-- cloud_functions/deliverer/enrichment.py, "Pre-embedding normalization"):
+-- FARM_FINGERPRINT of the cleaned, token-budget-truncated text. Items sharing
+-- it share one embedding and sentiment call. Run before deploying the deliverers.
+ALTER TABLE `social-listening-sense.social_listening_data.embeddings_cache`
+ADD COLUMN IF NOT EXISTS normalized_text_hash INT64 OPTIONS(description="FARM_FINGERPRINT of the normalized text sent to the embedding and sentiment models");
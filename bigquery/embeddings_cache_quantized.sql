@@ -0,0 +1,30 @@
+-- Compact copies of embeddings_cache.embeddings (see cloud_functions/kmeans-performer/embedding_codec.py)
+-- BigQuery bills a BYTES column by its length: 768 bytes (int8) or 1,536 bytes
+-- (float16) per 768-dim vector instead of 6,144 bytes for ARRAY<FLOAT64>
+ALTER TABLE `social-listening-sense.social_listening_data.embeddings_cache`
+ADD COLUMN IF NOT EXISTS embeddings_int8 BYTES OPTIONS(description="Embeddings as per-vector scaled int8 (two's-complement bytes); value = code * embeddings_int8_scale"),
+ADD COLUMN IF NOT EXISTS embeddings_int8_scale FLOAT64 OPTIONS(description="Scale of embeddings_int8: max(|x|) / 127"),
+ADD COLUMN IF NOT EXISTS embeddings_f16 BYTES OPTIONS(description="Embeddings as little-endian IEEE float16");
+
+-- Backfill int8 for rows written before the deliverer MERGE produced it
+-- (quantize_embeddings.py runs this and backfills embeddings_f16)
+UPDATE `social-listening-sense.social_listening_data.embeddings_cache` AS ec
+SET
+  embeddings_int8 = q.embeddings_int8,
+  embeddings_int8_scale = q.embeddings_int8_scale
+FROM (
+  SELECT
+    unified_id,
+    int8_scale AS embeddings_int8_scale,
+    CODE_POINTS_TO_BYTES(ARRAY(
+      SELECT MOD(CAST(ROUND(IFNULL(SAFE_DIVIDE(x, int8_scale), 0)) AS INT64) + 256, 256)
+      FROM UNNEST(embeddings) AS x WITH OFFSET AS i
+      ORDER BY i
+    )) AS embeddings_int8
+  FROM (
+    SELECT unified_id, embeddings, (SELECT MAX(ABS(x)) FROM UNNEST(embeddings) AS x) / 127 AS int8_scale
+    FROM `social-listening-sense.social_listening_data.embeddings_cache`
+    WHERE embeddings_int8 IS NULL AND ARRAY_LENGTH(embeddings) > 0
+  )
+) AS q
+WHERE ec.unified_id = q.unified_id;
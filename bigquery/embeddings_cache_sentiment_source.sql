@@ -0,0 +1,5 @@
+-- Which engine produced embeddings_cache.sentiment_score (see cloud_functions/deliverer/enrichment.py):
+-- 'understand_text' (ML.UNDERSTAND_TEXT) or 'local_lexicon' (the deliverer's in-process scorer).
+-- Run before deploying the deliverers; rows scored earlier keep NULL.
+ALTER TABLE `social-listening-sense.social_listening_data.embeddings_cache`
+ADD COLUMN IF NOT EXISTS sentiment_source STRING OPTIONS(description="Sentiment engine: understand_text or local_lexicon");
@@ -10,5 +10,10 @@ CREATE TABLE IF NOT EXISTS `social-listening-sense.social_listening_data.kmeans_
     labeling_job_id STRING,       -- BigQuery job ID for the labeling process
     status STRING,                  -- e.g., "submitted", "model_created", "prediction_completed", "labeled_completed", "failed"
     error_message STRING,           -- Any error message if the run failed
-    embedding_model STRING          -- e.g., "text-embedding-004"
-); 
\ No newline at end of file
+    embedding_model STRING,         -- e.g., "text-embedding-004"
+    fingerprint STRING              -- sha256 of the sorted ID set, num_topics, embedding model and training options
+);
+
+-- For tables created before the fingerprint column existed
+ALTER TABLE `social-listening-sense.social_listening_data.kmeans_runs`
+ADD COLUMN IF NOT EXISTS fingerprint STRING; 
\ No newline at end of file
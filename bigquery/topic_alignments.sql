@@ -0,0 +1,28 @@
+-- Mapping of topics between pairs of K-means runs, from centroid matching
+-- One row per matched topic pair or unmatched topic; the kmeans-performer
+-- function (mode "align") replaces all rows of a run pair when it re-aligns it
+-- Clustered by the run pair for efficient lookup
+CREATE TABLE IF NOT EXISTS `social-listening-sense.social_listening_data.topic_alignments` (
+    -- Run pair
+    run_id_a STRING NOT NULL,         -- Earlier (reference) run
+    run_id_b STRING NOT NULL,         -- Later run mapped onto it
+    aligned_at TIMESTAMP NOT NULL,    -- When the alignment was computed
+
+    -- Topic mapping
+    topic_id_a INT64,                 -- Topic in run_id_a (NULL for a topic new in run_id_b)
+    topic_id_b INT64,                 -- Topic in run_id_b (NULL for a topic that vanished)
+    similarity FLOAT64,               -- Centroid cosine similarity (best available one for unmatched topics)
+    match_type STRING,                -- 'matched', 'vanished' or 'new'
+
+    -- Split/merge notes
+    split_into ARRAY<INT64>,          -- Other run_id_b topics that topic_id_a split into
+    merged_from ARRAY<INT64>,         -- Other run_id_a topics that merged into topic_id_b
+
+    -- Constraints
+    PRIMARY KEY(run_id_a, run_id_b, topic_id_a, topic_id_b) NOT ENFORCED
+)
+PARTITION BY DATE(aligned_at)
+CLUSTER BY run_id_a, run_id_b
+OPTIONS(
+    description="Topic mappings between K-means runs computed by Hungarian matching of centroid cosine similarities, with split and merge notes."
+);
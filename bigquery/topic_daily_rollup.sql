@@ -0,0 +1,62 @@
+-- Pre-aggregated topic volume and sentiment per content day for dashboards
+-- Maintained incrementally by the kmeans-performer function (rollups.py):
+-- only (run_id, day) groups that received new assignments are recomputed
+-- Partitioned by day and clustered by run_id and topic_id, like the charts filter
+CREATE TABLE IF NOT EXISTS `social-listening-sense.social_listening_data.topic_daily_rollup` (
+    -- Grouping keys
+    run_id STRING NOT NULL,           -- Clustering run
+    topic_id INT64,                   -- Assigned cluster/topic ID
+    day DATE NOT NULL,                -- Content date (assignment date when content_timestamp is missing)
+    source STRING,                    -- Source platform
+    content_type STRING,              -- Type of content
+
+    -- Volume
+    doc_count INT64,                  -- Documents assigned
+
+    -- Sentiment (mean = sum / count, variance = sq_sum / count - mean^2)
+    sentiment_count INT64,            -- Documents with a sentiment score
+    sentiment_score_sum FLOAT64,
+    sentiment_score_sq_sum FLOAT64,
+    sentiment_magnitude_sum FLOAT64,
+    sentiment_magnitude_sq_sum FLOAT64,
+
+    -- Engagement (upvotes/likes from unified_social_content_items)
+    engagement_count INT64,           -- Documents with an engagement score
+    engagement_sum INT64,
+    engagement_sq_sum FLOAT64,
+
+    -- Bookkeeping
+    last_assigned_at TIMESTAMP,       -- Latest assignment included in the group
+    updated_at TIMESTAMP,             -- When the group was last recomputed
+
+    -- Constraints
+    PRIMARY KEY(run_id, topic_id, day, source, content_type) NOT ENFORCED
+)
+PARTITION BY day
+CLUSTER BY run_id, topic_id
+OPTIONS(
+    description="Daily per-topic counts, sentiment and engagement sums of document_topic_assignments, for dashboards."
+);
+
+-- Dashboard-facing view with the derived means and standard deviations
+CREATE OR REPLACE VIEW `social-listening-sense.social_listening_data.topic_daily_metrics` AS
+SELECT
+    run_id,
+    topic_id,
+    day,
+    source,
+    content_type,
+    doc_count,
+    SAFE_DIVIDE(sentiment_score_sum, sentiment_count) AS avg_sentiment_score,
+    SQRT(GREATEST(SAFE_DIVIDE(sentiment_score_sq_sum, sentiment_count)
+        - POW(SAFE_DIVIDE(sentiment_score_sum, sentiment_count), 2), 0)) AS stddev_sentiment_score,
+    SAFE_DIVIDE(sentiment_magnitude_sum, sentiment_count) AS avg_sentiment_magnitude,
+    SQRT(GREATEST(SAFE_DIVIDE(sentiment_magnitude_sq_sum, sentiment_count)
+        - POW(SAFE_DIVIDE(sentiment_magnitude_sum, sentiment_count), 2), 0)) AS stddev_sentiment_magnitude,
+    engagement_sum,
+    SAFE_DIVIDE(engagement_sum, engagement_count) AS avg_engagement
+FROM `social-listening-sense.social_listening_data.topic_daily_rollup`;
+
+-- Refresh watermark (the kmeans-performer function creates it on first refresh if missing)
+-- INSERT INTO `social-listening-sense.social_listening_data.nlp_processing_watermark` (table_name, last_processed_timestamp, updated_at)
+-- VALUES ('topic_daily_rollup', TIMESTAMP('1970-01-01 00:00:00 UTC'), CURRENT_TIMESTAMP());
@@ -0,0 +1,407 @@
+import functions_framework
+from flask import jsonify
+import requests
+import os
+import datetime
+import time
+import uuid
+from google.cloud import bigquery
+
+# Bright Data Reddit posts dataset, used when emitting to the scrape initiator
+REDDIT_DATASET_ID = "gd_lvz8ah06191smkebj4"
+WATERMARK_NAME = 'crawl_frontier:reddit_data'
+# reddit_data rows are re-read this far behind the watermark, since a delivery
+# can commit rows whose timestamp is older than rows already harvested
+WATERMARK_OVERLAP_MINUTES = 30
+
+# URLs sent to the scrape initiator per day (CRAWL_DAILY_BUDGET)
+DEFAULT_DAILY_BUDGET = int(os.environ.get('CRAWL_DAILY_BUDGET', '500'))
+# URLs per Bright Data trigger requested from the initiator
+EMIT_BATCH_SIZE = int(os.environ.get('CRAWL_EMIT_BATCH_SIZE', '50'))
+# Send a Google-signed ID token (needed when the initiator does not allow unauthenticated calls)
+SOCIAL_SCRAPER_USE_ID_TOKEN = os.environ.get('SOCIAL_SCRAPER_USE_ID_TOKEN', '').lower() in ('1', 'true')
+SOCIAL_SCRAPER_TIMEOUT_SECONDS = 300
+# Posts scraped within this many hours are skipped by the initiator (sent as max_age)
+DEFAULT_MAX_AGE_HOURS = float(os.environ.get('CRAWL_MAX_AGE_HOURS', '24'))
+
+# Priority score = engagement * (RELEVANCE_FLOOR + relevance), where engagement
+# is log-scaled comments and upvotes and relevance mixes how much of the corpus
+# comes from the post's community, how many scraped posts referenced it, and
+# whether its title mentions one of the requested keywords.
+UPVOTE_WEIGHT = 0.5
+RELEVANCE_FLOOR = 0.2
+COMMUNITY_WEIGHT = 0.5
+REFERENCE_WEIGHT = 0.3
+KEYWORD_WEIGHT = 0.2
+# Corpus window used for community affinity
+AFFINITY_DAYS = 30
+
+_bigquery_client = None
+
+
+def get_bigquery_client():
+    """Returns the instance-wide BigQuery client, creating it on first use."""
+    global _bigquery_client
+    if _bigquery_client is None:
+        _bigquery_client = bigquery.Client()
+    return _bigquery_client
+
+
+# --- Harvest ---
+
+HARVEST_SQL = """
+DECLARE watermark TIMESTAMP DEFAULT (
+  SELECT MAX(last_processed_timestamp) FROM `{watermark_table}` WHERE table_name = @watermark_name
+);
+DECLARE new_watermark TIMESTAMP DEFAULT (
+  SELECT MAX(timestamp) FROM `{reddit_table}`
+  WHERE timestamp > COALESCE(watermark, TIMESTAMP '1970-01-01 00:00:00 UTC')
+);
+
+-- Rows in the overlap were counted by an earlier harvest, unless they landed
+-- late; they can still add posts to the frontier but only rows past the
+-- watermark add to times_seen of posts already in it.
+MERGE `{frontier_table}` T
+USING (
+  WITH related AS (
+    SELECT
+      LOWER(REGEXP_EXTRACT(rp.url, r'/comments/([A-Za-z0-9]+)')) AS post_key,
+      REGEXP_EXTRACT(rp.url, r'/r/([A-Za-z0-9_]+)/comments/') AS subreddit,
+      rp.title,
+      rp.community,
+      rp.num_comments,
+      rp.num_upvotes,
+      r.community_name AS source_community,
+      r.timestamp > COALESCE(watermark, TIMESTAMP '1970-01-01 00:00:00 UTC') AS is_new
+    FROM `{reddit_table}` AS r, UNNEST(r.related_posts) AS rp
+    WHERE r.timestamp > TIMESTAMP_SUB(
+        COALESCE(watermark, TIMESTAMP '1970-01-01 00:00:00 UTC'), INTERVAL {overlap_minutes} MINUTE)
+      AND r.timestamp <= COALESCE(new_watermark, watermark)
+  )
+  SELECT
+    post_key,
+    CONCAT('https://www.reddit.com/r/', ANY_VALUE(subreddit), '/comments/', post_key, '/') AS url,
+    ANY_VALUE(title) AS title,
+    ANY_VALUE(COALESCE(community, subreddit)) AS community,
+    MAX(num_comments) AS num_comments,
+    MAX(num_upvotes) AS num_upvotes,
+    COUNT(*) AS times_seen,
+    COUNTIF(is_new) AS new_times_seen,
+    ARRAY_AGG(DISTINCT source_community IGNORE NULLS LIMIT 20) AS source_communities
+  FROM related
+  WHERE post_key IS NOT NULL AND subreddit IS NOT NULL
+  GROUP BY post_key
+) S
+ON T.post_key = S.post_key
+WHEN MATCHED AND S.new_times_seen > 0 THEN UPDATE SET
+  num_comments = GREATEST(IFNULL(T.num_comments, 0), IFNULL(S.num_comments, 0)),
+  num_upvotes = GREATEST(IFNULL(T.num_upvotes, 0), IFNULL(S.num_upvotes, 0)),
+  times_seen = IFNULL(T.times_seen, 0) + S.new_times_seen,
+  source_communities = ARRAY(
+    SELECT DISTINCT c FROM UNNEST(ARRAY_CONCAT(IFNULL(T.source_communities, []), IFNULL(S.source_communities, []))) AS c LIMIT 20
+  ),
+  last_seen_at = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (
+  post_key, url, title, community, num_comments, num_upvotes, times_seen,
+  source_communities, first_seen_at, last_seen_at, status
+) VALUES (
+  S.post_key, S.url, S.title, S.community, S.num_comments, S.num_upvotes, S.times_seen,
+  S.source_communities, CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP(), 'pending'
+);
+
+IF new_watermark IS NOT NULL THEN
+  MERGE `{watermark_table}` W
+  USING (SELECT @watermark_name AS table_name) S
+  ON W.table_name = S.table_name
+  WHEN MATCHED THEN UPDATE SET last_processed_timestamp = new_watermark, updated_at = CURRENT_TIMESTAMP()
+  WHEN NOT MATCHED THEN INSERT (table_name, last_processed_timestamp, updated_at)
+    VALUES (S.table_name, new_watermark, CURRENT_TIMESTAMP());
+END IF;
+
+-- Posts that were scraped (or triggered) since they were discovered are not crawled again
+UPDATE `{frontier_table}`
+SET status = 'already_scraped'
+WHERE status = 'pending'
+  AND (
+    post_key IN (
+      SELECT LOWER(REGEXP_REPLACE(post_id, r'^t3_', ''))
+      FROM `{reddit_table}`
+      WHERE post_id IS NOT NULL
+    )
+    OR post_key IN (
+      SELECT LOWER(REGEXP_EXTRACT(url, r'/comments/([A-Za-z0-9]+)'))
+      FROM `{scrape_job_table}`, UNNEST(urls_in_batch) AS url
+      WHERE dataset_id = @reddit_dataset_id
+    )
+  );
+"""
+
+
+def harvest_related_posts(client, tables):
+    """
+    Merges related_posts of reddit_data rows newer than the watermark (less
+    WATERMARK_OVERLAP_MINUTES) into the frontier and retires pending posts
+    that have been scraped since.
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('watermark_name', 'STRING', WATERMARK_NAME),
+        bigquery.ScalarQueryParameter('reddit_dataset_id', 'STRING', REDDIT_DATASET_ID),
+    ])
+    start = time.perf_counter()
+    job = client.query(HARVEST_SQL.format(overlap_minutes=WATERMARK_OVERLAP_MINUTES, **tables),
+                       job_config=job_config)
+    job.result()
+    print(f"Harvest finished in {time.perf_counter() - start:.1f}s "
+          f"({(job.total_bytes_processed or 0) / 1e6:.1f} MB processed)")
+
+
+# --- Scoring and selection ---
+
+SELECT_CANDIDATES_SQL = """
+WITH community_posts AS (
+  SELECT LOWER(REGEXP_REPLACE(community_name, r'^r/', '')) AS community, COUNT(*) AS posts
+  FROM `{reddit_table}`
+  WHERE timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {affinity_days} DAY)
+    AND community_name IS NOT NULL
+  GROUP BY community
+),
+max_posts AS (
+  SELECT MAX(posts) AS max_posts FROM community_posts
+),
+scored AS (
+  SELECT
+    f.post_key,
+    f.url,
+    f.title,
+    f.community,
+    LN(1 + IFNULL(f.num_comments, 0)) + @upvote_weight * LN(1 + IFNULL(f.num_upvotes, 0)) AS engagement,
+    IFNULL(SAFE_DIVIDE(LN(1 + IFNULL(c.posts, 0)), LN(1 + m.max_posts)), 0) AS community_affinity,
+    LEAST(1.0, IFNULL(f.times_seen, 0) / 5) AS reference_strength,
+    IF(EXISTS(
+      SELECT 1 FROM UNNEST(@keywords) AS keyword
+      WHERE STRPOS(LOWER(IFNULL(f.title, '')), LOWER(keyword)) > 0
+    ), 1.0, 0.0) AS keyword_match
+  FROM `{frontier_table}` AS f
+  LEFT JOIN community_posts AS c
+    ON LOWER(REGEXP_REPLACE(f.community, r'^r/', '')) = c.community
+  CROSS JOIN max_posts AS m
+  WHERE f.status = 'pending'
+)
+SELECT
+  *,
+  engagement * (@relevance_floor
+    + @community_weight * community_affinity
+    + @reference_weight * reference_strength
+    + @keyword_weight * keyword_match) AS score
+FROM scored
+ORDER BY score DESC
+LIMIT @limit
+"""
+
+
+def select_candidates(client, tables, limit, keywords):
+    """Returns up to `limit` pending frontier posts, highest priority first."""
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('upvote_weight', 'FLOAT64', UPVOTE_WEIGHT),
+        bigquery.ScalarQueryParameter('relevance_floor', 'FLOAT64', RELEVANCE_FLOOR),
+        bigquery.ScalarQueryParameter('community_weight', 'FLOAT64', COMMUNITY_WEIGHT),
+        bigquery.ScalarQueryParameter('reference_weight', 'FLOAT64', REFERENCE_WEIGHT),
+        bigquery.ScalarQueryParameter('keyword_weight', 'FLOAT64', KEYWORD_WEIGHT),
+        bigquery.ArrayQueryParameter('keywords', 'STRING', keywords),
+        bigquery.ScalarQueryParameter('limit', 'INT64', limit),
+    ])
+    query = SELECT_CANDIDATES_SQL.format(affinity_days=AFFINITY_DAYS, **tables)
+    return [dict(row) for row in client.query(query, job_config=job_config).result()]
+
+
+def emitted_today(client, tables):
+    """Returns the number of frontier URLs emitted since midnight UTC."""
+    query = f"""
+        SELECT COUNT(*) AS emitted
+        FROM `{tables['frontier_table']}`
+        WHERE status = 'emitted' AND emitted_at >= TIMESTAMP_TRUNC(CURRENT_TIMESTAMP(), DAY)
+    """
+    return list(client.query(query).result())[0].emitted
+
+
+# --- Emission ---
+
+def _auth_headers(scraper_url):
+    if not SOCIAL_SCRAPER_USE_ID_TOKEN:
+        return {}
+    import google.auth.transport.requests
+    import google.oauth2.id_token
+    token = google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), scraper_url)
+    return {'Authorization': f"Bearer {token}"}
+
+
+def emit_to_initiator(scraper_url, candidates, batch_size, max_age_hours):
+    """
+    Sends candidate URLs, in priority order, to the social scrape initiator,
+    which skips those scraped within max_age_hours.
+
+    Returns:
+        Tuple (statuses, response) where statuses maps post_key to 'emitted',
+        'skipped_recent' or None (left pending because its batch failed).
+    """
+    urls = [candidate['url'] for candidate in candidates]
+    response = requests.post(
+        scraper_url,
+        params={'dataset_id': REDDIT_DATASET_ID},
+        json={'urls': urls, 'batch_size': batch_size, 'max_age': max_age_hours},
+        headers=_auth_headers(scraper_url),
+        timeout=SOCIAL_SCRAPER_TIMEOUT_SECONDS,
+    )
+    body = response.json()
+    if not response.ok:
+        raise RuntimeError(f"Scrape initiator returned {response.status_code}: {body.get('message')}")
+
+    # The initiator drops skipped URLs and then splits the rest into batches of
+    # batch_size in order, so batch indexes map back to URLs.
+    skipped = {entry['url'] for entry in body.get('skipped_urls', [])}
+    sent = [url for url in urls if url not in skipped]
+    failed = set()
+    for failed_batch in body.get('failed_batches', []):
+        index = failed_batch['batch_index']
+        failed.update(sent[index * batch_size:(index + 1) * batch_size])
+
+    statuses = {}
+    for candidate in candidates:
+        if candidate['url'] in skipped:
+            statuses[candidate['post_key']] = 'skipped_recent'
+        elif candidate['url'] in failed:
+            statuses[candidate['post_key']] = None
+        else:
+            statuses[candidate['post_key']] = 'emitted'
+    return statuses, body
+
+
+def record_emission(client, tables, candidates, statuses, batch_id):
+    """Writes the emission outcome and score back to the frontier rows."""
+    updates = [candidate for candidate in candidates if statuses.get(candidate['post_key'])]
+    if not updates:
+        return
+    query = f"""
+        UPDATE `{tables['frontier_table']}` T
+        SET status = S.status,
+            score = S.score,
+            emitted_at = IF(S.status = 'emitted', CURRENT_TIMESTAMP(), T.emitted_at),
+            emit_batch_id = @batch_id
+        FROM (
+          SELECT post_key, @scores[OFFSET(i)] AS score, @statuses[OFFSET(i)] AS status
+          FROM UNNEST(@post_keys) AS post_key WITH OFFSET AS i
+        ) S
+        WHERE T.post_key = S.post_key
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('batch_id', 'STRING', batch_id),
+        bigquery.ArrayQueryParameter('post_keys', 'STRING', [c['post_key'] for c in updates]),
+        bigquery.ArrayQueryParameter('scores', 'FLOAT64', [float(c['score']) for c in updates]),
+        bigquery.ArrayQueryParameter('statuses', 'STRING', [statuses[c['post_key']] for c in updates]),
+    ])
+    client.query(query, job_config=job_config).result()
+
+
+@functions_framework.http
+def crawl_frontier(request):
+    """
+    Cloud Function (run by Cloud Scheduler) that grows the crawl frontier from
+    new reddit_data rows and emits the highest-priority posts to the scrape
+    initiator within the daily budget.
+
+    Args:
+        request (flask.Request): Optional JSON body:
+            {"keywords": ["..."],   # boost posts whose title mentions these
+             "max_urls": 100,       # cap for this run (default: remaining budget)
+             "daily_budget": 500,   # override CRAWL_DAILY_BUDGET
+             "max_age": 24,         # override CRAWL_MAX_AGE_HOURS
+             "harvest": true,       # merge new related_posts first
+             "dry_run": false}      # score and report without emitting
+
+    Returns:
+        JSON summary with the budget, emitted and skipped counts and the top candidates.
+    """
+    bigquery_dataset_id = os.environ.get('BIGQUERY_DATASET_ID')
+    reddit_data_table_id = os.environ.get('REDDIT_DATA_TABLE_ID')
+    scrape_job_table_id = os.environ.get('SCRAPE_JOB_TABLE_ID')
+    scraper_url = os.environ.get('SOCIAL_SCRAPER_URL')
+
+    if not bigquery_dataset_id or not reddit_data_table_id or not scrape_job_table_id:
+        print("Error: BIGQUERY_DATASET_ID, REDDIT_DATA_TABLE_ID or SCRAPE_JOB_TABLE_ID environment variable not set.")
+        return jsonify({
+            'status': 'error',
+            'message': 'BIGQUERY_DATASET_ID, REDDIT_DATA_TABLE_ID and SCRAPE_JOB_TABLE_ID environment variables are required'
+        }), 500
+
+    request_json = request.get_json(silent=True) or {}
+    dry_run = bool(request_json.get('dry_run', False))
+    if not scraper_url and not dry_run:
+        print("Error: SOCIAL_SCRAPER_URL environment variable not set.")
+        return jsonify({
+            'status': 'error',
+            'message': 'SOCIAL_SCRAPER_URL environment variable not set'
+        }), 500
+
+    keywords = [k for k in request_json.get('keywords', []) if isinstance(k, str) and k.strip()]
+    try:
+        daily_budget = int(request_json.get('daily_budget', DEFAULT_DAILY_BUDGET))
+        max_urls = int(request_json['max_urls']) if request_json.get('max_urls') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': "'daily_budget' and 'max_urls' must be integers"}), 400
+    try:
+        max_age_hours = float(request_json.get('max_age', DEFAULT_MAX_AGE_HOURS) or 0)
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': "'max_age' must be a number of hours"}), 400
+
+    client = get_bigquery_client()
+    prefix = f"{client.project}.{bigquery_dataset_id}"
+    tables = {
+        'reddit_table': f"{prefix}.{reddit_data_table_id}",
+        'scrape_job_table': f"{prefix}.{scrape_job_table_id}",
+        'frontier_table': f"{prefix}.{os.environ.get('CRAWL_FRONTIER_TABLE_ID', 'crawl_frontier')}",
+        'watermark_table': f"{prefix}.{os.environ.get('WATERMARK_TABLE_ID', 'nlp_processing_watermark')}",
+    }
+
+    try:
+        if request_json.get('harvest', True):
+            harvest_related_posts(client, tables)
+
+        used = emitted_today(client, tables)
+        remaining = max(0, daily_budget - used)
+        limit = remaining if max_urls is None else min(remaining, max_urls)
+        print(f"Daily budget {daily_budget}: {used} used, {remaining} remaining; selecting up to {limit}")
+
+        candidates = select_candidates(client, tables, limit, keywords) if limit > 0 else []
+        summary = {
+            'status': 'success',
+            'daily_budget': daily_budget,
+            'budget_used_before': used,
+            'candidates': len(candidates),
+            'emitted': 0,
+            'skipped_recent': 0,
+            'left_pending': 0,
+            'dry_run': dry_run,
+            'top_candidates': [
+                {k: candidate[k] for k in ('url', 'title', 'community', 'score')}
+                for candidate in candidates[:10]
+            ],
+        }
+        if dry_run or not candidates:
+            return jsonify(summary), 200
+
+        batch_id = f"frontier_{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S}_{uuid.uuid4().hex[:8]}"
+        statuses, initiator_response = emit_to_initiator(scraper_url, candidates, EMIT_BATCH_SIZE, max_age_hours)
+        record_emission(client, tables, candidates, statuses, batch_id)
+
+        summary['batch_id'] = batch_id
+        summary['emitted'] = sum(1 for status in statuses.values() if status == 'emitted')
+        summary['skipped_recent'] = sum(1 for status in statuses.values() if status == 'skipped_recent')
+        summary['left_pending'] = sum(1 for status in statuses.values() if status is None)
+        summary['snapshots'] = [s.get('snapshot_id') for s in initiator_response.get('snapshots', [])]
+        print(f"Frontier run {batch_id}: emitted {summary['emitted']}, skipped {summary['skipped_recent']}, "
+              f"left pending {summary['left_pending']}")
+        return jsonify(summary), 200
+
+    except Exception as e:
+        print(f"An error occurred while running the crawl frontier: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -0,0 +1,335 @@
+"""
+Parallel backfill/replay of Bright Data snapshot files into BigQuery.
+
+Reads every snapshot JSON file under a local directory or a gs://bucket/prefix,
+transforms the files in a process pool with the deliverer's compiled
+transformers, stages the rows as NDJSON and loads them with one BigQuery load
+job per batch of snapshots. Loaded snapshot IDs are recorded in a state file so
+an interrupted backfill resumes where it stopped.
+
+Before anything is transformed, snapshots whose snapshot_id already appears
+in the destination table or in delivery_ledger (for example because the
+deliverer ingested them) are skipped, so a replay without the state file does
+not append their rows again. The remaining snapshots are split into batches in
+snapshot ID order and a batch is loaded once all its files are done, so the
+same files always form the same batches and load job IDs; a batch that an
+overlapping run already loaded is reported as already loaded. --force skips
+the table and state-file checks and reloads under job IDs salted with
+--run-salt (default: the start time), which appends duplicate rows.
+A batch whose load fails is reported, its staged files are removed and the
+backfill carries on with the next batch.
+
+Snapshot files are expected to follow the delivery layout
+<dataset_id>/<snapshot_id>.json; use --dataset-id for flat directories.
+
+Usage:
+    python backfill.py gs://brightdata-social-raw/gd_lvz8ah06191smkebj4/
+    python backfill.py ./snapshots --dataset-id gd_lvz8ah06191smkebj4 --workers 8
+    python backfill.py ./snapshots --dry-run
+    python backfill.py ./snapshots --force --run-salt replay-2024-06
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from transform import SCHEMA_FILES, transform_posts
+from loader import is_staging_object, write_staging_file, load_staged_files, delete_staging_files
+from ledger import LEDGER_TABLE_ID, is_ledger_object
+
+DEFAULT_STAGING_BUCKET = 'brightdata-social-raw'
+
+# Per-process GCS client, created by the pool initializer
+_storage_client = None
+
+
+def _init_worker(use_gcs):
+    global _storage_client
+    if use_gcs:
+        from google.cloud import storage
+        _storage_client = storage.Client()
+
+
+def list_snapshot_files(source, dataset_id=None):
+    """
+    Lists snapshot files under a local directory or gs:// prefix.
+
+    Returns:
+        List of (path, dataset_id, snapshot_id) tuples, sorted by path.
+    """
+    files = []
+    if source.startswith('gs://'):
+        from google.cloud import storage
+        bucket_name, _, prefix = source[len('gs://'):].partition('/')
+        for blob in storage.Client().list_blobs(bucket_name, prefix=prefix):
+            if not blob.name.endswith('.json') or is_staging_object(blob.name) or is_ledger_object(blob.name):
+                continue
+            parts = blob.name.split('/')
+            files.append((f"gs://{bucket_name}/{blob.name}", dataset_id or parts[0], parts[-1][:-5]))
+    else:
+        for root, _, filenames in os.walk(source):
+            for filename in filenames:
+                if filename.endswith('.json'):
+                    path = os.path.join(root, filename)
+                    files.append((path, dataset_id or os.path.basename(root), filename[:-5]))
+    files.sort()
+    return files
+
+
+def _read_snapshot(path):
+    if path.startswith('gs://'):
+        bucket_name, object_name = path[len('gs://'):].split('/', 1)
+        return _storage_client.bucket(bucket_name).blob(object_name).download_as_bytes()
+    with open(path, 'rb') as snapshot_file:
+        return snapshot_file.read()
+
+
+def process_snapshot(path, dataset_id, snapshot_id, staging_bucket, dry_run):
+    """
+    Transforms one snapshot file and stages its rows (runs in a worker process).
+
+    Returns:
+        Dict with the staged URI (None for dry runs), row and byte counts and timings.
+    """
+    start = time.monotonic()
+    raw = _read_snapshot(path)
+    posts = json.loads(raw)
+    read_seconds = time.monotonic() - start
+
+    rows = transform_posts(dataset_id, posts, snapshot_id)
+    if rows is None:
+        raise ValueError(f"Unknown dataset_id {dataset_id} for {path}")
+
+    staged_uri = None
+    if not dry_run:
+        staged_uri = write_staging_file(_storage_client, staging_bucket, dataset_id, snapshot_id, rows)
+
+    return {
+        'path': path,
+        'dataset_id': dataset_id,
+        'snapshot_id': snapshot_id,
+        'staged_uri': staged_uri,
+        'rows': len(rows),
+        'bytes': len(raw),
+        'read_seconds': read_seconds,
+        'total_seconds': time.monotonic() - start,
+    }
+
+
+def load_state(state_file):
+    """Returns the set of snapshot IDs already loaded by a previous run."""
+    if not state_file or not os.path.exists(state_file):
+        return set()
+    with open(state_file) as f:
+        return set(json.load(f).get('loaded_snapshots', []))
+
+
+def save_state(state_file, loaded_snapshots):
+    if not state_file:
+        return
+    tmp_path = f"{state_file}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'loaded_snapshots': sorted(loaded_snapshots)}, f)
+    os.replace(tmp_path, state_file)
+
+
+def plan_batches(files, batch_size):
+    """
+    Splits (path, dataset_id, snapshot_id) tuples into per-dataset batches of
+    up to batch_size snapshots in snapshot ID order.
+
+    Returns:
+        List of (dataset_id, [index into files, ...]) batches.
+    """
+    by_dataset = {}
+    for index in sorted(range(len(files)), key=lambda i: (files[i][1], files[i][2])):
+        by_dataset.setdefault(files[index][1], []).append(index)
+    return [
+        (dataset_id, indices[start:start + batch_size])
+        for dataset_id, indices in by_dataset.items()
+        for start in range(0, len(indices), batch_size)
+    ]
+
+
+def ingested_snapshots(bq_client, table_ref, snapshot_ids):
+    """
+    Returns the snapshot IDs that already have rows in table_ref or a row in
+    the delivery_ledger table of the same dataset.
+    """
+    from google.cloud import bigquery
+    from google.api_core.exceptions import NotFound
+
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("snapshot_ids", "STRING", sorted(snapshot_ids)),
+    ])
+    found = set()
+    for table_id in (table_ref.table_id, LEDGER_TABLE_ID):
+        query = f"""
+        SELECT DISTINCT snapshot_id
+        FROM `{table_ref.project}.{table_ref.dataset_id}.{table_id}`
+        WHERE snapshot_id IN UNNEST(@snapshot_ids)
+        """
+        try:
+            found.update(row.snapshot_id for row in bq_client.query(query, job_config=job_config).result())
+        except NotFound:
+            if table_id != LEDGER_TABLE_ID:
+                raise
+            print(f"No {LEDGER_TABLE_ID} table in {table_ref.dataset_id}; checking {table_ref.table_id} only.")
+    return found
+
+
+def flush_batch(bq_client, storage_client, table_ref, batch, loaded_snapshots, state_file, salt=None):
+    """
+    Loads one batch of staged snapshots with a single load job and records them as done.
+
+    Returns:
+        'loaded', 'already_loaded' (an earlier job with the same ID loaded
+        them) or 'failed'. Staged files are removed in every case.
+    """
+    uris = [result['staged_uri'] for result in batch]
+    snapshot_ids = [result['snapshot_id'] for result in batch]
+    try:
+        _, loaded = load_staged_files(bq_client, table_ref, uris, snapshot_ids, salt=salt)
+    except Exception as e:
+        print(f"Error loading {len(snapshot_ids)} snapshot(s) into {table_ref.table_id}: {e}", file=sys.stderr)
+        status = 'failed'
+    else:
+        if not loaded:
+            print(f"{len(snapshot_ids)} snapshot(s) were already loaded into {table_ref.table_id}; "
+                  "use --force to load them again.")
+        loaded_snapshots.update(snapshot_ids)
+        save_state(state_file, loaded_snapshots)
+        status = 'loaded' if loaded else 'already_loaded'
+
+    try:
+        delete_staging_files(storage_client, uris)
+    except Exception as e:
+        print(f"Could not delete staged files {uris}: {e}", file=sys.stderr)
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help="Local directory or gs://bucket/prefix of snapshot JSON files")
+    parser.add_argument('--dataset-id', help="Bright Data dataset ID for all files (default: parent directory name)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Transform worker processes")
+    parser.add_argument('--batch-size', type=int, default=50, help="Snapshots per BigQuery load job")
+    parser.add_argument('--staging-bucket', default=DEFAULT_STAGING_BUCKET, help="Bucket for staged NDJSON files")
+    parser.add_argument('--bigquery-dataset', default=os.environ.get('BIGQUERY_DATASET_ID'))
+    parser.add_argument('--reddit-table', default=os.environ.get('REDDIT_DATA_TABLE_ID'))
+    parser.add_argument('--quora-table', default=os.environ.get('QUORA_DATA_TABLE_ID'))
+    parser.add_argument('--state-file', default='.backfill_state.json', help="Resume file of loaded snapshot IDs")
+    parser.add_argument('--dry-run', action='store_true', help="Transform only; do not stage or load")
+    parser.add_argument('--force', action='store_true',
+                        help="Reload snapshots that were already loaded, even if the state file lists them (appends duplicates)")
+    parser.add_argument('--run-salt', help="Job ID salt for --force (default: the start time)")
+    args = parser.parse_args(argv)
+    salt = (args.run_salt or time.strftime('%Y%m%dT%H%M%S')) if args.force else None
+
+    files = list_snapshot_files(args.source, args.dataset_id)
+    unknown = sorted({dataset_id for _, dataset_id, _ in files if dataset_id not in SCHEMA_FILES})
+    if unknown:
+        parser.error(f"Unknown dataset IDs {unknown}; pass --dataset-id for flat directories")
+
+    loaded_snapshots = set() if args.dry_run else load_state(args.state_file)
+    pending = files if args.force else [f for f in files if f[2] not in loaded_snapshots]
+    print(f"Found {len(files)} snapshot files, {len(files) - len(pending)} already loaded, {len(pending)} to process.")
+    if not pending:
+        return 0
+
+    bq_client = storage_client = None
+    table_refs = {}
+    if not args.dry_run:
+        if not args.bigquery_dataset or not args.reddit_table or not args.quora_table:
+            parser.error("--bigquery-dataset, --reddit-table and --quora-table (or the deliverer env vars) are required")
+        from google.cloud import bigquery, storage
+        from transform import REDDIT_DATASET_ID, QUORA_DATASET_ID
+        bq_client = bigquery.Client()
+        storage_client = storage.Client()
+        dataset_ref = bq_client.dataset(args.bigquery_dataset)
+        table_refs = {
+            REDDIT_DATASET_ID: dataset_ref.table(args.reddit_table),
+            QUORA_DATASET_ID: dataset_ref.table(args.quora_table),
+        }
+        if not args.force:
+            ingested = set()
+            for dataset_id, table_ref in table_refs.items():
+                snapshot_ids = {f[2] for f in pending if f[1] == dataset_id}
+                if snapshot_ids:
+                    ingested |= {(dataset_id, s) for s in ingested_snapshots(bq_client, table_ref, snapshot_ids)}
+            if ingested:
+                pending = [f for f in pending if (f[1], f[2]) not in ingested]
+                print(f"{len(ingested)} snapshot(s) are already in BigQuery; {len(pending)} left to process.")
+                loaded_snapshots.update(s for _, s in ingested)
+                save_state(args.state_file, loaded_snapshots)
+            if not pending:
+                return 0
+
+    # Batches are fixed up front (see plan_batches) and flushed once all their files are done
+    batches = plan_batches(pending, args.batch_size)
+    batch_of = {index: b for b, (_, indices) in enumerate(batches) for index in indices}
+    outstanding = [len(indices) for _, indices in batches]
+    ready = [[] for _ in batches]
+    totals = {'files': 0, 'rows': 0, 'bytes': 0, 'failed': 0}
+    batch_counts = {'loaded': 0, 'already_loaded': 0, 'failed': 0}
+    failed_snapshots = []
+
+    def flush(dataset_id, batch):
+        status = flush_batch(bq_client, storage_client, table_refs[dataset_id], batch,
+                             loaded_snapshots, args.state_file, salt=salt)
+        batch_counts[status] += 1
+        if status == 'failed':
+            failed_snapshots.extend(result['snapshot_id'] for result in batch)
+    start = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(args.source.startswith('gs://') or not args.dry_run,)) as pool:
+        futures = {
+            pool.submit(process_snapshot, path, dataset_id, snapshot_id, args.staging_bucket, args.dry_run): index
+            for index, (path, dataset_id, snapshot_id) in enumerate(pending)
+        }
+        for future in as_completed(futures):
+            b = batch_of[futures[future]]
+            outstanding[b] -= 1
+            try:
+                result = future.result()
+            except Exception as e:
+                totals['failed'] += 1
+                print(f"Error processing {pending[futures[future]][0]}: {e}", file=sys.stderr)
+                result = None
+
+            if result is not None:
+                totals['files'] += 1
+                totals['rows'] += result['rows']
+                totals['bytes'] += result['bytes']
+                elapsed = time.monotonic() - start
+                print(f"[{totals['files'] + totals['failed']}/{len(pending)}] {result['snapshot_id']}: "
+                      f"{result['rows']} rows in {result['total_seconds']:.2f}s "
+                      f"({totals['files'] / elapsed:.1f} files/s)")
+                ready[b].append(result)
+
+            if not args.dry_run and outstanding[b] == 0 and ready[b]:
+                flush(batches[b][0], ready[b])
+                ready[b] = []
+
+    elapsed = time.monotonic() - start
+    print("\nBackfill summary")
+    print(f"  files processed: {totals['files']} ({totals['failed']} failed)")
+    print(f"  rows:            {totals['rows']}")
+    if not args.dry_run:
+        print(f"  load batches:    {batch_counts['loaded']} loaded, {batch_counts['already_loaded']} already loaded, "
+              f"{batch_counts['failed']} failed")
+        if failed_snapshots:
+            print(f"  failed loads:    {len(failed_snapshots)} snapshot(s), retried on the next run: "
+                  f"{', '.join(sorted(failed_snapshots)[:10])}{' ...' if len(failed_snapshots) > 10 else ''}")
+    print(f"  input size:      {totals['bytes'] / 1e6:.1f} MB")
+    print(f"  elapsed:         {elapsed:.1f}s")
+    print(f"  throughput:      {totals['files'] / elapsed:.2f} files/s, "
+          f"{totals['rows'] / elapsed:.0f} rows/s, {totals['bytes'] / 1e6 / elapsed:.1f} MB/s")
+    return 1 if totals['failed'] or batch_counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
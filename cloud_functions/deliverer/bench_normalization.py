@@ -0,0 +1,81 @@
+"""
+Measures what the pre-embedding normalization saves on real deliveries.
+
+Runs the enrichment normalization stage over the content loaded in the last
+N days (regardless of what is already in embeddings_cache) and compares the
+raw texts with what would be sent to ML.GENERATE_EMBEDDING: items, model
+calls after de-duplication by normalized_text_hash, and characters (tokens
+estimated at enrichment.CHARS_PER_TOKEN). The query only reads text
+columns; no model is called.
+
+Usage:
+    python bench_normalization.py [--days 7] [--examples 5]
+"""
+import argparse
+
+from google.cloud import bigquery
+
+from enrichment import CHARS_PER_TOKEN, CONTENT_VIEW, normalized_items_sql
+
+
+def window_sql(days):
+    return f"primary_text IS NOT NULL AND record_load_timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(days)} DAY)"
+
+
+def stats_sql(days):
+    window = window_sql(days)
+    return f"""
+        WITH Raw AS (
+          SELECT COUNT(*) AS items, SUM(LENGTH(primary_text)) AS chars
+          FROM `{CONTENT_VIEW}`
+          WHERE {window}
+        ),
+        Normalized AS ({normalized_items_sql('content_item_id', f'`{CONTENT_VIEW}`', window)}
+        ),
+        DistinctTexts AS (
+          SELECT normalized_text_hash, ANY_VALUE(LENGTH(content)) AS chars
+          FROM Normalized
+          WHERE embeddable
+          GROUP BY normalized_text_hash
+        )
+        SELECT
+          Raw.items AS raw_items,
+          Raw.chars AS raw_chars,
+          (SELECT COUNT(*) FROM Normalized) AS kept_items,
+          (SELECT COUNTIF(embeddable) FROM Normalized) AS embeddable_items,
+          (SELECT COUNT(*) FROM DistinctTexts) AS embedding_calls,
+          (SELECT SUM(chars) FROM DistinctTexts) AS embedded_chars
+        FROM Raw
+    """
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--examples', type=int, default=0, help="Print this many raw/normalized pairs of changed texts")
+    args = parser.parse_args(argv)
+
+    client = bigquery.Client()
+    row = list(client.query(stats_sql(args.days)).result())[0]
+    raw_items, raw_chars = row.raw_items or 0, row.raw_chars or 0
+    calls, chars = row.embedding_calls or 0, row.embedded_chars or 0
+    print(f"Last {args.days} days: {raw_items} items, ~{raw_chars // CHARS_PER_TOKEN:,} tokens raw")
+    print(f"  dropped (empty/placeholder): {raw_items - row.kept_items}")
+    print(f"  too short to embed:          {row.kept_items - row.embeddable_items}")
+    print(f"  duplicate normalized texts:  {row.embeddable_items - calls}")
+    print(f"Embedding calls: {calls} ({calls / max(raw_items, 1):.1%} of raw items)")
+    print(f"Embedded tokens: ~{chars // CHARS_PER_TOKEN:,} ({chars / max(raw_chars, 1):.1%} of raw)")
+
+    if args.examples:
+        examples = client.query(f"""
+            SELECT original, content
+            FROM ({normalized_items_sql('primary_text AS original', f'`{CONTENT_VIEW}`', window_sql(args.days))})
+            WHERE content != original
+            LIMIT {int(args.examples)}
+        """).result()
+        for example in examples:
+            print(f"\n--- raw ---\n{example.original[:500]}\n--- normalized ---\n{example.content[:500]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Throughput benchmark for the local sentiment scorer.
+
+Scores synthetic comment-like texts (random mixes of lexicon words,
+negations, boosters, "but" clauses, exclamations and neutral filler) in
+batches and reports texts/second for each batch size, against a plain Python
+per-text, per-word scorer that applies the same rules (and is checked to give
+the same scores first). Pass --csv with a file of texts (one per line) to
+score real content instead.
+
+Usage:
+    python bench_sentiment.py [--texts 100000] [--words 40] [--batch-sizes 1 100 1000 10000]
+    python bench_sentiment.py --csv sample_texts.txt
+"""
+import argparse
+import math
+import random
+import time
+
+import numpy as np
+
+from sentiment import (
+    BOOSTER_DISTANCE_WEIGHTS, BOOSTERS, BUT_AFTER_WEIGHT, BUT_BEFORE_WEIGHT, CAPS_INCREMENT, DEFAULT_LEXICON,
+    EXCLAMATION_INCREMENT, MAGNITUDE_DIVISOR, MAX_EXCLAMATIONS, NEGATION_SCALAR, NEGATORS, NORMALIZATION_ALPHA,
+    SentimentScorer, _TOKEN_RE,
+)
+
+FILLER = ("the a this that it i you we they my our phone app battery update price service "
+          "support team order delivery screen camera today week just also still really").split()
+
+
+def synthetic_texts(n, words_per_text, seed=0):
+    rng = random.Random(seed)
+    lexicon_words = list(DEFAULT_LEXICON)
+    modifiers = list(NEGATORS) + list(BOOSTERS)
+    texts = []
+    for _ in range(n):
+        words = []
+        for _ in range(rng.randint(words_per_text // 2, words_per_text * 3 // 2)):
+            roll = rng.random()
+            if roll < 0.15:
+                word = rng.choice(lexicon_words)
+            elif roll < 0.2:
+                word = rng.choice(modifiers)
+            elif roll < 0.21:
+                word = 'but'
+            else:
+                word = rng.choice(FILLER)
+            words.append(word.upper() if rng.random() < 0.01 else word)
+        texts.append(' '.join(words) + ('!' * rng.randint(0, 2)))
+    return texts
+
+
+def reference_score(text, lexicon):
+    """Scores one text word by word with the same rules as SentimentScorer; returns (score, magnitude)."""
+    if not text:
+        return 0.0, 0.0
+    words = _TOKEN_RE.findall(text)
+    lowered = [word.lower() for word in words]
+    mixed_case = not text.isupper()
+    has_but = 'but' in lowered
+    seen_but = False
+    total = magnitude = 0.0
+    for i, word in enumerate(lowered):
+        seen_but = seen_but or word == 'but'
+        valence = lexicon.get(word, 0.0)
+        if not valence:
+            continue
+        sign = math.copysign(1.0, valence)
+        negated = False
+        for distance, weight in enumerate(BOOSTER_DISTANCE_WEIGHTS, start=1):
+            if i >= distance:
+                previous = lowered[i - distance]
+                valence += sign * BOOSTERS.get(previous, 0.0) * weight
+                negated = negated or previous in NEGATORS
+        if negated:
+            valence *= NEGATION_SCALAR
+        if mixed_case and len(words[i]) > 1 and words[i].isupper():
+            valence += math.copysign(CAPS_INCREMENT, valence) if valence else 0.0
+        if has_but:
+            valence *= BUT_AFTER_WEIGHT if seen_but else BUT_BEFORE_WEIGHT
+        total += valence
+        magnitude += abs(valence)
+    magnitude /= MAGNITUDE_DIVISOR
+    if total:
+        emphasis = min(text.count('!'), MAX_EXCLAMATIONS) * EXCLAMATION_INCREMENT
+        total += math.copysign(emphasis, total)
+        magnitude += emphasis / MAGNITUDE_DIVISOR
+    return total / math.sqrt(total * total + NORMALIZATION_ALPHA), magnitude
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--csv', help="File with one text per line")
+    parser.add_argument('--texts', type=int, default=100_000)
+    parser.add_argument('--words', type=int, default=40, help="Average words per synthetic text")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 100, 1000, 10000])
+    args = parser.parse_args(argv)
+
+    if args.csv:
+        with open(args.csv, encoding='utf-8') as f:
+            texts = [line.rstrip('\n') for line in f]
+    else:
+        texts = synthetic_texts(args.texts, args.words)
+    total_words = sum(len(t.split()) for t in texts)
+    print(f"{len(texts)} texts, {total_words / len(texts):.1f} words on average")
+
+    scorer = SentimentScorer(DEFAULT_LEXICON)
+    start = time.perf_counter()
+    expected = np.array([reference_score(text, DEFAULT_LEXICON) for text in texts]).reshape(-1, 2)
+    elapsed = time.perf_counter() - start
+    reference_rate = len(texts) / elapsed
+    scores, magnitudes = scorer.score(texts)
+    if not (np.allclose(scores, expected[:, 0]) and np.allclose(magnitudes, expected[:, 1])):
+        raise SystemExit("Batched scores differ from the per-text reference")
+    print(f"\n{'per-text reference':<24}{reference_rate:>12,.0f} texts/s")
+
+    for batch_size in args.batch_sizes:
+        # Single-text batches are slow; time a slice so the run stays short
+        sample = texts[:min(len(texts), batch_size * 2000)]
+        start = time.perf_counter()
+        for i in range(0, len(sample), batch_size):
+            scorer.score(sample[i:i + batch_size])
+        elapsed = time.perf_counter() - start
+        rate = len(sample) / elapsed
+        print(f"{'batch of ' + str(batch_size):<24}{rate:>12,.0f} texts/s  ({rate / reference_rate:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
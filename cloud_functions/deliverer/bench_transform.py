@@ -0,0 +1,217 @@
+"""
+Micro-benchmark for the compiled snapshot transformer.
+
+Builds synthetic Reddit posts with deep comment trees and compares the
+schema-compiled transformer against the per-post inline transformation the
+deliverer used before. Also checks that both produce the same rows (the
+compiled transformer keeps Bright Data's UTC timestamp strings as delivered,
+so timestamps are compared as instants).
+
+Usage:
+    python bench_transform.py [--posts 2000] [--comments 40] [--replies 10]
+"""
+import argparse
+import datetime
+import random
+import time
+
+from transform import REDDIT_DATASET_ID, _is_utc_timestamp, transform_posts
+
+
+def legacy_transform(posts_data, job_id):
+    """The Reddit branch of the deliverer before the compiled transformer, kept for comparison."""
+    rows_to_insert = []
+    for post in posts_data:
+        def parse_timestamp(ts_str):
+            if not ts_str:
+                return None
+            try:
+                dt = datetime.datetime.fromisoformat(ts_str.replace('Z', '+00:00'))
+                return dt.isoformat()
+            except (ValueError, AttributeError):
+                return None
+
+        def to_int(val):
+            if val is None or val == '':
+                return None
+            try:
+                return int(val)
+            except (ValueError, TypeError):
+                return None
+
+        row = {
+            "post_id": post.get("post_id"),
+            "url": post.get("url"),
+            "user_posted": post.get("user_posted"),
+            "title": post.get("title"),
+            "description": post.get("description"),
+            "num_comments": to_int(post.get("num_comments")),
+            "date_posted": parse_timestamp(post.get("date_posted")),
+            "community_name": post.get("community_name"),
+            "num_upvotes": to_int(post.get("num_upvotes")),
+            "photos": post.get("photos", []) if isinstance(post.get("photos"), list) else [],
+            "videos": post.get("videos", []) if isinstance(post.get("videos"), list) else [],
+            "tag": post.get("tag"),
+            "related_posts": [
+                {
+                    "num_comments": to_int(rp.get("num_comments")),
+                    "num_upvotes": to_int(rp.get("num_upvotes")),
+                    "thumbnail": rp.get("thumbnail"),
+                    "url": rp.get("url"),
+                    "title": rp.get("title"),
+                    "community_url": rp.get("community_url"),
+                    "community": rp.get("community")
+                }
+                for rp in (post.get("related_posts") or [])
+            ],
+            "comments": [
+                {
+                    "replies": [
+                        {
+                            "num_replies": to_int(reply.get("num_replies")),
+                            "num_upvotes": to_int(reply.get("num_upvotes")),
+                            "date_of_reply": parse_timestamp(reply.get("date_of_reply")),
+                            "user_url": reply.get("user_url"),
+                            "reply": reply.get("reply"),
+                            "user_replying": reply.get("user_replying")
+                        }
+                        for reply in (comment.get("replies") or [])
+                    ],
+                    "num_replies": to_int(comment.get("num_replies")),
+                    "user_commenting": comment.get("user_commenting"),
+                    "num_upvotes": to_int(comment.get("num_upvotes")),
+                    "date_of_comment": parse_timestamp(comment.get("date_of_comment")),
+                    "url": comment.get("url"),
+                    "user_url": comment.get("user_url"),
+                    "comment": comment.get("comment")
+                }
+                for comment in (post.get("comments") or [])
+            ],
+            "community_url": post.get("community_url"),
+            "community_description": post.get("community_description"),
+            "community_members_num": to_int(post.get("community_members_num")),
+            "community_rank": {
+                "community_rank_value": post.get("community_rank", {}).get("community_rank_value"),
+                "community_rank_type": post.get("community_rank", {}).get("community_rank_type")
+            } if post.get("community_rank") else None,
+            "post_karma": to_int(post.get("post_karma")),
+            "bio_description": post.get("bio_description"),
+            "embedded_links": post.get("embedded_links", []) if isinstance(post.get("embedded_links"), list) else [],
+            "timestamp": parse_timestamp(post.get("timestamp")),
+            "input": {
+                "url": post.get("input", {}).get("url")
+            } if post.get("input") else None,
+            "error_code": post.get("error_code"),
+            "error": post.get("error"),
+            "warning_code": post.get("warning_code"),
+            "warning": post.get("warning"),
+            "snapshot_id": job_id
+        }
+        rows_to_insert.append(row)
+    return rows_to_insert
+
+
+def _random_timestamp(rng):
+    ts = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(seconds=rng.randrange(3 * 10**7))
+    millis = rng.choice([0, rng.randrange(1000)])
+    return ts.strftime('%Y-%m-%dT%H:%M:%S') + f".{millis:03d}Z"
+
+
+def make_posts(n_posts, n_comments, n_replies, seed=0):
+    """Generates synthetic Bright Data Reddit posts with n_comments x n_replies comment trees."""
+    rng = random.Random(seed)
+    posts = []
+    for p in range(n_posts):
+        comments = []
+        for c in range(n_comments):
+            replies = [{
+                "num_replies": rng.randrange(5),
+                "num_upvotes": str(rng.randrange(500)),
+                "date_of_reply": _random_timestamp(rng),
+                "user_url": f"https://www.reddit.com/user/u{rng.randrange(10**6)}/",
+                "reply": "reply text " * rng.randrange(1, 20),
+                "user_replying": f"u{rng.randrange(10**6)}",
+            } for _ in range(n_replies)]
+            comments.append({
+                "replies": replies,
+                "num_replies": n_replies,
+                "user_commenting": f"u{rng.randrange(10**6)}",
+                "num_upvotes": rng.randrange(1000),
+                "date_of_comment": _random_timestamp(rng),
+                "url": f"https://www.reddit.com/r/test/comments/p{p}/c{c}/",
+                "user_url": f"https://www.reddit.com/user/u{rng.randrange(10**6)}/",
+                "comment": "comment text " * rng.randrange(1, 40),
+            })
+        posts.append({
+            "post_id": f"t3_{p}",
+            "url": f"https://www.reddit.com/r/test/comments/p{p}/",
+            "user_posted": f"u{p}",
+            "title": f"Post {p}",
+            "description": "body " * 50,
+            "num_comments": str(n_comments),
+            "date_posted": _random_timestamp(rng),
+            "community_name": "test",
+            "num_upvotes": rng.randrange(10000),
+            "photos": ["https://i.redd.it/a.jpg"],
+            "videos": None,
+            "related_posts": [{"num_comments": "12", "num_upvotes": 40, "url": f"https://www.reddit.com/r/test/comments/r{i}/",
+                               "title": "related", "community": "r/test"} for i in range(5)],
+            "comments": comments,
+            "community_rank": {"community_rank_value": "Top 1%", "community_rank_type": "Rank by size"},
+            "community_members_num": "123456",
+            "embedded_links": [],
+            "timestamp": _random_timestamp(rng),
+            "input": {"url": f"https://www.reddit.com/r/test/comments/p{p}/"},
+            "unknown_field": "dropped",
+        })
+    return posts
+
+
+def _normalize_timestamps(value):
+    """Rewrites UTC timestamp strings in the legacy isoformat() shape, recursively."""
+    if type(value) is dict:
+        return {key: _normalize_timestamps(item) for key, item in value.items()}
+    if type(value) is list:
+        return [_normalize_timestamps(item) for item in value]
+    if type(value) is str and _is_utc_timestamp(value):
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).isoformat()
+    return value
+
+
+def _time(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--comments', type=int, default=40)
+    parser.add_argument('--replies', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    posts = make_posts(args.posts, args.comments, args.replies)
+    snapshot_id = "s_benchmark"
+
+    compiled_rows = _normalize_timestamps(transform_posts(REDDIT_DATASET_ID, posts, snapshot_id))
+    if legacy_transform(posts, snapshot_id) != compiled_rows:
+        raise SystemExit("Compiled transformer output differs from the legacy transformation")
+
+    legacy = _time(lambda: legacy_transform(posts, snapshot_id), args.repeat)
+    compiled = _time(lambda: transform_posts(REDDIT_DATASET_ID, posts, snapshot_id), args.repeat)
+
+    items_per_post = 1 + args.comments * (1 + args.replies)
+    print(f"{args.posts} posts x {args.comments} comments x {args.replies} replies "
+          f"({items_per_post} items per post)")
+    print(f"legacy:   {args.posts / legacy:10.1f} posts/s  ({legacy * 1000:.1f} ms)")
+    print(f"compiled: {args.posts / compiled:10.1f} posts/s  ({compiled * 1000:.1f} ms)")
+    print(f"speedup:  {legacy / compiled:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,18 @@ import json
 import os
 from google.cloud import bigquery
 import datetime
+import time
 from google.api_core.exceptions import GoogleAPIError # Import for BigQuery API errors
 from google.cloud import storage  # Add import for GCS client
+from loader import is_staging_object, write_staging_file, load_staged_files, delete_staging_files
+from transform import REDDIT_DATASET_ID, QUORA_DATASET_ID, transform_posts
+from ledger import DeliveryRetry, delivery_key, is_ledger_object, claim_delivery, release_delivery, complete_delivery
+from hooks import notify_embeddings_updated
+from enrichment import run_enrichment_merge
+
+# 'streaming' uses insert_rows_json; 'load_job' stages the snapshot as NDJSON in the
+# same bucket and submits one BigQuery load job per snapshot.
+INGESTION_MODE = os.environ.get('INGESTION_MODE', 'streaming')
 
 # Initialize BigQuery client outside the function for potential warm starts
 # It's generally safe as long as the client is not tied to a specific request context.
@@ -21,6 +31,9 @@ def process_reddit_data_from_pubsub(cloud_event):
     Cloud Function triggered by a GCS finalized event containing scraped Reddit data.
     Downloads the file, inserts data into BigQuery reddit_data table,
     and updates the scrape_job table status.
+
+    With INGESTION_MODE=load_job the rows are staged as NDJSON under STAGING_PREFIX
+    and loaded with one load job per snapshot instead of streaming inserts.
     """
     print("Received GCS event.")
     print(cloud_event)
@@ -38,6 +51,9 @@ def process_reddit_data_from_pubsub(cloud_event):
         gcs_bucket = cloud_event.data['bucket']
         gcs_object = cloud_event.data['name']
         print(f"Detected GCS event: bucket={gcs_bucket}, object={gcs_object}")
+        if is_staging_object(gcs_object) or is_ledger_object(gcs_object):
+            print(f"Ignoring deliverer-owned object: {gcs_object}")
+            return
         # Extract dataset_id and job_id from object name
         # Example: gd_lvz8ah06191smkebj4/s_mdg76ss41kkwv9mio8.json
         parts = gcs_object.split('/')
@@ -55,18 +71,6 @@ def process_reddit_data_from_pubsub(cloud_event):
         print(f"Error parsing GCS object name: {e}")
         return
 
-    # --- Download the file from GCS ---
-    try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(gcs_bucket)
-        blob = bucket.blob(gcs_object)
-        file_contents = blob.download_as_text()
-        posts_data = json.loads(file_contents)
-        print(f"Downloaded and parsed {len(posts_data)} posts from GCS.")
-    except Exception as e:
-        print(f"Error downloading or parsing GCS file: {e}")
-        return
-
     # --- Fetch BigQuery table IDs from environment variables ---
     bigquery_dataset_id = os.environ.get('BIGQUERY_DATASET_ID')
     reddit_data_table_id = os.environ.get('REDDIT_DATA_TABLE_ID')
@@ -89,141 +93,44 @@ def process_reddit_data_from_pubsub(cloud_event):
         print("Error: SCRAPE_JOB_TABLE_ID environment variable not set for scrape_job.")
         return
 
-    # --- Prepare data for BigQuery insertion ---
-    rows_to_insert = []
-    
-    if message_dataset_id == "gd_lvz8ah06191smkebj4":  # Reddit dataset
-        for post in posts_data:
-            # Helper function to convert timestamp strings to proper format
-            def parse_timestamp(ts_str):
-                if not ts_str:
-                    return None
-                try:
-                    # Try parsing as ISO format first
-                    dt = datetime.datetime.fromisoformat(ts_str.replace('Z', '+00:00'))
-                    return dt.isoformat()
-                except (ValueError, AttributeError):
-                    return None
+    # --- Claim the delivery in the ledger so redelivered events are skipped ---
+    storage_client = storage.Client()
+    object_generation = cloud_event.data.get('generation')
+    ledger_key = delivery_key(job_id, object_generation)
+    if not claim_delivery(storage_client, ledger_key):
+        return
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    timings_ms = {}
 
-            # Helper function to convert to integer
-            def to_int(val):
-                if val is None or val == '':
-                    return None
-                try:
-                    return int(val)
-                except (ValueError, TypeError):
-                    return None
+    # --- Download the file from GCS ---
+    phase_start = time.monotonic()
+    try:
+        bucket = storage_client.bucket(gcs_bucket)
+        blob = bucket.blob(gcs_object)
+        file_contents = blob.download_as_text()
+        posts_data = json.loads(file_contents)
+        print(f"Downloaded and parsed {len(posts_data)} posts from GCS.")
+    except Exception as e:
+        print(f"Error downloading or parsing GCS file: {e}")
+        release_delivery(storage_client, ledger_key)
+        return
+    timings_ms['download'] = int((time.monotonic() - phase_start) * 1000)
 
-            row = {
-                "post_id": post.get("post_id"),
-                "url": post.get("url"),
-                "user_posted": post.get("user_posted"),
-                "title": post.get("title"),
-                "description": post.get("description"),
-                "num_comments": to_int(post.get("num_comments")),
-                "date_posted": parse_timestamp(post.get("date_posted")),
-                "community_name": post.get("community_name"),
-                "num_upvotes": to_int(post.get("num_upvotes")),
-                "photos": post.get("photos", []) if isinstance(post.get("photos"), list) else [],
-                "videos": post.get("videos", []) if isinstance(post.get("videos"), list) else [],
-                "tag": post.get("tag"),
-                "related_posts": [
-                    {
-                        "num_comments": to_int(rp.get("num_comments")),
-                        "num_upvotes": to_int(rp.get("num_upvotes")),
-                        "thumbnail": rp.get("thumbnail"),
-                        "url": rp.get("url"),
-                        "title": rp.get("title"),
-                        "community_url": rp.get("community_url"),
-                        "community": rp.get("community")
-                    }
-                    for rp in (post.get("related_posts") or [])
-                ],
-                "comments": [
-                    {
-                        "replies": [
-                            {
-                                "num_replies": to_int(reply.get("num_replies")),
-                                "num_upvotes": to_int(reply.get("num_upvotes")),
-                                "date_of_reply": parse_timestamp(reply.get("date_of_reply")),
-                                "user_url": reply.get("user_url"),
-                                "reply": reply.get("reply"),
-                                "user_replying": reply.get("user_replying")
-                            }
-                            for reply in (comment.get("replies") or [])
-                        ],
-                        "num_replies": to_int(comment.get("num_replies")),
-                        "user_commenting": comment.get("user_commenting"),
-                        "num_upvotes": to_int(comment.get("num_upvotes")),
-                        "date_of_comment": parse_timestamp(comment.get("date_of_comment")),
-                        "url": comment.get("url"),
-                        "user_url": comment.get("user_url"),
-                        "comment": comment.get("comment")
-                    }
-                    for comment in (post.get("comments") or [])
-                ],
-                "community_url": post.get("community_url"),
-                "community_description": post.get("community_description"),
-                "community_members_num": to_int(post.get("community_members_num")),
-                "community_rank": {
-                    "community_rank_value": post.get("community_rank", {}).get("community_rank_value"),
-                    "community_rank_type": post.get("community_rank", {}).get("community_rank_type")
-                } if post.get("community_rank") else None,
-                "post_karma": to_int(post.get("post_karma")),
-                "bio_description": post.get("bio_description"),
-                "embedded_links": post.get("embedded_links", []) if isinstance(post.get("embedded_links"), list) else [],
-                "timestamp": parse_timestamp(post.get("timestamp")),
-                "input": {
-                    "url": post.get("input", {}).get("url")
-                } if post.get("input") else None,
-                "error_code": post.get("error_code"),
-                "error": post.get("error"),
-                "warning_code": post.get("warning_code"),
-                "warning": post.get("warning"),
-                "snapshot_id": job_id  # This is REQUIRED in the schema
-            }
-            rows_to_insert.append(row)
-    elif message_dataset_id == "gd_lvz1rbj81afv3m6n5y":  # Quora dataset
-        for post in posts_data:
-            row = {
-                "timestamp": post.get("timestamp"),
-                "author_education": post.get("author_education"),
-                "post_id": post.get("post_id"),
-                "top_comments": post.get("top_comments"),
-                "views": post.get("views"),
-                "shares": post.get("shares"),
-                "author_content_views": post.get("author_content_views"),
-                "post_date": post.get("post_date"),
-                "upvotes": post.get("upvotes"),
-                "extarnal_urls": post.get("extarnal_urls"),
-                "pictures_urls": post.get("pictures_urls"),
-                "header": post.get("header"),
-                "author_joined_date": post.get("author_joined_date"),
-                "input": post.get("input"),
-                "post_text": post.get("post_text"),
-                "videos_urls": post.get("videos_urls"),
-                "over_all_answers": post.get("over_all_answers"),
-                "originally_answered": post.get("originally_answered"),
-                "author_name": post.get("author_name"),
-                "author_about": post.get("author_about"),
-                "error": post.get("error"),
-                "url": post.get("url"),
-                "error_code": post.get("error_code"),
-                "author_active_spaces": post.get("author_active_spaces"),
-                "title": post.get("title"),
-                "snapshot_id": job_id
-            }
-            rows_to_insert.append(row)
-    else:
+    # --- Prepare data for BigQuery insertion ---
+    phase_start = time.monotonic()
+    rows_to_insert = transform_posts(message_dataset_id, posts_data, job_id)
+    if rows_to_insert is None:
         print(f"Error: Unknown dataset_id: {message_dataset_id}")
+        release_delivery(storage_client, ledger_key)
         return
+    timings_ms['transform'] = int((time.monotonic() - phase_start) * 1000)
 
     # --- Insert data into appropriate BigQuery table based on dataset_id ---
     target_table_id = None
-    if message_dataset_id == "gd_lvz8ah06191smkebj4":  # Reddit dataset
+    if message_dataset_id == REDDIT_DATASET_ID:
         target_table_id = reddit_data_table_id
         print("Routing data to Reddit table")
-    elif message_dataset_id == "gd_lvz1rbj81afv3m6n5y":  # Quora dataset
+    elif message_dataset_id == QUORA_DATASET_ID:
         target_table_id = quora_data_table_id
         print("Routing data to Quora table")
     else:
@@ -232,100 +139,69 @@ def process_reddit_data_from_pubsub(cloud_event):
 
     target_table_ref = bq_client.dataset(bigquery_dataset_id).table(target_table_id)
     target_table = None
-    try:
-        target_table = bq_client.get_table(target_table_ref) # Get table schema
-        print(f"Inserting {len(rows_to_insert)} rows into {bigquery_dataset_id}.{target_table_id}")
-        errors = bq_client.insert_rows_json(target_table, rows_to_insert)
-
-        if errors:
-            print(f"BigQuery insertion into {target_table_id} had errors: {errors}")
+    phase_start = time.monotonic()
+    if INGESTION_MODE == 'load_job':
+        try:
+            staged_uri = write_staging_file(storage_client, gcs_bucket, message_dataset_id, job_id, rows_to_insert)
+            load_job, loaded = load_staged_files(bq_client, target_table_ref, [staged_uri], [job_id])
+            insertion_status = "completed_success" if loaded else "already_loaded"
+            delete_staging_files(storage_client, [staged_uri])
+        except GoogleAPIError as e:
+            print(f"BigQuery API error during load into {target_table_id}: {e}")
             insertion_status = "completed_with_failures"
-            # Log specific errors if needed
-        else:
-            print(f"BigQuery insertion into {target_table_id} successful.")
-            insertion_status = "completed_success"
+        except Exception as e:
+            print(f"An unexpected error occurred during load into {target_table_id}: {e}")
+            insertion_status = "completed_with_failures"
+    else:
+        try:
+            target_table = bq_client.get_table(target_table_ref) # Get table schema
+            print(f"Inserting {len(rows_to_insert)} rows into {bigquery_dataset_id}.{target_table_id}")
+            errors = bq_client.insert_rows_json(target_table, rows_to_insert)
 
-    except GoogleAPIError as e:
-        print(f"BigQuery API error during insertion into {target_table_id}: {e}")
-        insertion_status = "completed_with_failures" # Or a specific error status
-        # Log the error details
-    except Exception as e:
-        print(f"An unexpected error occurred during BigQuery insertion into {target_table_id}: {e}")
-        insertion_status = "completed_with_failures" # Or a specific error status
-        # Log the error details
+            if errors:
+                print(f"BigQuery insertion into {target_table_id} had errors: {errors}")
+                insertion_status = "completed_with_failures"
+                # Log specific errors if needed
+            else:
+                print(f"BigQuery insertion into {target_table_id} successful.")
+                insertion_status = "completed_success"
+
+        except GoogleAPIError as e:
+            print(f"BigQuery API error during insertion into {target_table_id}: {e}")
+            insertion_status = "completed_with_failures" # Or a specific error status
+            # Log the error details
+        except Exception as e:
+            print(f"An unexpected error occurred during BigQuery insertion into {target_table_id}: {e}")
+            insertion_status = "completed_with_failures" # Or a specific error status
+            # Log the error details
+
+    timings_ms['insert'] = int((time.monotonic() - phase_start) * 1000)
+
+    if insertion_status == "completed_with_failures":
+        # Leave the delivery unclaimed and fail the invocation so Eventarc retries it
+        release_delivery(storage_client, ledger_key)
+        raise DeliveryRetry(f"Insertion of snapshot {job_id} into {target_table_id} failed")
 
     # After successful insertion, run the embeddings_cache MERGE job for both Reddit and Quora
     if insertion_status == "completed_success":
-        print("Running embeddings_cache MERGE job...")
-        merge_sql = """
-        MERGE INTO `social-listening-sense.social_listening_data.embeddings_cache` AS T
-        USING (
-          WITH SourceData AS (
-            SELECT v.content_item_id, v.primary_text AS content
-            FROM `social-listening-sense.social_listening_data.unified_social_content_items` AS v
-            LEFT JOIN `social-listening-sense.social_listening_data.embeddings_cache` AS ec
-            ON v.content_item_id = ec.unified_id
-            WHERE
-              v.record_load_timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 2 DAY)
-              AND (ec.unified_id IS NULL OR ec.sentiment_score IS NULL OR ec.embeddings IS NULL OR ARRAY_LENGTH(ec.embeddings) = 0)
-              AND v.primary_text IS NOT NULL AND LENGTH(TRIM(v.primary_text)) > 0
-          ),
-          EmbeddingResults AS (
-            SELECT generated.content_item_id, generated.ml_generate_embedding_result AS embeddings_array, generated.ml_generate_embedding_status AS embedding_status
-            FROM ML.GENERATE_EMBEDDING(
-              MODEL `social-listening-sense.social_listening_data.social_media_embedding_model`,
-              (SELECT content_item_id, content FROM SourceData),
-              STRUCT(TRUE AS flatten_json_output, 'CLUSTERING' as task_type)
-            ) AS generated
-          ),
-          SentimentResults AS (
-            SELECT
-              understand_results.content_item_id,
-              CAST(JSON_VALUE(understand_results.ml_understand_text_result, '$.document_sentiment.score') AS FLOAT64) AS sentiment_score,
-              CAST(JSON_VALUE(understand_results.ml_understand_text_result, '$.document_sentiment.magnitude') AS FLOAT64) AS sentiment_magnitude,
-              understand_results.ml_understand_text_status AS sentiment_status
-            FROM ML.UNDERSTAND_TEXT(
-              MODEL `social-listening-sense.social_listening_data.sentiment_analysis_model`,
-              (SELECT content_item_id, content AS text_content FROM SourceData),
-              STRUCT('analyze_sentiment' AS nlu_option)
-            ) AS understand_results
-          )
-          SELECT
-            COALESCE(er.content_item_id, sr.content_item_id) AS unified_id,
-            er.embeddings_array AS embeddings,
-            CURRENT_TIMESTAMP() AS embedding_generated_at,
-            'text-embedding-004' AS embedding_model_name,
-            'CLUSTERING' AS embedding_task_type,
-            sr.sentiment_score,
-            sr.sentiment_magnitude,
-            er.embedding_status,
-            sr.sentiment_status
-          FROM EmbeddingResults AS er
-          FULL OUTER JOIN SentimentResults AS sr
-          ON er.content_item_id = sr.content_item_id
-          WHERE
-            (LENGTH(COALESCE(er.embedding_status, '')) = 0 OR er.content_item_id IS NULL)
-            AND (LENGTH(COALESCE(sr.sentiment_status, '')) = 0 OR sr.content_item_id IS NULL)
-            AND (er.content_item_id IS NOT NULL OR sr.content_item_id IS NOT NULL)
-        ) AS S
-        ON T.unified_id = S.unified_id
-        WHEN NOT MATCHED THEN
-          INSERT (unified_id, embeddings, embedding_model_name, embedding_task_type, embedding_generated_at, sentiment_score, sentiment_magnitude)
-          VALUES (S.unified_id, S.embeddings, S.embedding_model_name, S.embedding_task_type, S.embedding_generated_at, S.sentiment_score, S.sentiment_magnitude)
-        WHEN MATCHED THEN
-          UPDATE SET
-            T.embeddings = COALESCE(T.embeddings, S.embeddings),
-            T.embedding_model_name = COALESCE(T.embedding_model_name, S.embedding_model_name),
-            T.embedding_task_type = COALESCE(T.embedding_task_type, S.embedding_task_type),
-            T.embedding_generated_at = COALESCE(T.embedding_generated_at, S.embedding_generated_at),
-            T.sentiment_score = COALESCE(T.sentiment_score, S.sentiment_score),
-            T.sentiment_magnitude = COALESCE(T.sentiment_magnitude, S.sentiment_magnitude)
-        """
-        try:
-            merge_job = bq_client.query(merge_sql)
-            merge_job.result()  # Wait for job to complete
-            print("MERGE job for embeddings_cache completed successfully.")
-        except Exception as e:
-            print(f"Error running embeddings_cache MERGE job: {e}")
+        phase_start = time.monotonic()
+        merge_succeeded = run_enrichment_merge(bq_client)['succeeded']
+        timings_ms['merge'] = int((time.monotonic() - phase_start) * 1000)
+
+        if merge_succeeded:
+            # Let downstream functions (similarity index, topic assignment) pick up the new embeddings
+            notify_embeddings_updated(bigquery_dataset_id)
+
+    complete_delivery(storage_client, bq_client, bigquery_dataset_id, ledger_key, {
+        'snapshot_id': job_id,
+        'object_generation': object_generation,
+        'dataset_id': message_dataset_id,
+        'trigger': 'gcs',
+        'ingestion_mode': INGESTION_MODE,
+        'status': insertion_status,
+        'row_count': len(rows_to_insert),
+        'started_at': started_at,
+        'timings_ms': timings_ms,
+    })
 
     print("Function execution finished.")
\ No newline at end of file
@@ -0,0 +1,333 @@
+"""
+embeddings_cache enrichment MERGE shared by both deliverers.
+
+After a delivery, content items loaded in the last two days that still lack
+embeddings or sentiment are enriched: embeddings (plus their int8 copy) with
+ML.GENERATE_EMBEDDING, sentiment with one of two engines (SENTIMENT_ENGINE,
+or per delivery where the trigger allows it):
+
+- remote: ML.UNDERSTAND_TEXT analyze_sentiment, as before.
+- local: the in-process lexicon scorer (sentiment.py). Candidate texts are
+  read, scored here and passed to the MERGE as a query parameter; no NL API
+  quota is used.
+- auto: remote first, keeping the embeddings of items whose sentiment call
+  failed or was throttled; those items, or all of them if the remote MERGE
+  fails outright, are then scored locally.
+
+Each engine only sends the items that are missing its output, so an item with
+embeddings but no sentiment is not re-embedded. sentiment_source records which
+engine produced each score.
+
+Both engines see normalized text (see "Pre-embedding normalization" below),
+one call per distinct text; bench_normalization.py measures the savings.
+"""
+import os
+import time
+
+from google.cloud import bigquery
+
+from sentiment import score_texts
+
+SENTIMENT_ENGINES = ('remote', 'local', 'auto')
+SENTIMENT_ENGINE = os.environ.get('SENTIMENT_ENGINE', 'remote')
+REMOTE_SENTIMENT_SOURCE = 'understand_text'
+LOCAL_SENTIMENT_SOURCE = 'local_lexicon'
+# Items scored locally per MERGE (passed as one query parameter); the rest
+# stay without sentiment and are picked up by the next delivery
+LOCAL_SENTIMENT_MAX_ROWS = int(os.environ.get('LOCAL_SENTIMENT_MAX_ROWS', '50000'))
+
+EMBEDDINGS_CACHE_TABLE = 'social-listening-sense.social_listening_data.embeddings_cache'
+CONTENT_VIEW = 'social-listening-sense.social_listening_data.unified_social_content_items'
+
+# --- Pre-embedding normalization ---
+# Texts are cleaned in BigQuery before any model call: quoted parents, code
+# blocks, URLs, markdown and HTML entities are stripped, whitespace collapsed,
+# then the text is cut at a word boundary to the token budget (estimated at
+# CHARS_PER_TOKEN). Placeholders are dropped; texts under MIN_EMBEDDING_WORDS
+# still get sentiment but are not embedded. Identical normalized texts
+# (FARM_FINGERPRINT, stored as normalized_text_hash) are sent once per MERGE.
+EMBEDDING_TOKEN_BUDGET = int(os.environ.get('EMBEDDING_TOKEN_BUDGET', '512'))
+CHARS_PER_TOKEN = 4
+MIN_EMBEDDING_WORDS = int(os.environ.get('MIN_EMBEDDING_WORDS', '3'))
+PLACEHOLDER_TEXTS = ('[deleted]', '[removed]', '[deleted by user]', '[removed by reddit]', 'deleted', 'removed')
+
+# (RE2 pattern, replacement), applied in order
+NORMALIZATION_RULES = (
+    (r'(?m)^[ \t]*(?:>|&gt;).*$', ''),            # quoted parent lines
+    (r'(?s)```.*?```', ' '),                       # fenced code blocks
+    (r'!?\[([^\]]*)\]\([^)]*\)', r'\1'),           # markdown links and images -> link text
+    (r'(?i)(?:https?://|www\.)\S+', ' '),          # bare URLs
+    (r'&(?:amp;)?(?:#x200[Bb]|nbsp);', ' '),       # zero-width spaces and nbsp entities
+    (r'&amp;', '&'),
+    (r'&lt;', '<'),
+    (r'&gt;', '>'),
+    (r'[*_~`#|^]+', ' '),                          # emphasis, headers, tables, superscript
+    (r'\s+', ' '),
+)
+
+
+def normalized_text_sql(column):
+    """SQL expression applying NORMALIZATION_RULES to column, trimmed (not yet truncated)."""
+    expr = column
+    for pattern, replacement in NORMALIZATION_RULES:
+        expr = f"REGEXP_REPLACE({expr}, r'{pattern}', r'{replacement}')"
+    return f"TRIM({expr})"
+
+
+def normalized_items_sql(columns, source, where):
+    """
+    Wraps source rows in the normalization stage.
+
+    Args:
+        columns: Extra columns to carry through (comma-separated SQL).
+        source: FROM clause; must expose primary_text.
+        where: WHERE clause over the source rows.
+
+    Returns:
+        SQL yielding the carried columns plus content (normalized, truncated),
+        normalized_text_hash and embeddable, without placeholder or empty texts.
+    """
+    max_chars = EMBEDDING_TOKEN_BUDGET * CHARS_PER_TOKEN
+    placeholders = ', '.join(f"'{text}'" for text in PLACEHOLDER_TEXTS)
+    return f"""
+              SELECT *, FARM_FINGERPRINT(content) AS normalized_text_hash, ARRAY_LENGTH(SPLIT(content, ' ')) >= {MIN_EMBEDDING_WORDS} AS embeddable
+              FROM (
+                SELECT * EXCEPT (normalized),
+                  IF(LENGTH(normalized) > {max_chars}, REGEXP_REPLACE(LEFT(normalized, {max_chars}), r'\\s+\\S*$', ''), normalized) AS content
+                FROM (
+                  SELECT {columns}, {normalized_text_sql('primary_text')} AS normalized
+                  FROM {source}
+                  WHERE {where}
+                )
+              )
+              WHERE LENGTH(content) > 0 AND LOWER(content) NOT IN ({placeholders})"""
+
+
+# Items in the delivery window still missing embeddings or sentiment
+PENDING_ITEMS_SQL = f"""(
+                  SELECT
+                    v.content_item_id,
+                    v.primary_text,
+                    ec.embeddings IS NULL OR ARRAY_LENGTH(ec.embeddings) = 0 AS needs_embedding,
+                    ec.sentiment_score IS NULL AS needs_sentiment
+                  FROM `{CONTENT_VIEW}` AS v
+                  LEFT JOIN `{EMBEDDINGS_CACHE_TABLE}` AS ec
+                  ON v.content_item_id = ec.unified_id
+                  WHERE
+                    v.record_load_timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 2 DAY)
+                    AND (ec.unified_id IS NULL OR ec.sentiment_score IS NULL OR ec.embeddings IS NULL OR ARRAY_LENGTH(ec.embeddings) = 0)
+                )"""
+
+SOURCE_DATA_SQL = f"""
+            SELECT *
+            FROM ({normalized_items_sql('content_item_id, needs_embedding, needs_sentiment', PENDING_ITEMS_SQL, 'primary_text IS NOT NULL')})
+            WHERE (needs_embedding AND embeddable) OR needs_sentiment
+"""
+
+REMOTE_SENTIMENT_SQL = """
+            SELECT
+              sd.content_item_id,
+              CAST(JSON_VALUE(understand_results.ml_understand_text_result, '$.document_sentiment.score') AS FLOAT64) AS sentiment_score,
+              CAST(JSON_VALUE(understand_results.ml_understand_text_result, '$.document_sentiment.magnitude') AS FLOAT64) AS sentiment_magnitude,
+              understand_results.ml_understand_text_status AS sentiment_status
+            FROM ML.UNDERSTAND_TEXT(
+              MODEL `social-listening-sense.social_listening_data.sentiment_analysis_model`,
+              (SELECT normalized_text_hash, ANY_VALUE(content) AS text_content FROM SourceData WHERE needs_sentiment GROUP BY normalized_text_hash),
+              STRUCT('analyze_sentiment' AS nlu_option)
+            ) AS understand_results
+            JOIN SourceData AS sd
+            ON sd.normalized_text_hash = understand_results.normalized_text_hash AND sd.needs_sentiment
+"""
+
+LOCAL_SENTIMENT_SQL = """
+            SELECT item.content_item_id, item.sentiment_score, item.sentiment_magnitude, '' AS sentiment_status
+            FROM UNNEST(@local_sentiment) AS item
+"""
+
+LOCAL_SENTIMENT_TYPE = bigquery.StructQueryParameterType(
+    bigquery.ScalarQueryParameterType('STRING', name='content_item_id'),
+    bigquery.ScalarQueryParameterType('FLOAT64', name='sentiment_score'),
+    bigquery.ScalarQueryParameterType('FLOAT64', name='sentiment_magnitude'),
+)
+
+MERGE_SQL_TEMPLATE = """
+        MERGE INTO `{embeddings_cache}` AS T
+        USING (
+          WITH SourceData AS ({source_data}
+          ),
+          -- One embedding per distinct normalized text, shared by its items below
+          EmbeddingResults AS (
+            SELECT generated.normalized_text_hash, generated.ml_generate_embedding_result AS embeddings_array, generated.ml_generate_embedding_status AS embedding_status
+            FROM ML.GENERATE_EMBEDDING(
+              MODEL `social-listening-sense.social_listening_data.social_media_embedding_model`,
+              (SELECT normalized_text_hash, ANY_VALUE(content) AS content FROM SourceData WHERE needs_embedding AND embeddable GROUP BY normalized_text_hash),
+              STRUCT(TRUE AS flatten_json_output, 'CLUSTERING' as task_type)
+            ) AS generated
+          ),
+          -- Per-vector scaled int8 copy (see kmeans-performer/embedding_codec.py):
+          -- codes are stored as two's-complement bytes, value = code * scale
+          QuantizedResults AS (
+            SELECT
+              normalized_text_hash,
+              embeddings_array,
+              embedding_status,
+              int8_scale AS embeddings_int8_scale,
+              IF(ARRAY_LENGTH(embeddings_array) > 0, CODE_POINTS_TO_BYTES(ARRAY(
+                SELECT MOD(CAST(ROUND(IFNULL(SAFE_DIVIDE(x, int8_scale), 0)) AS INT64) + 256, 256)
+                FROM UNNEST(embeddings_array) AS x WITH OFFSET AS i
+                ORDER BY i
+              )), NULL) AS embeddings_int8
+            FROM (
+              SELECT *, (SELECT MAX(ABS(x)) FROM UNNEST(embeddings_array) AS x) / 127 AS int8_scale
+              FROM EmbeddingResults
+            )
+          ),
+          ItemEmbeddings AS (
+            SELECT sd.content_item_id, q.* EXCEPT (normalized_text_hash)
+            FROM QuantizedResults AS q
+            JOIN SourceData AS sd
+            ON sd.normalized_text_hash = q.normalized_text_hash AND sd.needs_embedding AND sd.embeddable
+          ),
+          SentimentResults AS ({sentiment_results}
+          )
+          SELECT
+            COALESCE(er.content_item_id, sr.content_item_id) AS unified_id,
+            er.embeddings_array AS embeddings,
+            er.embeddings_int8,
+            er.embeddings_int8_scale,
+            CURRENT_TIMESTAMP() AS embedding_generated_at,
+            'text-embedding-004' AS embedding_model_name,
+            'CLUSTERING' AS embedding_task_type,
+            -- A failed sentiment call leaves the score NULL for a later pass
+            IF(LENGTH(COALESCE(sr.sentiment_status, '')) = 0, sr.sentiment_score, NULL) AS sentiment_score,
+            IF(LENGTH(COALESCE(sr.sentiment_status, '')) = 0, sr.sentiment_magnitude, NULL) AS sentiment_magnitude,
+            @sentiment_source AS sentiment_source,
+            sd.normalized_text_hash,
+            er.embedding_status,
+            sr.sentiment_status
+          FROM ItemEmbeddings AS er
+          FULL OUTER JOIN SentimentResults AS sr
+          ON er.content_item_id = sr.content_item_id
+          JOIN SourceData AS sd
+          ON sd.content_item_id = COALESCE(er.content_item_id, sr.content_item_id)
+          WHERE
+            (LENGTH(COALESCE(er.embedding_status, '')) = 0 OR er.content_item_id IS NULL)
+            AND (@keep_failed_sentiment OR LENGTH(COALESCE(sr.sentiment_status, '')) = 0 OR sr.content_item_id IS NULL)
+            AND (er.content_item_id IS NOT NULL OR sr.content_item_id IS NOT NULL)
+        ) AS S
+        ON T.unified_id = S.unified_id
+        WHEN NOT MATCHED THEN
+          INSERT (unified_id, embeddings, embeddings_int8, embeddings_int8_scale, embedding_model_name, embedding_task_type, embedding_generated_at, sentiment_score, sentiment_magnitude, sentiment_source, normalized_text_hash)
+          VALUES (S.unified_id, S.embeddings, S.embeddings_int8, S.embeddings_int8_scale, S.embedding_model_name, S.embedding_task_type, S.embedding_generated_at, S.sentiment_score, S.sentiment_magnitude, IF(S.sentiment_score IS NULL, NULL, S.sentiment_source), S.normalized_text_hash)
+        WHEN MATCHED THEN
+          UPDATE SET
+            T.embeddings = COALESCE(T.embeddings, S.embeddings),
+            -- Keep the int8 copy in step with whichever embeddings are kept
+            T.embeddings_int8 = IF(T.embeddings IS NULL, S.embeddings_int8, T.embeddings_int8),
+            T.embeddings_int8_scale = IF(T.embeddings IS NULL, S.embeddings_int8_scale, T.embeddings_int8_scale),
+            T.embedding_model_name = COALESCE(T.embedding_model_name, S.embedding_model_name),
+            T.embedding_task_type = COALESCE(T.embedding_task_type, S.embedding_task_type),
+            T.embedding_generated_at = COALESCE(T.embedding_generated_at, S.embedding_generated_at),
+            T.sentiment_score = COALESCE(T.sentiment_score, S.sentiment_score),
+            T.sentiment_magnitude = COALESCE(T.sentiment_magnitude, S.sentiment_magnitude),
+            T.sentiment_source = IF(T.sentiment_score IS NULL AND S.sentiment_score IS NOT NULL, S.sentiment_source, T.sentiment_source),
+            T.normalized_text_hash = COALESCE(T.normalized_text_hash, S.normalized_text_hash)
+"""
+
+
+def build_merge_sql(engine):
+    """Returns the enrichment MERGE with ML.UNDERSTAND_TEXT ('remote') or @local_sentiment ('local') sentiment."""
+    return MERGE_SQL_TEMPLATE.format(
+        embeddings_cache=EMBEDDINGS_CACHE_TABLE,
+        source_data=SOURCE_DATA_SQL,
+        sentiment_results=REMOTE_SENTIMENT_SQL if engine == 'remote' else LOCAL_SENTIMENT_SQL,
+    )
+
+
+def _run_remote_merge(bq_client, keep_failed_sentiment):
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('sentiment_source', 'STRING', REMOTE_SENTIMENT_SOURCE),
+        bigquery.ScalarQueryParameter('keep_failed_sentiment', 'BOOL', keep_failed_sentiment),
+    ])
+    bq_client.query(build_merge_sql('remote'), job_config=job_config).result()
+
+
+def _run_local_merge(bq_client, skip_if_none=False):
+    """
+    Scores the items still missing sentiment in-process and MERGEs them;
+    returns how many were scored. With skip_if_none, no MERGE is run when
+    nothing needs scoring (embeddings were already handled by a remote pass).
+    """
+    start = time.monotonic()
+    candidates = list(bq_client.query(f"""
+        SELECT content_item_id, content
+        FROM ({SOURCE_DATA_SQL})
+        WHERE needs_sentiment
+        LIMIT {LOCAL_SENTIMENT_MAX_ROWS}
+    """).result())
+    # Score each distinct normalized text once
+    texts = list(dict.fromkeys(row.content for row in candidates))
+    text_scores = dict(zip(texts, zip(*score_texts(texts)))) if texts else {}
+    scores = [text_scores[row.content][0] for row in candidates]
+    magnitudes = [text_scores[row.content][1] for row in candidates]
+    elapsed = time.monotonic() - start
+    print(f"Scored {len(candidates)} items locally in {elapsed:.2f}s (including the candidate query)")
+    if skip_if_none and not candidates:
+        return 0
+
+    local_sentiment = [
+        bigquery.StructQueryParameter(
+            None,
+            bigquery.ScalarQueryParameter('content_item_id', 'STRING', row.content_item_id),
+            bigquery.ScalarQueryParameter('sentiment_score', 'FLOAT64', score),
+            bigquery.ScalarQueryParameter('sentiment_magnitude', 'FLOAT64', magnitude),
+        )
+        for row, score, magnitude in zip(candidates, scores, magnitudes)
+    ]
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter('local_sentiment', LOCAL_SENTIMENT_TYPE, local_sentiment),
+        bigquery.ScalarQueryParameter('sentiment_source', 'STRING', LOCAL_SENTIMENT_SOURCE),
+        bigquery.ScalarQueryParameter('keep_failed_sentiment', 'BOOL', False),
+    ])
+    bq_client.query(build_merge_sql('local'), job_config=job_config).result()
+    return len(candidates)
+
+
+def run_enrichment_merge(bq_client, engine=None):
+    """
+    Runs the embeddings_cache enrichment MERGE with the given sentiment engine
+    (default SENTIMENT_ENGINE). Errors are printed, not raised.
+
+    Returns:
+        Dict with 'succeeded', the 'engine' requested, 'fallback' (why local
+        scoring was used in auto mode, or None) and 'locally_scored'.
+    """
+    engine = engine or SENTIMENT_ENGINE
+    if engine not in SENTIMENT_ENGINES:
+        print(f"Unknown sentiment engine '{engine}', using 'remote'")
+        engine = 'remote'
+    result = {'succeeded': False, 'engine': engine, 'fallback': None, 'locally_scored': 0}
+
+    print(f"Running embeddings_cache MERGE job (sentiment engine: {engine})...")
+    try:
+        if engine == 'local':
+            result['locally_scored'] = _run_local_merge(bq_client)
+        elif engine == 'remote':
+            _run_remote_merge(bq_client, keep_failed_sentiment=False)
+        else:
+            try:
+                _run_remote_merge(bq_client, keep_failed_sentiment=True)
+                result['fallback'] = 'failed_items'
+            except Exception as e:
+                print(f"Remote sentiment MERGE failed, falling back to local scoring: {e}")
+                result['fallback'] = 'remote_error'
+            # Items whose sentiment call failed or was throttled (or all, after an error)
+            result['locally_scored'] = _run_local_merge(
+                bq_client, skip_if_none=result['fallback'] == 'failed_items')
+            if result['fallback'] == 'failed_items' and not result['locally_scored']:
+                result['fallback'] = None
+        print("MERGE job for embeddings_cache completed successfully.")
+        result['succeeded'] = True
+    except Exception as e:
+        print(f"Error running embeddings_cache MERGE job: {e}")
+    return result
@@ -0,0 +1,48 @@
+"""
+Post-delivery notifications to downstream functions.
+
+After the embeddings_cache MERGE adds new items, the deliverer pings the
+functions that keep derived state in sync with it. Each hook is enabled by
+setting its URL environment variable and is best-effort: a failed or slow
+call is logged and never fails the delivery.
+"""
+import os
+
+import requests
+
+# similarity-index function; receives {"action": "refresh"}
+SIMILARITY_INDEX_URL = os.environ.get('SIMILARITY_INDEX_URL')
+# kmeans-performer function and the run whose topics new items are assigned to
+# (comma-separated for several runs); receives {"mode": "assign"}
+TOPIC_ASSIGN_URL = os.environ.get('TOPIC_ASSIGN_URL')
+TOPIC_ASSIGN_RUN_IDS = [r.strip() for r in os.environ.get('TOPIC_ASSIGN_RUN_ID', '').split(',') if r.strip()]
+
+# The downstream work can outlast the deliverer's patience; the call is
+# fire-and-forget, so a read timeout is expected and ignored.
+HOOK_TIMEOUT = (5, 10)
+
+
+def _post(name, url, payload):
+    try:
+        response = requests.post(url, json=payload, timeout=HOOK_TIMEOUT)
+        print(f"{name} hook returned {response.status_code}")
+    except requests.exceptions.ReadTimeout:
+        print(f"{name} hook accepted; not waiting for it to finish")
+    except requests.exceptions.RequestException as e:
+        print(f"{name} hook failed: {e}")
+
+
+def notify_embeddings_updated(bigquery_dataset_id):
+    """Notifies downstream functions (similarity index, topic assignment) that embeddings_cache received new items."""
+    if SIMILARITY_INDEX_URL:
+        _post('Similarity index', SIMILARITY_INDEX_URL, {
+            'action': 'refresh',
+            'bigquery_dataset_id': bigquery_dataset_id,
+        })
+    if TOPIC_ASSIGN_URL:
+        for run_id in TOPIC_ASSIGN_RUN_IDS:
+            _post(f"Topic assignment ({run_id})", TOPIC_ASSIGN_URL, {
+                'mode': 'assign',
+                'run_id': run_id,
+                'since_hours': 48,
+            })
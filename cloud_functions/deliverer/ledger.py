@@ -0,0 +1,176 @@
+"""
+Idempotent delivery ledger for the deliverer functions.
+
+GCS finalize events and Pub/Sub messages are delivered at least once. Before a
+snapshot is processed, the deliverer claims it by creating a small marker object
+with if_generation_match=0, which GCS guarantees only one caller can win. The
+marker's metadata records the processing status, so a redelivered event is
+rejected with a single metadata lookup. Completed deliveries are also appended
+to the delivery_ledger BigQuery table with row counts and timings.
+
+Only a completed delivery is skipped. An event that finds the delivery being
+processed elsewhere, or that fails to insert it, raises DeliveryRetry so that
+Pub/Sub or Eventarc redeliver it (deploy the deliverers with retries enabled);
+the claiming invocation may still crash before it finishes.
+"""
+import datetime
+import json
+import os
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+LEDGER_BUCKET = os.environ.get('DELIVERY_LEDGER_BUCKET', 'brightdata-social-raw')
+LEDGER_PREFIX = os.environ.get('DELIVERY_LEDGER_PREFIX', '_ledger').strip('/')
+LEDGER_TABLE_ID = os.environ.get('DELIVERY_LEDGER_TABLE_ID', 'delivery_ledger')
+
+# A claim still marked 'processing' after this long is assumed to belong to a
+# crashed instance and may be taken over.
+STALE_CLAIM_SECONDS = int(os.environ.get('DELIVERY_LEDGER_STALE_SECONDS', '900'))
+
+# Keys this instance has seen completed; lets warm instances skip the GCS lookup.
+_completed_keys = set()
+
+
+class DeliveryRetry(Exception):
+    """Raised to fail the invocation so the event is redelivered and retried."""
+
+
+def delivery_key(snapshot_id, generation=None):
+    """Builds the ledger key: the snapshot ID, plus the object generation for GCS deliveries."""
+    if generation:
+        return f"{snapshot_id}@{generation}"
+    return snapshot_id
+
+
+def is_ledger_object(object_name):
+    """Returns True if the GCS object is a ledger marker."""
+    return object_name.startswith(f"{LEDGER_PREFIX}/")
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _marker_blob(storage_client, key):
+    return storage_client.bucket(LEDGER_BUCKET).blob(f"{LEDGER_PREFIX}/{key}")
+
+
+def claim_delivery(storage_client, key):
+    """
+    Claims a delivery for processing.
+
+    Args:
+        storage_client: GCS client.
+        key: Ledger key from delivery_key().
+
+    Returns:
+        True if this invocation should process the delivery, False if it was
+        already processed.
+
+    Raises:
+        DeliveryRetry: Another invocation holds a claim younger than
+            STALE_CLAIM_SECONDS; the redelivered event checks again.
+    """
+    if key in _completed_keys:
+        print(f"Delivery {key} already processed (instance cache); skipping.")
+        return False
+
+    blob = _marker_blob(storage_client, key)
+    blob.metadata = {'status': 'processing', 'claimed_at': _utcnow().isoformat()}
+    try:
+        blob.upload_from_string(b'', if_generation_match=0)
+        return True
+    except PreconditionFailed:
+        pass
+
+    existing = storage_client.bucket(LEDGER_BUCKET).get_blob(blob.name)
+    if existing is None:
+        # Released between our attempt and the lookup; try once more.
+        try:
+            blob.upload_from_string(b'', if_generation_match=0)
+            return True
+        except PreconditionFailed:
+            raise DeliveryRetry(f"Delivery {key} was claimed by another invocation")
+
+    metadata = existing.metadata or {}
+    if metadata.get('status') == 'completed':
+        _completed_keys.add(key)
+        print(f"Delivery {key} already processed at {metadata.get('finished_at')}; skipping.")
+        return False
+
+    claimed_at = metadata.get('claimed_at')
+    age = None
+    if claimed_at:
+        age = (_utcnow() - datetime.datetime.fromisoformat(claimed_at)).total_seconds()
+    if age is not None and age < STALE_CLAIM_SECONDS:
+        raise DeliveryRetry(f"Delivery {key} is being processed by another invocation "
+                            f"(claimed {int(age)}s ago); retrying later")
+
+    # Stale claim: take it over, guarded by the metageneration we just read.
+    existing.metadata = {'status': 'processing', 'claimed_at': _utcnow().isoformat()}
+    try:
+        existing.patch(if_metageneration_match=existing.metageneration)
+        print(f"Took over stale claim for delivery {key}.")
+        return True
+    except PreconditionFailed:
+        raise DeliveryRetry(f"Stale claim for delivery {key} was taken over by another invocation")
+
+
+def release_delivery(storage_client, key):
+    """Removes the claim after a failed delivery so a later event can retry it."""
+    try:
+        _marker_blob(storage_client, key).delete()
+    except NotFound:
+        pass
+    except Exception as e:
+        print(f"Warning: could not release ledger claim for {key}: {e}")
+
+
+def complete_delivery(storage_client, bq_client, bigquery_dataset_id, key, record):
+    """
+    Marks a delivery as completed and appends it to the delivery_ledger table.
+
+    Args:
+        storage_client: GCS client.
+        bq_client: BigQuery client.
+        bigquery_dataset_id: BigQuery dataset holding the ledger table.
+        key: Ledger key from delivery_key().
+        record: Dict with snapshot_id, object_generation, dataset_id, trigger,
+            ingestion_mode, row_count, started_at (datetime) and timings_ms.
+    """
+    finished_at = _utcnow()
+    _completed_keys.add(key)
+
+    blob = _marker_blob(storage_client, key)
+    blob.metadata = {
+        'status': 'completed',
+        'finished_at': finished_at.isoformat(),
+        'row_count': str(record.get('row_count')),
+    }
+    try:
+        blob.patch()
+    except Exception as e:
+        print(f"Warning: could not mark delivery {key} as completed: {e}")
+
+    started_at = record['started_at']
+    row = {
+        'delivery_key': key,
+        'snapshot_id': record.get('snapshot_id'),
+        'object_generation': record.get('object_generation'),
+        'dataset_id': record.get('dataset_id'),
+        'trigger': record.get('trigger'),
+        'ingestion_mode': record.get('ingestion_mode'),
+        'status': record.get('status', 'completed'),
+        'row_count': record.get('row_count'),
+        'started_at': started_at.isoformat(),
+        'finished_at': finished_at.isoformat(),
+        'duration_ms': int((finished_at - started_at).total_seconds() * 1000),
+        'timings_ms': json.dumps(record.get('timings_ms') or {}),
+    }
+    try:
+        table_ref = bq_client.dataset(bigquery_dataset_id).table(LEDGER_TABLE_ID)
+        errors = bq_client.insert_rows_json(table_ref, [row])
+        if errors:
+            print(f"Delivery ledger insertion had errors: {errors}")
+    except Exception as e:
+        print(f"Warning: could not record delivery {key} in ledger table: {e}")
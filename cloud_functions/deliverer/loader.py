@@ -0,0 +1,133 @@
+"""
+Load-job ingestion helpers for the deliverer.
+
+Instead of streaming each post with insert_rows_json, the transformed snapshot
+is written as newline-delimited JSON to a staging prefix in the delivery bucket
+and then loaded into BigQuery with a single load job. Load jobs are free of the
+streaming insert cost and quotas, and because the job ID is derived from the
+snapshot ID(s), BigQuery refuses to run the same load twice.
+"""
+import hashlib
+import itertools
+import json
+import os
+
+from google.api_core.exceptions import Conflict, GoogleAPICallError
+from google.cloud import bigquery
+
+# Prefix (inside the delivery bucket) where staged NDJSON files are written.
+# The GCS-triggered deliverer ignores objects under this prefix.
+STAGING_PREFIX = os.environ.get('STAGING_PREFIX', '_staging').strip('/')
+
+
+def is_staging_object(object_name):
+    """Returns True if the GCS object was written by the load-job mode itself."""
+    return object_name.startswith(f"{STAGING_PREFIX}/")
+
+
+def staging_object_name(dataset_id, snapshot_id):
+    """Returns the staging object name for a snapshot."""
+    return f"{STAGING_PREFIX}/{dataset_id}/{snapshot_id}.ndjson"
+
+
+def write_staging_file(storage_client, bucket_name, dataset_id, snapshot_id, rows):
+    """
+    Writes the transformed rows of one snapshot as NDJSON to the staging prefix.
+
+    Args:
+        storage_client: GCS client.
+        bucket_name: Bucket to stage into (normally the delivery bucket).
+        dataset_id: Bright Data dataset ID, used as a sub-directory.
+        snapshot_id: Bright Data snapshot ID.
+        rows: List of row dicts matching the destination table schema.
+
+    Returns:
+        The gs:// URI of the staged file.
+    """
+    object_name = staging_object_name(dataset_id, snapshot_id)
+    payload = "\n".join(json.dumps(row, separators=(',', ':')) for row in rows)
+    blob = storage_client.bucket(bucket_name).blob(object_name)
+    blob.upload_from_string(payload, content_type='application/x-ndjson')
+    print(f"Staged {len(rows)} rows to gs://{bucket_name}/{object_name}")
+    return f"gs://{bucket_name}/{object_name}"
+
+
+def delete_staging_files(storage_client, source_uris):
+    """Deletes staged files after a successful load. Errors are logged, not raised."""
+    for uri in source_uris:
+        try:
+            bucket_name, object_name = uri[len("gs://"):].split('/', 1)
+            storage_client.bucket(bucket_name).blob(object_name).delete()
+        except Exception as e:
+            print(f"Warning: could not delete staged file {uri}: {e}")
+
+
+def load_job_id(table_id, snapshot_ids, attempt=0, salt=None):
+    """
+    Builds a deterministic load job ID for a set of snapshots.
+
+    The same snapshots always map to the same job ID, so a redelivered event
+    cannot load the same data twice. A salt gives a deliberate reload (e.g. a
+    forced backfill) its own job IDs.
+    """
+    key = "\n".join(sorted(snapshot_ids))
+    if salt:
+        key = f"{key}\n{salt}"
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+    job_id = f"deliverer_load_{table_id}_{digest}"
+    if attempt:
+        job_id = f"{job_id}_retry{attempt}"
+    return job_id
+
+
+def load_staged_files(bq_client, table_ref, source_uris, snapshot_ids, salt=None):
+    """
+    Submits one BigQuery load job for the staged files and waits for it.
+
+    Args:
+        bq_client: BigQuery client.
+        table_ref: Destination TableReference (reddit_data or quora_data).
+        source_uris: gs:// URIs of staged NDJSON files.
+        snapshot_ids: Snapshot IDs contained in the staged files.
+        salt: Optional salt for the job ID (see load_job_id).
+
+    Returns:
+        Tuple of (load job, loaded) where loaded is False when an earlier job
+        with the same ID had already loaded these snapshots.
+
+    Failed earlier jobs are skipped by moving on to the next retry ID
+    (_retry1, _retry2, ...), with no upper bound, so a snapshot whose loads
+    kept failing can still be loaded once the cause is fixed.
+    """
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        create_disposition=bigquery.CreateDisposition.CREATE_NEVER,
+    )
+
+    for attempt in itertools.count():
+        job_id = load_job_id(table_ref.table_id, snapshot_ids, attempt, salt)
+        try:
+            load_job = bq_client.load_table_from_uri(
+                source_uris, table_ref, job_id=job_id, job_config=job_config
+            )
+        except Conflict:
+            # A job with this ID already exists: either it loaded these
+            # snapshots already, or it failed and we retry under a new ID.
+            previous_job = bq_client.get_job(job_id)
+            if previous_job.state != 'DONE':
+                try:
+                    previous_job.result()
+                except GoogleAPICallError:
+                    # Still running when fetched and failed since; error_result says so
+                    pass
+            if previous_job.error_result is None:
+                print(f"Load job {job_id} already completed; skipping duplicate load.")
+                return previous_job, False
+            print(f"Previous load job {job_id} failed ({previous_job.error_result}); retrying.")
+            continue
+
+        print(f"Submitted load job {job_id} for {len(source_uris)} file(s) into {table_ref.table_id}")
+        load_job.result()
+        print(f"Load job {job_id} completed: {load_job.output_rows} rows loaded.")
+        return load_job, True
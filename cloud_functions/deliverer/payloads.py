@@ -0,0 +1,131 @@
+"""
+Decoding of Pub/Sub delivery payloads.
+
+Besides the original plain base64 JSON body, the Pub/Sub deliverer accepts:
+
+* Compressed bodies: set the message attribute content_encoding to 'gzip' or
+  'zstd' and publish the compressed JSON bytes.
+* Pointer messages: set the attribute gcs_uri to gs://bucket/object and leave
+  the body empty. The object is streamed from GCS and decompressed on the fly
+  (content_encoding applies to the object, defaulting to its file extension).
+  Objects ending in .ndjson/.jsonl are parsed line by line.
+
+Pointer messages let snapshots larger than the 10 MB Pub/Sub limit flow through
+the same topic.
+"""
+import base64
+import gzip
+import io
+import json
+
+try:
+    import zstandard
+except ImportError:  # zstd bodies are rejected with a clear error instead
+    zstandard = None
+
+SUPPORTED_ENCODINGS = ('identity', 'gzip', 'zstd')
+
+_EXTENSION_ENCODINGS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+}
+
+
+def _get_encoding(attributes, object_name=None):
+    encoding = (attributes.get('content_encoding') or attributes.get('content-encoding') or '').lower()
+    if not encoding and object_name:
+        for extension, extension_encoding in _EXTENSION_ENCODINGS.items():
+            if object_name.endswith(extension):
+                encoding = extension_encoding
+                break
+    encoding = encoding or 'identity'
+    if encoding not in SUPPORTED_ENCODINGS:
+        raise ValueError(f"Unsupported content_encoding '{encoding}'. Expected one of {SUPPORTED_ENCODINGS}")
+    if encoding == 'zstd' and zstandard is None:
+        raise ValueError("content_encoding 'zstd' requires the zstandard package")
+    return encoding
+
+
+def decompress_bytes(data, encoding):
+    """Decompresses a message body according to its content encoding."""
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'zstd':
+        # max_output_size is needed when the frame does not record its content size
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=2**31)
+    return data
+
+
+def open_decompressed_stream(raw_stream, encoding):
+    """Wraps a binary stream so reads return decompressed bytes."""
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=raw_stream, mode='rb')
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(raw_stream)
+    return raw_stream
+
+
+def _strip_compression_extension(object_name):
+    for extension in _EXTENSION_ENCODINGS:
+        if object_name.endswith(extension):
+            return object_name[:-len(extension)]
+    return object_name
+
+
+def read_gcs_posts(storage_client, gcs_uri, encoding):
+    """
+    Streams a snapshot object from GCS and parses its posts.
+
+    Args:
+        storage_client: GCS client.
+        gcs_uri: gs://bucket/object of the snapshot.
+        encoding: Content encoding of the object.
+
+    Returns:
+        List of post dicts.
+    """
+    if not gcs_uri.startswith('gs://'):
+        raise ValueError(f"gcs_uri must start with gs://, got '{gcs_uri}'")
+    bucket_name, object_name = gcs_uri[len('gs://'):].split('/', 1)
+    blob = storage_client.bucket(bucket_name).blob(object_name)
+    line_delimited = _strip_compression_extension(object_name).endswith(('.ndjson', '.jsonl'))
+
+    with blob.open('rb', chunk_size=8 * 1024 * 1024) as raw_stream:
+        stream = open_decompressed_stream(raw_stream, encoding)
+        if line_delimited:
+            text_stream = io.TextIOWrapper(stream, encoding='utf-8')
+            return [json.loads(line) for line in text_stream if line.strip()]
+        return json.load(stream)
+
+
+def read_message_posts(message_data, attributes, storage_client=None):
+    """
+    Returns the list of posts carried by a Pub/Sub message.
+
+    Args:
+        message_data: Base64-encoded message body (may be empty for pointer messages).
+        attributes: Message attributes.
+        storage_client: GCS client, required for pointer messages.
+
+    Raises:
+        ValueError: If the payload cannot be decoded or is not a list of posts.
+    """
+    gcs_uri = attributes.get('gcs_uri')
+    if gcs_uri:
+        if storage_client is None:
+            raise ValueError("A GCS client is required for pointer messages")
+        encoding = _get_encoding(attributes, gcs_uri)
+        print(f"Reading pointer payload {gcs_uri} (encoding={encoding})")
+        posts = read_gcs_posts(storage_client, gcs_uri, encoding)
+    else:
+        encoding = _get_encoding(attributes)
+        body = base64.b64decode(message_data or b'')
+        if encoding != 'identity':
+            compressed_size = len(body)
+            body = decompress_bytes(body, encoding)
+            print(f"Decompressed {encoding} body: {compressed_size} -> {len(body)} bytes")
+        posts = json.loads(body)
+
+    if not isinstance(posts, list):
+        raise ValueError("Decoded data is not a list.")
+    return posts
@@ -0,0 +1,231 @@
+"""
+In-process, lexicon- and rule-based sentiment scoring (VADER-style).
+
+Produces sentiment_score in [-1, 1] and a non-negative sentiment_magnitude,
+on the same scales as the Natural Language API's document sentiment that
+ML.UNDERSTAND_TEXT returns, so either source can fill embeddings_cache:
+
+- every lexicon word has a valence in [-4, 4];
+- a negator ("not", "never", "n't", ...) within the three preceding words
+  flips and dampens it (x -0.74);
+- a booster or dampener ("very", "slightly", ...) in the preceding words
+  moves it away from or towards zero;
+- an ALL-CAPS word in otherwise mixed-case text is emphasized;
+- in texts with "but", words before it count half and words after it 1.5x;
+- each "!" (up to four) strengthens the total;
+- score = total / sqrt(total^2 + 15) (VADER's normalization), and
+  magnitude = sum of absolute valences / 4, so one strongly emotional word
+  contributes about 1, like one strongly emotional sentence does in the API.
+
+Texts are scored in batches: the tokens of the whole batch are mapped to
+lexicon ids, the rules are applied with shifted numpy arrays, and the results
+are summed per text with np.bincount, so apart from tokenization and a
+memoized id lookup there is no per-word Python work.
+
+The built-in lexicon covers common English review and discussion vocabulary.
+SENTIMENT_LEXICON_PATH can point at a VADER-format lexicon file
+(token<TAB>mean valence<TAB>...) to replace it.
+"""
+import os
+import re
+
+import numpy as np
+
+NEGATION_SCALAR = -0.74
+BOOSTER_INCREMENT = 0.293
+CAPS_INCREMENT = 0.733
+EXCLAMATION_INCREMENT = 0.292
+MAX_EXCLAMATIONS = 4
+BUT_BEFORE_WEIGHT = 0.5
+BUT_AFTER_WEIGHT = 1.5
+NORMALIZATION_ALPHA = 15
+MAGNITUDE_DIVISOR = 4.0
+# Distinct raw words memoized by a scorer before its cache is reset
+MAX_CACHED_WORDS = 500_000
+# Decay of a booster's effect with its distance from the word it modifies
+BOOSTER_DISTANCE_WEIGHTS = (1.0, 0.95, 0.9)
+
+_TOKEN_RE = re.compile(r"[A-Za-z]+(?:'[A-Za-z]+)?")
+
+NEGATORS = frozenset("""
+not no never none nobody nothing neither nor nowhere cannot without
+isn't aren't wasn't weren't don't doesn't didn't won't wouldn't can't couldn't
+shouldn't hasn't haven't hadn't ain't mustn't
+""".split())
+
+BOOSTERS = {
+    **{word: BOOSTER_INCREMENT for word in """
+    absolutely amazingly completely deeply enormously entirely especially exceptionally extremely
+    fully greatly highly hugely incredibly intensely particularly purely quite really remarkably
+    so substantially super thoroughly totally tremendously truly utterly very
+    """.split()},
+    **{word: -BOOSTER_INCREMENT for word in """
+    almost barely hardly kinda marginally occasionally partly scarcely slightly somewhat sorta
+    """.split()},
+}
+
+DEFAULT_LEXICON = {
+    # Positive
+    'good': 1.9, 'great': 3.1, 'excellent': 2.7, 'amazing': 2.8, 'awesome': 3.1, 'fantastic': 2.6,
+    'wonderful': 2.7, 'love': 3.2, 'loved': 2.9, 'loves': 2.7, 'like': 1.5, 'liked': 1.8, 'likes': 1.8,
+    'best': 3.2, 'better': 1.9, 'nice': 1.8, 'happy': 2.7, 'glad': 2.0, 'pleased': 1.9, 'enjoy': 2.2,
+    'enjoyed': 2.3, 'fun': 2.3, 'perfect': 2.7, 'beautiful': 2.9, 'brilliant': 2.8, 'recommend': 1.5,
+    'recommended': 1.8, 'helpful': 1.8, 'useful': 1.9, 'easy': 1.9, 'reliable': 1.9, 'fast': 1.0,
+    'quick': 1.0, 'cheap': 0.5, 'affordable': 1.3, 'worth': 0.9, 'win': 2.8, 'wins': 2.7, 'won': 2.7,
+    'success': 2.7, 'successful': 2.8, 'impressive': 2.5, 'impressed': 2.1, 'favorite': 2.0,
+    'favourite': 2.0, 'thanks': 1.9, 'thank': 1.5, 'thankful': 2.7, 'grateful': 2.0, 'cool': 1.3,
+    'solid': 1.0, 'smooth': 1.2, 'satisfied': 1.8, 'satisfying': 2.0, 'excited': 2.0, 'exciting': 2.2,
+    'hope': 1.9, 'hopeful': 1.6, 'safe': 1.9, 'clean': 1.7, 'friendly': 2.2, 'comfortable': 1.5,
+    'improved': 2.1, 'improvement': 2.0, 'fixed': 1.0, 'works': 1.0, 'working': 0.6, 'yes': 1.7,
+    'agree': 1.5, 'wow': 2.8, 'lol': 1.8, 'haha': 2.0, 'superb': 3.1, 'outstanding': 3.0,
+    'incredible': 2.6, 'stellar': 2.8, 'positive': 2.6, 'benefit': 2.0, 'benefits': 2.0, 'gain': 2.0,
+    'calm': 1.3, 'kind': 2.4, 'trust': 2.3, 'trusted': 2.1, 'honest': 2.3, 'fair': 1.3, 'strong': 2.3,
+    'popular': 1.8, 'valuable': 2.1, 'elegant': 2.1, 'lucky': 2.6, 'joy': 2.8, 'proud': 2.1,
+    # Negative
+    'bad': -2.5, 'worse': -2.1, 'worst': -3.1, 'terrible': -2.1, 'awful': -2.0, 'horrible': -2.5,
+    'hate': -2.7, 'hated': -3.2, 'hates': -1.9, 'dislike': -1.6, 'poor': -2.1, 'disappointing': -2.2,
+    'disappointed': -1.9, 'disappointment': -2.3, 'problem': -1.7, 'problems': -1.7, 'issue': -0.6,
+    'issues': -0.7, 'bug': -1.0, 'bugs': -1.0, 'broken': -2.1, 'break': -0.5, 'broke': -1.8,
+    'fail': -2.5, 'failed': -2.3, 'fails': -2.2, 'failure': -2.3, 'slow': -0.9, 'expensive': -1.1,
+    'overpriced': -1.7, 'waste': -1.8, 'wasted': -2.2, 'useless': -1.8, 'annoying': -1.7,
+    'annoyed': -1.6, 'angry': -2.3, 'sad': -2.1, 'unhappy': -1.8, 'upset': -1.6, 'frustrating': -1.9,
+    'frustrated': -2.4, 'scam': -2.7, 'fraud': -2.8, 'fake': -2.1, 'wrong': -2.1, 'sucks': -1.5,
+    'crap': -1.6, 'garbage': -2.0, 'trash': -1.5, 'avoid': -1.2, 'complaint': -1.2, 'complain': -1.8,
+    'difficult': -1.5, 'hard': -0.4, 'confusing': -1.3, 'confused': -1.3, 'ugly': -2.3, 'boring': -1.3,
+    'dangerous': -2.1, 'risk': -1.1, 'risky': -1.4, 'worried': -1.2, 'worry': -1.9, 'fear': -2.2,
+    'afraid': -2.2, 'scary': -2.2, 'pain': -2.3, 'painful': -1.9, 'sick': -2.3, 'hurt': -2.4,
+    'lost': -1.3, 'lose': -1.7, 'loss': -1.3, 'no': -1.2, 'unfortunately': -1.5, 'sorry': -0.3,
+    'cancel': -1.0, 'cancelled': -1.0, 'refund': -0.6, 'crash': -1.7, 'crashes': -1.7, 'crashed': -1.7,
+    'lag': -1.0, 'laggy': -1.4, 'rude': -2.0, 'dirty': -1.9, 'stupid': -2.4, 'dumb': -2.3,
+    'ridiculous': -1.5, 'mess': -1.5, 'nightmare': -2.7, 'disaster': -3.1, 'toxic': -2.5,
+    'negative': -2.7, 'weak': -1.9, 'unreliable': -1.8, 'lie': -1.6, 'lies': -1.8, 'lying': -2.4,
+    'regret': -1.8, 'hell': -3.6, 'damn': -1.7, 'wtf': -2.8, 'ugh': -1.8, 'meh': -0.3,
+}
+
+
+def load_lexicon(path=None):
+    """Returns {token: valence} from a VADER-format lexicon file, or the built-in lexicon."""
+    path = path or os.environ.get('SENTIMENT_LEXICON_PATH')
+    if not path:
+        return dict(DEFAULT_LEXICON)
+    lexicon = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) >= 2:
+                try:
+                    lexicon[parts[0].lower()] = float(parts[1])
+                except ValueError:
+                    continue
+    return lexicon
+
+
+class SentimentScorer:
+    """Scores batches of texts; build once and reuse (the lexicon is compiled at init)."""
+
+    def __init__(self, lexicon=None):
+        lexicon = lexicon if lexicon is not None else load_lexicon()
+        vocabulary = set(lexicon) | NEGATORS | set(BOOSTERS) | {'but'}
+        self._ids = {word: i for i, word in enumerate(sorted(vocabulary))}
+        size = len(self._ids) + 1  # last id: out-of-vocabulary
+        self._valence = np.zeros(size)
+        self._negator = np.zeros(size, dtype=bool)
+        self._booster = np.zeros(size)
+        self._but = np.zeros(size, dtype=bool)
+        for word, i in self._ids.items():
+            self._valence[i] = lexicon.get(word, 0.0)
+            self._negator[i] = word in NEGATORS
+            self._booster[i] = BOOSTERS.get(word, 0.0)
+            self._but[i] = word == 'but'
+        self._unknown = size - 1
+        self._word_ids = {}
+
+    def score(self, texts):
+        """
+        Scores a batch of texts.
+
+        Returns:
+            Tuple of (scores, magnitudes) as float64 arrays of len(texts);
+            empty or None texts score 0.
+        """
+        n = len(texts)
+        words = []
+        lengths = np.zeros(n, dtype=np.int64)
+        exclamations = np.zeros(n)
+        mixed_case = np.zeros(n, dtype=bool)
+        for t, text in enumerate(texts):
+            if not text:
+                continue
+            text_words = _TOKEN_RE.findall(text)
+            words.extend(text_words)
+            lengths[t] = len(text_words)
+            exclamations[t] = min(text.count('!'), MAX_EXCLAMATIONS)
+            mixed_case[t] = not text.isupper()
+        if not words:
+            return np.zeros(n), np.zeros(n)
+
+        # Raw words are memoized, so most lookups are one C-level dict.get
+        cache = self._word_ids
+        if len(cache) > MAX_CACHED_WORDS:
+            cache.clear()
+        for word in set(words).difference(cache):
+            cache[word] = self._ids.get(word.lower(), self._unknown)
+        ids = np.array(list(map(cache.__getitem__, words)))
+        text_index = np.repeat(np.arange(n), lengths)
+        valence = self._valence[ids].copy()
+        sign = np.sign(valence)
+        has_valence = valence != 0
+
+        # Boosters and negators in the three preceding words of the same text
+        negated = np.zeros(len(ids), dtype=bool)
+        for distance, weight in enumerate(BOOSTER_DISTANCE_WEIGHTS, start=1):
+            previous = np.full(len(ids), self._unknown)
+            previous[distance:] = ids[:-distance]
+            same_text = np.zeros(len(ids), dtype=bool)
+            same_text[distance:] = text_index[distance:] == text_index[:-distance]
+            previous = np.where(same_text, previous, self._unknown)
+            valence += sign * self._booster[previous] * weight * has_valence
+            negated |= self._negator[previous]
+        valence = np.where(negated & has_valence, valence * NEGATION_SCALAR, valence)
+
+        # ALL-CAPS emphasis in mixed-case texts (only sentiment words are checked)
+        for i in np.flatnonzero(has_valence & mixed_case[text_index]):
+            word = words[i]
+            if len(word) > 1 and word.isupper():
+                valence[i] += np.sign(valence[i]) * CAPS_INCREMENT
+
+        # "but" shifts weight to the clause after it
+        is_but = self._but[ids]
+        if is_but.any():
+            buts_so_far = np.cumsum(is_but)
+            text_starts = np.searchsorted(text_index, np.arange(n))
+            buts_before_text = np.concatenate(([0], buts_so_far))[text_starts]
+            seen_but = (buts_so_far - buts_before_text[text_index]) > 0
+            text_has_but = np.bincount(text_index, weights=is_but, minlength=n) > 0
+            weight = np.where(seen_but, BUT_AFTER_WEIGHT, BUT_BEFORE_WEIGHT)
+            valence = np.where(text_has_but[text_index], valence * weight, valence)
+
+        totals = np.bincount(text_index, weights=valence, minlength=n)
+        magnitudes = np.bincount(text_index, weights=np.abs(valence), minlength=n) / MAGNITUDE_DIVISOR
+        emphasis = exclamations * EXCLAMATION_INCREMENT
+        totals += np.sign(totals) * emphasis
+        magnitudes += np.where(totals != 0, emphasis / MAGNITUDE_DIVISOR, 0.0)
+        scores = totals / np.sqrt(totals * totals + NORMALIZATION_ALPHA)
+        return scores, magnitudes
+
+
+_scorer = None
+
+
+def get_scorer():
+    """Returns the instance-wide scorer, creating it on first use."""
+    global _scorer
+    if _scorer is None:
+        _scorer = SentimentScorer()
+    return _scorer
+
+
+def score_texts(texts):
+    """Scores texts with the instance-wide scorer; returns (scores, magnitudes) lists rounded to 4 places."""
+    scores, magnitudes = get_scorer().score(texts)
+    return np.round(scores, 4).tolist(), np.round(magnitudes, 4).tolist()
@@ -0,0 +1,239 @@
+"""
+Schema-driven row transformers for Bright Data Reddit and Quora snapshots.
+
+At import time the BigQuery table schemas (schemas/reddit_data.json and
+schemas/quora_data.json, which are also the table definitions) are compiled
+into one Python function per dataset.
+Each generated function builds the output row as a single dict literal with the
+field coercers bound as globals. Values that already have the right shape -
+ints for INTEGER fields, timestamps in Bright Data's usual UTC form - are
+checked inline and kept as they are, so only the odd value pays for a
+coercer call. BigQuery reads the UTC strings as delivered, which saves the
+datetime round trip the deliverer used to make for every comment and reply.
+
+Coercion rules (the ones the Reddit branch of the deliverer always applied):
+    INTEGER          -> int, or None if missing/unparseable; display counts
+                        such as '1.2K', '15,300' or '12 answers' are parsed
+    FLOAT            -> float, or None if missing/unparseable (same counts)
+    TIMESTAMP        -> ISO 8601 string (Bright Data's UTC strings unchanged),
+                        or None if missing/unparseable
+    REPEATED scalar  -> the list as delivered, or [] if not a list
+    RECORD           -> nested row, or None if missing
+    REPEATED RECORD  -> list of nested rows, [] if missing
+    anything else    -> passed through unchanged
+"""
+import datetime
+import gc
+import json
+import os
+import re
+
+REDDIT_DATASET_ID = "gd_lvz8ah06191smkebj4"
+QUORA_DATASET_ID = "gd_lvz1rbj81afv3m6n5y"
+
+# Schema file (JSON list of BigQuery fields) for each Bright Data dataset
+SCHEMA_FILES = {
+    REDDIT_DATASET_ID: "reddit_data.json",
+    QUORA_DATASET_ID: "quora_data.json",
+}
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Directories searched for schema files: an explicit SCHEMA_DIR, then the
+# schemas/ directory deployed with the function (the only copy of the schemas).
+SCHEMA_SEARCH_PATH = [
+    path for path in (
+        os.environ.get('SCHEMA_DIR'),
+        os.path.join(_HERE, 'schemas'),
+    ) if path
+]
+
+# Bright Data's usual UTC timestamp shape, e.g. 2024-05-01T12:34:56.789Z.
+# Days are limited to 01-28 so every match is a valid date; anything else
+# falls back to datetime.fromisoformat.
+_UTC_TIMESTAMP_RE = re.compile(
+    r'\d{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|1\d|2[0-8])'
+    r'T(?:[01]\d|2[0-3]):[0-5]\d:[0-5]\d(?:\.\d{1,6})?(?:Z|\+00:00)\Z'
+)
+_is_utc_timestamp = _UTC_TIMESTAMP_RE.match
+_fromisoformat = datetime.datetime.fromisoformat
+
+# Display counts as scraped from Quora/Reddit pages: '1.2K', '15,300', '12 answers'
+_COUNT_RE = re.compile(r'\s*([0-9][0-9,]*(?:\.[0-9]+)?)\s*([KkMmBb])?\b')
+_COUNT_MULTIPLIERS = {'k': 1_000, 'm': 1_000_000, 'b': 1_000_000_000}
+
+
+def parse_timestamp(value):
+    """
+    Converts a timestamp string to an ISO 8601 string BigQuery accepts.
+
+    Valid UTC timestamps in Bright Data's usual shape are returned unchanged;
+    anything else goes through datetime.fromisoformat. Returns None for empty
+    or unparseable values.
+    """
+    if not value:
+        return None
+    if type(value) is str and _is_utc_timestamp(value):
+        return value
+    try:
+        return _fromisoformat(value.replace('Z', '+00:00')).isoformat()
+    except (ValueError, AttributeError, TypeError):
+        return None
+
+
+def parse_count(value):
+    """
+    Parses a display count ('1.2K', '3M', '15,300', '12 answers') to a float.
+
+    Returns None if the string does not start with a number.
+    """
+    match = _COUNT_RE.match(value)
+    if not match:
+        return None
+    number = float(match.group(1).replace(',', ''))
+    suffix = match.group(2)
+    return number * _COUNT_MULTIPLIERS[suffix.lower()] if suffix else number
+
+
+def to_int(value):
+    """Converts a value to int, returning None for empty or unparseable values."""
+    if type(value) is int:
+        return value
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        pass
+    count = parse_count(value) if type(value) is str else None
+    return round(count) if count is not None else None
+
+
+def to_float(value):
+    """Converts a value to float, returning None for empty or unparseable values."""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        pass
+    return parse_count(value) if type(value) is str else None
+
+
+_SCALAR_COERCERS = {
+    'INTEGER': '_to_int',
+    'INT64': '_to_int',
+    'FLOAT': '_to_float',
+    'FLOAT64': '_to_float',
+    'TIMESTAMP': '_parse_timestamp',
+}
+
+
+def load_schema(filename):
+    """Loads a BigQuery JSON schema file from the first directory on SCHEMA_SEARCH_PATH that has it."""
+    for directory in SCHEMA_SEARCH_PATH:
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            with open(path) as schema_file:
+                return json.load(schema_file)
+    raise FileNotFoundError(f"Schema file {filename} not found in {SCHEMA_SEARCH_PATH}")
+
+
+def _generate_record_function(name, fields, functions, is_root):
+    """Appends the source of a function converting one RECORD to `functions`."""
+    lines = []
+    for field in fields:
+        field_name = field['name']
+        field_type = field['type'].upper()
+        repeated = field.get('mode', 'NULLABLE').upper() == 'REPEATED'
+        getter = f"g({field_name!r})"
+
+        if is_root and field_name == 'snapshot_id':
+            expression = "snapshot_id"
+        elif field_type in ('RECORD', 'STRUCT'):
+            child = f"{name}__{field_name}"
+            _generate_record_function(child, field.get('fields', []), functions, is_root=False)
+            if repeated:
+                expression = f"[{child}(item) for item in ({getter} or ()) if type(item) is dict]"
+            else:
+                expression = f"({child}(_v) if type(_v := {getter}) is dict and _v else None)"
+        elif repeated:
+            coercer = _SCALAR_COERCERS.get(field_type)
+            if coercer:
+                expression = f"([{coercer}(item) for item in _v] if type(_v := {getter}) is list else [])"
+            else:
+                expression = f"(_v if type(_v := {getter}) is list else [])"
+        elif field_type in ('INTEGER', 'INT64'):
+            expression = f"(_v if type(_v := {getter}) is int else _to_int(_v))"
+        elif field_type == 'TIMESTAMP':
+            expression = f"(_v if type(_v := {getter}) is str and _is_utc_timestamp(_v) else _parse_timestamp(_v))"
+        else:
+            coercer = _SCALAR_COERCERS.get(field_type)
+            expression = f"{coercer}({getter})" if coercer else getter
+
+        lines.append(f"        {field_name!r}: {expression},")
+
+    signature = "source, snapshot_id" if is_root else "source"
+    functions.append(
+        f"def {name}({signature}):\n"
+        f"    g = source.get\n"
+        f"    return {{\n" + "\n".join(lines) + "\n    }\n"
+    )
+
+
+def compile_transformer(schema, name='transform_row'):
+    """
+    Compiles a BigQuery schema into a function `f(post, snapshot_id) -> row`.
+
+    Args:
+        schema: List of BigQuery field dicts (name, type, mode, fields).
+        name: Name of the generated function (shows up in tracebacks).
+
+    Returns:
+        The generated row transformer.
+    """
+    functions = []
+    _generate_record_function(name, schema, functions, is_root=True)
+    source = "\n\n".join(functions)
+    namespace = {
+        '_to_int': to_int,
+        '_to_float': to_float,
+        '_parse_timestamp': parse_timestamp,
+        '_is_utc_timestamp': _is_utc_timestamp,
+    }
+    exec(compile(source, f"<transformer {name}>", 'exec'), namespace)
+    transformer = namespace[name]
+    transformer.source = source
+    return transformer
+
+
+TRANSFORMERS = {
+    dataset_id: compile_transformer(load_schema(filename), name=f"transform_{filename.split('.')[0]}")
+    for dataset_id, filename in SCHEMA_FILES.items()
+}
+
+
+def transform_posts(dataset_id, posts, snapshot_id):
+    """
+    Transforms a snapshot's posts into rows for the dataset's BigQuery table.
+
+    Args:
+        dataset_id: Bright Data dataset ID (Reddit or Quora).
+        posts: List of post dicts as delivered by Bright Data.
+        snapshot_id: Snapshot ID stored on every row.
+
+    Returns:
+        List of row dicts, or None if the dataset ID is unknown.
+    """
+    transformer = TRANSFORMERS.get(dataset_id)
+    if transformer is None:
+        return None
+    # The rows are acyclic, so pause the cyclic garbage collector instead of
+    # letting it rescan the growing row list every few hundred allocations.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return [transformer(post, snapshot_id) for post in posts if type(post) is dict]
+    finally:
+        if gc_was_enabled:
+            gc.enable()
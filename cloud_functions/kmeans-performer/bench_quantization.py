@@ -0,0 +1,108 @@
+"""
+Accuracy and decode-speed check of the compact embedding encodings.
+
+For each encoding the script reports:
+
+- bytes per vector as BigQuery bills it (8 per dimension for ARRAY<FLOAT64>),
+- mean and worst cosine similarity between decoded and original vectors,
+- recall@k of cosine nearest neighbours against the float64 vectors,
+- adjusted Rand index of K-means labels against the float64 labels (same
+  seed and initialization),
+- time to turn fetched rows into a float32 matrix (lists of floats via
+  np.array for float64, one np.frombuffer for the BYTES encodings).
+
+The corpus is synthetic by default: clustered 768-dimensional vectors, the
+size of text-embedding-004. Pass --npz with an array saved from real
+embeddings (key "embeddings") to check real data.
+
+Usage:
+    python bench_quantization.py
+    python bench_quantization.py --n 50000 --k 10 --clusters 20
+    python bench_quantization.py --npz sample_embeddings.npz
+"""
+import argparse
+import time
+
+import numpy as np
+
+from embedding_codec import decode_float16, decode_int8, encode_float16, encode_int8
+
+
+def synthetic_corpus(n, dim, n_topics, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_topics, dim))
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    labels = rng.integers(0, n_topics, n)
+    vectors = centers[labels] + noise * rng.standard_normal((n, dim)) / np.sqrt(dim)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def unit(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def neighbour_recall(reference, candidate, queries, k):
+    ref_unit, cand_unit = unit(reference), unit(candidate)
+    recalls = []
+    for q in queries:
+        truth = set(np.argsort(-(ref_unit @ ref_unit[q]))[1:k + 1].tolist())
+        found = set(np.argsort(-(cand_unit @ cand_unit[q]))[1:k + 1].tolist())
+        recalls.append(len(truth & found) / k)
+    return float(np.mean(recalls))
+
+
+def kmeans_labels(vectors, n_clusters, init):
+    from sklearn.cluster import KMeans
+    return KMeans(n_clusters=n_clusters, init=init, n_init=1, max_iter=100).fit(unit(vectors)).labels_
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--npz', help="Real embeddings (.npz with an 'embeddings' array) instead of synthetic ones")
+    parser.add_argument('--n', type=int, default=20_000, help="Synthetic corpus size")
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--clusters', type=int, default=20, help="Synthetic topics and K-means K")
+    parser.add_argument('--noise', type=float, default=1.5, help="Synthetic within-topic spread")
+    parser.add_argument('--k', type=int, default=10, help="Neighbours for recall@k")
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    from sklearn.metrics import adjusted_rand_score
+
+    if args.npz:
+        with np.load(args.npz) as archive:
+            vectors = np.asarray(archive['embeddings'], dtype=np.float64)
+    else:
+        vectors = synthetic_corpus(args.n, args.dim, args.clusters, args.noise)
+    n, dim = vectors.shape
+    print(f"{n} vectors x {dim} dims")
+
+    rng = np.random.default_rng(1)
+    queries = rng.choice(n, min(args.queries, n), replace=False)
+    init = unit(vectors[rng.choice(n, args.clusters, replace=False)])
+    reference_labels = kmeans_labels(vectors, args.clusters, init)
+
+    int8_blobs, int8_scales = encode_int8(vectors)
+    f16_blobs = encode_float16(vectors)
+    as_lists = vectors.tolist()
+    decoders = {
+        'float64': (dim * 8, lambda: np.array(as_lists, dtype=np.float32)),
+        'float16': (len(f16_blobs[0]), lambda: decode_float16(f16_blobs)),
+        'int8': (len(int8_blobs[0]) + 8, lambda: decode_int8(int8_blobs, int8_scales)),
+    }
+
+    print(f"\n{'encoding':<10}{'bytes/vec':>10}{'scan':>8}{'mean cos':>11}{'min cos':>10}"
+          f"{'recall@' + str(args.k):>11}{'ARI':>8}{'decode ms':>11}")
+    for encoding, (size, decode) in decoders.items():
+        start = time.perf_counter()
+        decoded = decode()
+        decode_ms = (time.perf_counter() - start) * 1000
+        cosines = np.einsum('ij,ij->i', unit(decoded.astype(np.float64)), unit(vectors))
+        recall = neighbour_recall(vectors, decoded, queries, args.k)
+        ari = adjusted_rand_score(reference_labels, kmeans_labels(decoded, args.clusters, init))
+        print(f"{encoding:<10}{size:>10}{dim * 8 / size:>7.1f}x{cosines.mean():>11.6f}{cosines.min():>10.6f}"
+              f"{recall:>11.3f}{ari:>8.3f}{decode_ms:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Centroids of finished K-means runs and nearest-centroid assignment.
+
+Centroids for a run_id are loaded, in order of preference, from:
+
+1. an in-memory cache on the warm instance,
+2. a centroid artifact (.npz with topic_ids and centroids) under
+   CENTROID_ARTIFACT_DIR - a local directory or gs://bucket/prefix (the
+   default local directory is only a per-instance cache),
+3. the run's BigQuery ML model via ML.CENTROIDS,
+4. the mean embedding of each topic's documents in document_topic_assignments
+   (used when the temp model has been deleted).
+
+Whatever BigQuery returns is written back as an artifact, so only the first
+assignment for a run pays for a query.
+"""
+from __future__ import annotations
+
+import io
+import logging
+import os
+import re
+import threading
+
+import numpy as np
+from google.cloud import bigquery
+
+logger = logging.getLogger(__name__)
+
+# The /tmp default is a cache for the warm instance and is lost with it; set a
+# gs:// path for artifacts that outlive instances (multi-K runs and runs whose
+# temp model was collected otherwise fall back to assignment means).
+CENTROID_ARTIFACT_DIR = os.environ.get('CENTROID_ARTIFACT_DIR', '/tmp/kmeans_centroids')
+# Rows per matrix product when assigning
+ASSIGN_BATCH_SIZE = 4096
+
+_cache_lock = threading.Lock()
+_centroid_cache = {}
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Returns float32 L2-normalized rows (zero rows stay zero)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def assign_to_centroids(embeddings: np.ndarray, centroids: np.ndarray,
+                        batch_size: int = ASSIGN_BATCH_SIZE) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Assigns each embedding to its nearest centroid by cosine distance.
+
+    Args:
+        embeddings: (n, dim) array of embeddings.
+        centroids: (k, dim) array of centroids.
+        batch_size: Rows per matrix product, bounding peak memory.
+
+    Returns:
+        Tuple of (index of the nearest centroid per row, cosine distance to it).
+    """
+    unit_centroids = normalize_rows(centroids).T
+    nearest = np.empty(len(embeddings), dtype=np.int64)
+    distances = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), batch_size):
+        similarities = normalize_rows(embeddings[start:start + batch_size]) @ unit_centroids
+        best = np.argmax(similarities, axis=1)
+        nearest[start:start + batch_size] = best
+        distances[start:start + batch_size] = 1.0 - similarities[np.arange(len(best)), best]
+    return nearest, distances
+
+
+# --- Artifacts ---
+
+def _artifact_path(run_id: str) -> str:
+    return f"{CENTROID_ARTIFACT_DIR.rstrip('/')}/{run_id}.npz"
+
+
+def _split_gcs_path(path: str) -> tuple[str, str]:
+    bucket_name, _, object_name = path[len('gs://'):].partition('/')
+    return bucket_name, object_name
+
+
+def save_centroid_artifact(run_id: str, topic_ids: np.ndarray, centroids: np.ndarray) -> str:
+    """Writes a run's centroids as an .npz artifact and returns its path."""
+    buffer = io.BytesIO()
+    np.savez(buffer, topic_ids=np.asarray(topic_ids, dtype=np.int64), centroids=np.asarray(centroids, dtype=np.float32))
+    path = _artifact_path(run_id)
+    if path.startswith('gs://'):
+        from google.cloud import storage
+        bucket_name, object_name = _split_gcs_path(path)
+        storage.Client().bucket(bucket_name).blob(object_name).upload_from_string(buffer.getvalue())
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(buffer.getvalue())
+    return path
+
+
+def load_centroid_artifact(run_id: str) -> tuple[np.ndarray, np.ndarray] | None:
+    """Returns (topic_ids, centroids) from the run's artifact, or None if there is none."""
+    path = _artifact_path(run_id)
+    if path.startswith('gs://'):
+        from google.cloud import storage
+        from google.cloud.exceptions import NotFound
+        bucket_name, object_name = _split_gcs_path(path)
+        try:
+            data = storage.Client().bucket(bucket_name).blob(object_name).download_as_bytes()
+        except NotFound:
+            return None
+    elif os.path.exists(path):
+        with open(path, 'rb') as f:
+            data = f.read()
+    else:
+        return None
+    with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+        return archive['topic_ids'], archive['centroids']
+
+
+# --- BigQuery ---
+
+def _feature_index(feature: str) -> int:
+    # Array features come back one row per element, named with the element
+    # index; without it there is no safe way to put the values in order.
+    match = re.search(r'(\d+)$', feature or '')
+    if not match:
+        raise ValueError(f"ML.CENTROIDS feature {feature!r} has no trailing element index")
+    return int(match.group(1))
+
+
+def load_centroids_from_model(client: bigquery.Client, project_id: str, bigquery_dataset_id: str,
+                              run_id: str, location: str) -> tuple[np.ndarray, np.ndarray]:
+    """Reads centroids from the run's BigQuery ML model with ML.CENTROIDS."""
+    query = f"""
+    SELECT centroid_id, feature, numerical_value
+    FROM ML.CENTROIDS(MODEL `{project_id}.{bigquery_dataset_id}.temp_topic_model_{run_id}`)
+    WHERE numerical_value IS NOT NULL
+    """
+    values = {}
+    for row in client.query(query, location=location).result():
+        features = values.setdefault(row.centroid_id, {})
+        index = _feature_index(row.feature)
+        if index in features:
+            raise ValueError(f"ML.CENTROIDS returned element index {index} twice for centroid {row.centroid_id}")
+        features[index] = row.numerical_value
+    if not values:
+        raise ValueError(f"ML.CENTROIDS returned no numerical features for run {run_id}")
+
+    topic_ids = np.array(sorted(values), dtype=np.int64)
+    indexes = sorted(values[topic_ids[0]])
+    if any(sorted(values[topic_id]) != indexes for topic_id in topic_ids):
+        raise ValueError(f"ML.CENTROIDS returned different features per centroid for run {run_id}")
+    centroids = np.array(
+        [[values[topic_id][index] for index in indexes] for topic_id in topic_ids],
+        dtype=np.float32,
+    )
+    return topic_ids, centroids
+
+
+def load_centroids_from_assignments(client: bigquery.Client, project_id: str, bigquery_dataset_id: str,
+                                    run_id: str, location: str) -> tuple[np.ndarray, np.ndarray]:
+    """Recomputes centroids as the mean normalized embedding of each topic's documents."""
+    query = f"""
+    SELECT dta.topic_id, ec.embeddings
+    FROM `{project_id}.{bigquery_dataset_id}.document_topic_assignments` AS dta
+    JOIN `{project_id}.{bigquery_dataset_id}.embeddings_cache` AS ec
+      ON dta.unified_id = ec.unified_id
+    WHERE dta.run_id = @run_id
+      AND ec.embeddings IS NOT NULL AND ARRAY_LENGTH(ec.embeddings) > 0
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("run_id", "STRING", run_id)
+    ])
+    sums = {}
+    for row in client.query(query, job_config=job_config, location=location).result():
+        vector = normalize_rows(np.asarray([row.embeddings], dtype=np.float32))[0]
+        if row.topic_id in sums:
+            sums[row.topic_id] += vector
+        else:
+            sums[row.topic_id] = vector
+    if not sums:
+        raise ValueError(f"No topic assignments found for run {run_id}")
+    topic_ids = np.array(sorted(sums), dtype=np.int64)
+    return topic_ids, normalize_rows(np.stack([sums[topic_id] for topic_id in topic_ids]))
+
+
+def get_run_centroids(client: bigquery.Client, project_id: str, bigquery_dataset_id: str, run_id: str,
+                      location: str, embedding_dim: int | None = None) -> tuple[np.ndarray, np.ndarray, str]:
+    """
+    Returns (topic_ids, centroids, source) for a run, trying the sources in
+    the order described in the module docstring.
+
+    Args:
+        embedding_dim: Expected centroid dimension; centroids from a source
+            with a different dimension are rejected and the next source is tried.
+    """
+    with _cache_lock:
+        cached = _centroid_cache.get(run_id)
+    if cached is not None:
+        return cached[0], cached[1], 'memory'
+
+    def usable(loaded):
+        return loaded is not None and (embedding_dim is None or loaded[1].shape[1] == embedding_dim)
+
+    try:
+        loaded = load_centroid_artifact(run_id)
+    except Exception as e:
+        logger.warning(f"Could not read centroid artifact for run {run_id}: {e}")
+        loaded = None
+    source = 'artifact'
+    if not usable(loaded):
+        loaded, source = None, None
+        for source_name, loader in (('ml_centroids', load_centroids_from_model),
+                                    ('assignment_means', load_centroids_from_assignments)):
+            try:
+                candidate = loader(client, project_id, bigquery_dataset_id, run_id, location)
+            except Exception as e:
+                logger.warning(f"Could not load centroids for run {run_id} from {source_name}: {e}")
+                continue
+            if usable(candidate):
+                loaded, source = candidate, source_name
+                break
+            logger.warning(f"Centroids from {source_name} have dimension {candidate[1].shape[1]}, "
+                           f"expected {embedding_dim}")
+        if loaded is None:
+            raise ValueError(f"No usable centroids found for run {run_id}")
+        try:
+            path = save_centroid_artifact(run_id, *loaded)
+            logger.info(f"Saved centroid artifact for run {run_id} to {path}")
+        except Exception as e:
+            logger.warning(f"Could not save centroid artifact for run {run_id}: {e}")
+
+    with _cache_lock:
+        _centroid_cache[run_id] = loaded
+    logger.info(f"Loaded {len(loaded[0])} centroids for run {run_id} from {source}")
+    return loaded[0], loaded[1], source
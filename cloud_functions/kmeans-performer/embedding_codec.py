@@ -0,0 +1,117 @@
+"""
+Compact encodings of embeddings_cache vectors.
+
+Besides the ARRAY<FLOAT64> `embeddings` column, embeddings_cache can hold:
+
+- int8: `embeddings_int8` BYTES with one signed byte per dimension and the
+  per-vector scale in `embeddings_int8_scale` (value = code * scale, where
+  scale = max|x| / 127). 1/8 of the float64 bytes; written by the deliverer
+  MERGE and by quantize_embeddings.py.
+- float16: `embeddings_f16` BYTES, little-endian IEEE half floats. 1/4 of the
+  float64 bytes; written by quantize_embeddings.py.
+
+BigQuery scans (and bills) a BYTES column by its length, so selecting an
+encoded column instead of `embeddings` cuts scan bytes and transfer time by
+the same factor. Decoding joins the row blobs and calls np.frombuffer once,
+so no per-element Python objects are created. bench_quantization.py measures
+the accuracy cost.
+
+This file is kept identical in kmeans-performer and similarity-index.
+"""
+from __future__ import annotations
+
+import numpy as np
+
+ENCODINGS = ('float64', 'int8', 'float16')
+INT8_MAX = 127
+
+
+def validate_encoding(encoding: str) -> str:
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown embedding encoding '{encoding}'; expected one of {', '.join(ENCODINGS)}")
+    return encoding
+
+
+def select_sql(encoding: str, alias: str = 'ec') -> str:
+    """Returns the SELECT expressions that fetch embeddings in this encoding."""
+    validate_encoding(encoding)
+    if encoding == 'int8':
+        return f"{alias}.embeddings_int8, {alias}.embeddings_int8_scale"
+    if encoding == 'float16':
+        return f"{alias}.embeddings_f16"
+    return f"{alias}.embeddings"
+
+
+def filter_sql(encoding: str, alias: str = 'ec') -> str:
+    """Returns the WHERE condition selecting rows that have embeddings in this encoding."""
+    validate_encoding(encoding)
+    if encoding == 'int8':
+        return f"{alias}.embeddings_int8 IS NOT NULL AND {alias}.embeddings_int8_scale IS NOT NULL"
+    if encoding == 'float16':
+        return f"{alias}.embeddings_f16 IS NOT NULL"
+    return f"{alias}.embeddings IS NOT NULL AND ARRAY_LENGTH({alias}.embeddings) > 0"
+
+
+# --- Encoding ---
+
+def encode_int8(vectors: np.ndarray) -> tuple[list[bytes], np.ndarray]:
+    """Quantizes (n, dim) vectors to per-vector scaled int8; returns (blobs, scales)."""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    scales = np.abs(vectors).max(axis=1) / INT8_MAX
+    safe_scales = np.where(scales > 0, scales, 1.0)
+    codes = np.clip(np.rint(vectors / safe_scales[:, None]), -INT8_MAX, INT8_MAX).astype(np.int8)
+    return [row.tobytes() for row in codes], scales
+
+
+def encode_float16(vectors: np.ndarray) -> list[bytes]:
+    """Encodes (n, dim) vectors as little-endian float16 blobs."""
+    codes = np.asarray(vectors, dtype='<f2')
+    return [row.tobytes() for row in codes]
+
+
+# --- Decoding ---
+
+def decode_int8(blobs: list[bytes], scales) -> np.ndarray:
+    """Decodes int8 blobs and their scales into an (n, dim) float32 array."""
+    if not blobs:
+        return np.empty((0, 0), dtype=np.float32)
+    codes = np.frombuffer(b''.join(blobs), dtype=np.int8).reshape(len(blobs), -1)
+    return codes.astype(np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+
+
+def decode_float16(blobs: list[bytes]) -> np.ndarray:
+    """Decodes float16 blobs into an (n, dim) float32 array."""
+    if not blobs:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.frombuffer(b''.join(blobs), dtype='<f2').reshape(len(blobs), -1).astype(np.float32)
+
+
+class EmbeddingCollector:
+    """Accumulates embeddings from query rows and decodes them in one pass."""
+
+    def __init__(self, encoding: str = 'float64'):
+        self.encoding = validate_encoding(encoding)
+        self._values = []
+        self._scales = []
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def add(self, row) -> None:
+        if self.encoding == 'int8':
+            self._values.append(row.embeddings_int8)
+            self._scales.append(row.embeddings_int8_scale)
+        elif self.encoding == 'float16':
+            self._values.append(row.embeddings_f16)
+        else:
+            self._values.append(row.embeddings)
+
+    def to_array(self) -> np.ndarray:
+        """Returns the collected embeddings as an (n, dim) float32 array."""
+        if self.encoding == 'int8':
+            return decode_int8(self._values, self._scales)
+        if self.encoding == 'float16':
+            return decode_float16(self._values)
+        if not self._values:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.array(self._values, dtype=np.float32)
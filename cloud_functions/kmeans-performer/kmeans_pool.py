@@ -0,0 +1,107 @@
+"""
+Concurrent K-means over one embedding matrix for several values of K.
+
+The normalized float32 matrix is copied once into a shared memory block;
+worker processes attach to it by name and wrap it in a numpy array without
+copying, so N concurrent fits cost one matrix of memory instead of N pickled
+copies. Each worker runs scikit-learn KMeans on the unit vectors (Euclidean
+k-means on the unit sphere, i.e. cosine clustering) with its BLAS/OpenMP
+threads capped at its share of the CPUs.
+
+This module imports only numpy and the standard library at the top, so the
+spawned workers start without loading BigQuery or UMAP.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_N_INIT = 3
+DEFAULT_MAX_ITER = 100
+RANDOM_STATE = 42
+
+
+def _attach(name: str, shape: tuple, dtype: str):
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _fit_worker(name: str, shape: tuple, dtype: str, n_clusters: int, n_init: int, max_iter: int,
+                threads: int) -> dict:
+    from sklearn.cluster import KMeans
+    from threadpoolctl import threadpool_limits
+
+    block, embeddings = _attach(name, shape, dtype)
+    try:
+        start = time.perf_counter()
+        with threadpool_limits(limits=threads):
+            model = KMeans(n_clusters=n_clusters, n_init=n_init, max_iter=max_iter,
+                           random_state=RANDOM_STATE).fit(embeddings)
+        centroids = model.cluster_centers_.astype(np.float32)
+        unit_centroids = centroids / np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        labels = model.labels_.astype(np.int32)
+        # Cosine distance of each document to its own centroid
+        distances = 1.0 - np.einsum('ij,ij->i', embeddings, unit_centroids[labels])
+        return {
+            'n_clusters': n_clusters,
+            'labels': labels,
+            'distances': distances.astype(np.float32),
+            'centroids': centroids,
+            'inertia': float(model.inertia_),
+            'fit_seconds': round(time.perf_counter() - start, 2),
+        }
+    finally:
+        del embeddings
+        block.close()
+
+
+def cluster_many(embeddings: np.ndarray, n_clusters_list: list[int], n_init: int = DEFAULT_N_INIT,
+                 max_iter: int = DEFAULT_MAX_ITER, max_workers: int | None = None) -> list[dict]:
+    """
+    Fits one K-means model per K concurrently on a shared copy of the embeddings.
+
+    Args:
+        embeddings: (n, dim) embeddings; L2-normalized here.
+        n_clusters_list: Values of K.
+        n_init: KMeans initializations per K.
+        max_iter: KMeans iterations per initialization.
+        max_workers: Worker processes (default: one per K, at most the CPU count).
+
+    Returns:
+        One dict per K, in the order given, with labels (index of each row's
+        centroid), distances (cosine distance to it), centroids, inertia and
+        fit_seconds.
+    """
+    unit = np.asarray(embeddings, dtype=np.float32)
+    unit = unit / np.maximum(np.linalg.norm(unit, axis=1, keepdims=True), 1e-12)
+    cpus = os.cpu_count() or 1
+    max_workers = max_workers or min(len(n_clusters_list), cpus)
+    threads = max(1, cpus // max_workers)
+
+    block = shared_memory.SharedMemory(create=True, size=unit.nbytes)
+    try:
+        shared = np.ndarray(unit.shape, dtype=unit.dtype, buffer=block.buf)
+        shared[:] = unit
+        del unit
+        # spawn: the parent holds gRPC/HTTP client threads that must not be forked
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context('spawn')) as pool:
+            futures = [
+                pool.submit(_fit_worker, block.name, shared.shape, shared.dtype.str, k, n_init, max_iter, threads)
+                for k in n_clusters_list
+            ]
+            results = [future.result() for future in futures]
+        del shared
+    finally:
+        block.close()
+        block.unlink()
+
+    for result in results:
+        logger.info(f"K={result['n_clusters']}: fitted in {result['fit_seconds']}s (inertia {result['inertia']:.1f})")
+    return results
@@ -1,15 +1,25 @@
+from __future__ import annotations
+
 import functions_framework
 from flask import jsonify, request
 from google.cloud import bigquery
 import logging
 import os
 import json
+import random
 import time
 from datetime import datetime
+from typing import TYPE_CHECKING
 from google.cloud.exceptions import NotFound
-import numpy as np
-import umap
-import pandas as pd
+from runtime import get_bigquery_client, load_rows
+import prompt_packing
+import scheduler
+
+# numpy and umap are imported where they are used: umap pulls in numba and
+# pynndescent, which dominate cold-start time and are not needed when
+# skip_umap is set. See profile_imports.py.
+if TYPE_CHECKING:
+    import numpy as np
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -18,8 +28,27 @@ logger = logging.getLogger(__name__)
 # Configuration
 PROJECT_ID = os.environ.get('GCP_PROJECT', 'social-listening-sense')
 BIGQUERY_LOCATION = 'eu'  # Ensure this matches your dataset location
+EMBEDDING_MODEL = 'text-embedding-004'
+KMEANS_RUNS_TABLE = f"{PROJECT_ID}.social_listening_data.kmeans_runs"
+# Training options of the BigQuery ML model; part of the run fingerprint
+KMEANS_TRAINING_OPTIONS = {
+    'kmeans_init_method': 'KMEANS_PLUS_PLUS',
+    'max_iterations': 50,
+    'distance_type': 'COSINE',  # Using cosine distance for embedding vectors
+}
+# Upper bound on the K values of one multi-K request
+MAX_SIBLING_RUNS = 8
+# Labels starting with this are placeholders written when Gemini's output could not be used
+LABEL_ERROR_PREFIX = 'Error:'
+RELABEL_MIN_CONFIDENCE = 0.5
+RELABEL_MAX_ATTEMPTS = 3
+RELABEL_BACKOFF_SECONDS = 2.0
+# Embedding column read by the local (UMAP, assignment, multi-K) paths:
+# 'float64', 'int8' or 'float16' (see embedding_codec.py)
+EMBEDDING_ENCODING = os.environ.get('EMBEDDING_ENCODING', 'float64')
 
-def create_kmeans_model_job(unified_ids: list, n_clusters: int, bigquery_dataset_id: str, description: str = None):
+def create_kmeans_model_job(unified_ids: list, n_clusters: int, bigquery_dataset_id: str, description: str = None,
+                            fingerprint: str = None):
     """
     Constructs and submits a BigQuery ML job to create a K-Means model using
     an Array Parameter for the unified_ids list.
@@ -29,11 +58,12 @@ def create_kmeans_model_job(unified_ids: list, n_clusters: int, bigquery_dataset
         n_clusters: The number of clusters (K) for K-Means.
         bigquery_dataset_id: The BigQuery dataset ID to use.
         description: Optional description for the run.
+        fingerprint: Run fingerprint (see run_reuse.py) stored on kmeans_runs.
 
     Returns:
         A dictionary containing the run_id and the BigQuery job ID for model creation.
     """
-    client = bigquery.Client(project=PROJECT_ID)
+    client = get_bigquery_client(PROJECT_ID)
 
     # Generate a unique run_id for this K-Means operation
     run_id = f"kmeans_run_{int(time.time())}_{n_clusters}"
@@ -45,9 +75,9 @@ def create_kmeans_model_job(unified_ids: list, n_clusters: int, bigquery_dataset
     OPTIONS(
       model_type='KMEANS',
       num_clusters={n_clusters},
-      kmeans_init_method='KMEANS_PLUS_PLUS',
-      max_iterations=50,
-      distance_type='COSINE'  # Using cosine distance for embedding vectors
+      kmeans_init_method='{KMEANS_TRAINING_OPTIONS['kmeans_init_method']}',
+      max_iterations={KMEANS_TRAINING_OPTIONS['max_iterations']},
+      distance_type='{KMEANS_TRAINING_OPTIONS['distance_type']}'
     )
     AS
     SELECT
@@ -89,9 +119,9 @@ def create_kmeans_model_job(unified_ids: list, n_clusters: int, bigquery_dataset
         # Insert a row into kmeans_runs table
         insert_run_sql = f"""
         INSERT INTO `{PROJECT_ID}.social_listening_data.kmeans_runs`
-        (run_id, created_at, num_topics, description, model_name, model_creation_job_id, status, embedding_model)
+        (run_id, created_at, num_topics, description, model_name, model_creation_job_id, status, embedding_model, fingerprint)
         VALUES
-        (@run_id, @created_at, @num_topics, @description, @model_name, @model_creation_job_id, @status, @embedding_model)
+        (@run_id, @created_at, @num_topics, @description, @model_name, @model_creation_job_id, @status, @embedding_model, @fingerprint)
         """
 
         job_config = bigquery.QueryJobConfig(
@@ -103,7 +133,8 @@ def create_kmeans_model_job(unified_ids: list, n_clusters: int, bigquery_dataset
                 bigquery.ScalarQueryParameter("model_name", "STRING", model_name),
                 bigquery.ScalarQueryParameter("model_creation_job_id", "STRING", query_job.job_id),
                 bigquery.ScalarQueryParameter("status", "STRING", "submitted"),
-                bigquery.ScalarQueryParameter("embedding_model", "STRING", "text-embedding-004")
+                bigquery.ScalarQueryParameter("embedding_model", "STRING", EMBEDDING_MODEL),
+                bigquery.ScalarQueryParameter("fingerprint", "STRING", fingerprint)
             ]
         )
 
@@ -136,7 +167,7 @@ def create_kmeans_model_job(unified_ids: list, n_clusters: int, bigquery_dataset
                     bigquery.ScalarQueryParameter("model_name", "STRING", model_name),
                     bigquery.ScalarQueryParameter("status", "STRING", "failed"),
                     bigquery.ScalarQueryParameter("error_message", "STRING", str(e)),
-                    bigquery.ScalarQueryParameter("embedding_model", "STRING", "text-embedding-004")
+                    bigquery.ScalarQueryParameter("embedding_model", "STRING", EMBEDDING_MODEL)
                 ]
             )
 
@@ -272,7 +303,8 @@ def run_prediction_job(client, run_id: str, unified_ids: list, bigquery_dataset_
         
         raise
 
-def fetch_embeddings(client: bigquery.Client, unified_ids: list, bigquery_dataset_id: str) -> tuple[list[str], np.ndarray]:
+def fetch_embeddings(client: bigquery.Client, unified_ids: list, bigquery_dataset_id: str,
+                     encoding: str = 'float64') -> tuple[list[str], np.ndarray]:
     """
     Fetches embeddings for the given unified IDs from BigQuery.
     
@@ -280,20 +312,23 @@ def fetch_embeddings(client: bigquery.Client, unified_ids: list, bigquery_datase
         client: BigQuery client
         unified_ids: List of content IDs to fetch embeddings for
         bigquery_dataset_id: The BigQuery dataset ID
+        encoding: 'float64' (the embeddings array), or the compact 'int8' /
+            'float16' columns (see embedding_codec.py)
         
     Returns:
-        Tuple of (list of unified_ids that had valid embeddings, numpy array of embeddings)
+        Tuple of (list of unified_ids that had valid embeddings, float32 numpy array of embeddings)
     """
+    from embedding_codec import EmbeddingCollector, filter_sql, select_sql
+
     query = f"""
     SELECT
         ec.unified_id,
-        ec.embeddings
+        {select_sql(encoding)}
     FROM
         `{PROJECT_ID}.{bigquery_dataset_id}.embeddings_cache` AS ec
     WHERE
         ec.unified_id IN UNNEST(@unified_id_list)
-        AND ec.embeddings IS NOT NULL 
-        AND ARRAY_LENGTH(ec.embeddings) > 0
+        AND {filter_sql(encoding)}
     """
     
     job_config = bigquery.QueryJobConfig(
@@ -306,19 +341,20 @@ def fetch_embeddings(client: bigquery.Client, unified_ids: list, bigquery_datase
         query_job = client.query(query, job_config=job_config, location=BIGQUERY_LOCATION)
         results = query_job.result()
         
-        # Convert results to lists
+        # Collect results and decode them in one pass
         valid_ids = []
-        embeddings_list = []
+        collector = EmbeddingCollector(encoding)
         
         for row in results:
             valid_ids.append(row.unified_id)
-            embeddings_list.append(row.embeddings)
+            collector.add(row)
         
         if not valid_ids:
-            raise ValueError("No valid embeddings found for the provided IDs")
+            raise ValueError(f"No valid {encoding} embeddings found for the provided IDs")
         
-        # Convert to numpy array
-        embeddings_array = np.array(embeddings_list)
+        embeddings_array = collector.to_array()
+        logger.info(f"Fetched {len(valid_ids)} {encoding} embeddings "
+                    f"({(query_job.total_bytes_processed or 0) / 1e6:.1f} MB processed)")
         
         return valid_ids, embeddings_array
         
@@ -378,32 +414,41 @@ def perform_umap_reduction(embeddings: np.ndarray, n_neighbors: int = 15,
     Returns:
         2D numpy array of coordinates
     """
-
-
-    reducer = umap.UMAP(
+    # Runs in the scheduler's UMAP process pool, so other runs on this
+    # instance keep making progress during the fit
+    return scheduler.run_umap(
+        embeddings,
         n_neighbors=n_neighbors,
         min_dist=min_dist,
         metric=metric,
         n_components=n_components
     )
-    
-    return reducer.fit_transform(embeddings)
 
-def get_top_documents_for_topics(client: bigquery.Client, run_id: str, bigquery_dataset_id: str, 
-                               num_docs: int = 10, max_text_length: int = 500) -> dict:
+def get_top_documents_for_topics(client: bigquery.Client, run_id: str, bigquery_dataset_id: str,
+                                 num_docs: int = 30, max_text_length: int | None = None,
+                                 token_budget: int = prompt_packing.DEFAULT_TOKEN_BUDGET,
+                                 topic_ids: list[int] | None = None) -> dict:
     """
-    Gets the top documents for each topic based on assignment score.
-    
+    Gets the most representative documents of each topic, packed into a
+    per-topic token budget (see prompt_packing.py).
+
     Args:
         client: BigQuery client
         run_id: The run ID for this clustering operation
         bigquery_dataset_id: The BigQuery dataset ID
-        num_docs: Number of top documents to get per topic
-        max_text_length: Maximum length of text to include for each document
-        
+        num_docs: Maximum number of documents per topic
+        max_text_length: Optional per-document cap in characters (cut on a
+            sentence boundary); defaults to prompt_packing.DEFAULT_MAX_DOC_TOKENS
+        token_budget: Estimated prompt tokens available for each topic's documents
+        topic_ids: Optional subset of topics (default: all topics of the run)
+
     Returns:
-        Dictionary mapping topic IDs to lists of document texts
+        Dictionary mapping topic IDs to the packed documents and their stats
     """
+    max_doc_tokens = (max_text_length // prompt_packing.CHARS_PER_TOKEN if max_text_length
+                      else prompt_packing.DEFAULT_MAX_DOC_TOKENS)
+    # Candidates beyond num_docs replace the duplicates and near-empty texts that
+    # packing skips; texts are cut server-side to what one document may use
     query = f"""
     WITH RankedDocs AS (
         SELECT
@@ -412,51 +457,65 @@ def get_top_documents_for_topics(client: bigquery.Client, run_id: str, bigquery_
             assignment_score,
             ROW_NUMBER() OVER (PARTITION BY topic_id ORDER BY assignment_score ASC) as doc_rank
         FROM `{PROJECT_ID}.{bigquery_dataset_id}.document_topic_assignments`
-        WHERE run_id = @run_id
+        WHERE run_id = @run_id AND primary_text IS NOT NULL
+        {"AND topic_id IN UNNEST(@topic_ids)" if topic_ids is not None else ""}
     )
     SELECT
         topic_id,
-        STRING_AGG(
-            SUBSTR(primary_text, 1, @max_text_length),
-            '\\n---\\n'
-            ORDER BY doc_rank
-            LIMIT @num_docs
-        ) as topic_documents,
-        AVG(assignment_score) as avg_assignment_score,
-        COUNT(*) as num_documents
+        ARRAY_AGG(STRUCT(SUBSTR(primary_text, 1, @max_fetch_chars) AS text, assignment_score) ORDER BY doc_rank) as candidates
     FROM RankedDocs
-    WHERE doc_rank <= @num_docs
+    WHERE doc_rank <= @num_candidates
     GROUP BY topic_id
     """
-    
+
     job_config = bigquery.QueryJobConfig(
         query_parameters=[
             bigquery.ScalarQueryParameter("run_id", "STRING", run_id),
-            bigquery.ScalarQueryParameter("num_docs", "INT64", num_docs),
-            bigquery.ScalarQueryParameter("max_text_length", "INT64", max_text_length)
+            bigquery.ScalarQueryParameter("num_candidates", "INT64", num_docs * 3),
+            bigquery.ScalarQueryParameter("max_fetch_chars", "INT64", (max_doc_tokens + 1) * prompt_packing.CHARS_PER_TOKEN * 2)
         ]
     )
-    
+    if topic_ids is not None:
+        job_config.query_parameters = job_config.query_parameters + [
+            bigquery.ArrayQueryParameter("topic_ids", "INT64", list(topic_ids))
+        ]
+
     try:
         query_job = client.query(query, job_config=job_config, location=BIGQUERY_LOCATION)
         results = query_job.result()
-        
+
         topic_docs = {}
         for row in results:
+            texts = [candidate['text'] for candidate in row.candidates]
+            packed = prompt_packing.pack_documents(texts, token_budget=token_budget,
+                                                   max_doc_tokens=max_doc_tokens, max_docs=num_docs)
+            if not packed['indices']:
+                # A topic of one- and two-word comments: label it from those
+                packed = prompt_packing.pack_documents(texts, token_budget=token_budget,
+                                                       max_doc_tokens=max_doc_tokens, max_docs=num_docs,
+                                                       min_words=1)
+            scores = [row.candidates[i]['assignment_score'] for i in packed['indices']]
             topic_docs[row.topic_id] = {
-                'documents': row.topic_documents,
-                'avg_assignment_score': row.avg_assignment_score,
-                'num_documents': row.num_documents
+                'documents': packed['text'],
+                'avg_assignment_score': sum(scores) / len(scores) if scores else 0.0,
+                'num_documents': len(scores),
+                'prompt_tokens': packed['tokens_used'],
+                'num_truncated': packed['num_truncated'],
+                'num_duplicates': packed['num_duplicates']
             }
-        
+
+        logger.info(f"Packed documents for {len(topic_docs)} topics of run {run_id}: "
+                    f"~{sum(info['prompt_tokens'] for info in topic_docs.values())} tokens "
+                    f"(budget {token_budget} per topic)")
         return topic_docs
-        
+
     except Exception as e:
         logger.error(f"Error getting top documents: {e}")
         raise
 
 def generate_topic_labels(client: bigquery.Client, run_id: str, topic_docs: dict, 
-                         bigquery_dataset_id: str) -> None:
+                         bigquery_dataset_id: str, temperature: float = 0.2,
+                         store: bool = True) -> list[dict]:
     """
     Generates topic labels using Gemini through BigQuery ML and stores them.
     
@@ -465,6 +524,12 @@ def generate_topic_labels(client: bigquery.Client, run_id: str, topic_docs: dict
         run_id: The run ID for this clustering operation
         topic_docs: Dictionary mapping topic IDs to document information
         bigquery_dataset_id: The BigQuery dataset ID
+        temperature: Sampling temperature for Gemini
+        store: Whether to append the rows to topic_labels (relabel_topics
+            upserts them itself)
+
+    Returns:
+        The topic_labels rows, including error placeholders
     """
     # Create a temporary table for the input data
     temp_table = f"temp_topic_docs_{run_id}"
@@ -510,7 +575,7 @@ def generate_topic_labels(client: bigquery.Client, run_id: str, topic_docs: dict
                 SELECT @prompt as prompt
             ),
             STRUCT(
-                0.2 as temperature,
+                @temperature as temperature,
                 1024 as max_output_tokens,
                 0.95 as top_p,
                 40 as top_k
@@ -520,7 +585,8 @@ def generate_topic_labels(client: bigquery.Client, run_id: str, topic_docs: dict
         
         job_config = bigquery.QueryJobConfig(
             query_parameters=[
-                bigquery.ScalarQueryParameter("prompt", "STRING", prompt)
+                bigquery.ScalarQueryParameter("prompt", "STRING", prompt),
+                bigquery.ScalarQueryParameter("temperature", "FLOAT64", temperature)
             ]
         )
         
@@ -592,6 +658,7 @@ def generate_topic_labels(client: bigquery.Client, run_id: str, topic_docs: dict
                             'model_version': response_json.get('model_version'),
                             'response_id': response_json.get('response_id'),
                             'prompt_used': prompt_used,
+                            'prompt_document_tokens': info.get('prompt_tokens'),
                             'usage_metadata': response_json.get('usage_metadata', {})
                         })
                     })
@@ -655,19 +722,704 @@ def generate_topic_labels(client: bigquery.Client, run_id: str, topic_docs: dict
                 })
             })
     
-    # Insert all labels into the topic_labels table
+    if not store:
+        return rows_to_insert
+
+    # Load (rather than stream) the labels so relabel_topics can MERGE over them right away
     table_id = f"{PROJECT_ID}.{bigquery_dataset_id}.topic_labels"
     
     try:
-        errors = client.insert_rows_json(table_id, rows_to_insert)
-        if errors:
-            raise Exception(f"Errors inserting topic labels: {errors}")
+        load_rows(client, table_id, _loadable_label_rows(rows_to_insert), location=BIGQUERY_LOCATION)
         logger.info(f"Successfully stored labels for {len(rows_to_insert)} topics")
         
     except Exception as e:
         logger.error(f"Error storing topic labels: {e}")
         raise
 
+    return rows_to_insert
+
+def _loadable_label_rows(rows: list[dict]) -> list[dict]:
+    """topic_labels rows for a load job: model_metadata as an object, not a JSON string."""
+    return [
+        {**row, 'model_metadata': json.loads(row['model_metadata']) if row.get('model_metadata') else None}
+        for row in rows
+    ]
+
+def is_usable_label(row: dict) -> bool:
+    """Whether a topic_labels row holds a real label rather than an error placeholder."""
+    return not row['topic_label'].startswith(LABEL_ERROR_PREFIX)
+
+def find_topics_to_relabel(client: bigquery.Client, run_id: str, bigquery_dataset_id: str,
+                           min_confidence: float = RELABEL_MIN_CONFIDENCE) -> dict:
+    """
+    Finds the topics of a run whose latest label is an error placeholder,
+    has a confidence_score below min_confidence, or is missing.
+
+    Returns:
+        Dictionary mapping topic IDs to their latest label row (None if missing)
+    """
+    query = f"""
+    WITH LatestLabels AS (
+        SELECT topic_id, topic_label, confidence_score
+        FROM `{PROJECT_ID}.{bigquery_dataset_id}.topic_labels`
+        WHERE run_id = @run_id
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY topic_id ORDER BY created_at DESC) = 1
+    ),
+    RunTopics AS (
+        SELECT DISTINCT topic_id
+        FROM `{PROJECT_ID}.{bigquery_dataset_id}.document_topic_assignments`
+        WHERE run_id = @run_id
+    )
+    SELECT t.topic_id, l.topic_label, l.confidence_score
+    FROM RunTopics AS t
+    LEFT JOIN LatestLabels AS l USING (topic_id)
+    WHERE l.topic_label IS NULL
+        OR STARTS_WITH(l.topic_label, @error_prefix)
+        OR l.confidence_score < @min_confidence
+    ORDER BY t.topic_id
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("run_id", "STRING", run_id),
+            bigquery.ScalarQueryParameter("error_prefix", "STRING", LABEL_ERROR_PREFIX),
+            bigquery.ScalarQueryParameter("min_confidence", "FLOAT64", min_confidence)
+        ]
+    )
+    results = client.query(query, job_config=job_config, location=BIGQUERY_LOCATION).result()
+    return {
+        row.topic_id: ({'topic_label': row.topic_label, 'confidence_score': row.confidence_score}
+                       if row.topic_label is not None else None)
+        for row in results
+    }
+
+def upsert_topic_labels(client: bigquery.Client, bigquery_dataset_id: str, rows: list[dict]) -> int:
+    """
+    Upserts label rows into topic_labels on (run_id, topic_id).
+
+    Rows are loaded into a staging table and MERGEd. An existing label is only
+    replaced by a usable one that is better: the old one is an error
+    placeholder or has a lower confidence_score. Topics without a label get
+    the row either way.
+
+    Returns:
+        Number of topic_labels rows inserted or updated
+    """
+    if not rows:
+        return 0
+    table_id = f"{PROJECT_ID}.{bigquery_dataset_id}.topic_labels"
+    staging_table_id = f"{PROJECT_ID}.{bigquery_dataset_id}.temp_topic_labels_{rows[0]['run_id']}_{int(time.time())}"
+
+    load_rows(client, staging_table_id, _loadable_label_rows(rows), location=BIGQUERY_LOCATION,
+              schema=client.get_table(table_id).schema,
+              write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    try:
+        merge_sql = f"""
+        MERGE `{table_id}` AS T
+        USING `{staging_table_id}` AS S
+        ON T.run_id = S.run_id AND T.topic_id = S.topic_id
+        WHEN MATCHED AND NOT STARTS_WITH(S.topic_label, @error_prefix)
+            AND (STARTS_WITH(T.topic_label, @error_prefix) OR S.confidence_score > T.confidence_score) THEN
+          UPDATE SET
+            created_at = S.created_at,
+            topic_label = S.topic_label,
+            topic_description = S.topic_description,
+            confidence_score = S.confidence_score,
+            num_documents_used = S.num_documents_used,
+            avg_assignment_score = S.avg_assignment_score,
+            model_metadata = S.model_metadata
+        WHEN NOT MATCHED THEN
+          INSERT ROW
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("error_prefix", "STRING", LABEL_ERROR_PREFIX)
+            ]
+        )
+        merge_job = client.query(merge_sql, job_config=job_config, location=BIGQUERY_LOCATION)
+        merge_job.result()
+        return merge_job.num_dml_affected_rows or 0
+    finally:
+        client.delete_table(staging_table_id, not_found_ok=True)
+
+def relabel_topics(client: bigquery.Client, run_id: str, bigquery_dataset_id: str,
+                   min_confidence: float = RELABEL_MIN_CONFIDENCE,
+                   max_attempts: int = RELABEL_MAX_ATTEMPTS,
+                   labeling_params: dict | None = None,
+                   topic_ids: list[int] | None = None) -> dict:
+    """
+    Regenerates the labels of a run's failed or low-confidence topics only.
+
+    Each attempt labels the topics still lacking a usable label at or above
+    min_confidence; attempts are spaced by exponential backoff with jitter and
+    raise the temperature a little, so a retry does not just repeat the same
+    answer. The best row per topic is upserted into topic_labels.
+
+    Args:
+        client: BigQuery client
+        run_id: The run whose labels are repaired
+        bigquery_dataset_id: The BigQuery dataset ID
+        min_confidence: Labels below this confidence_score are retried
+        max_attempts: Labeling attempts per topic
+        labeling_params: Same options as a clustering request's labeling_params
+        topic_ids: Optional subset of the topics found by find_topics_to_relabel
+
+    Returns:
+        Summary dict of the topics found, relabeled and still failing
+    """
+    labeling_params = labeling_params or {}
+    start = time.perf_counter()
+
+    current = find_topics_to_relabel(client, run_id, bigquery_dataset_id, min_confidence)
+    if topic_ids is not None:
+        current = {topic_id: row for topic_id, row in current.items() if topic_id in set(topic_ids)}
+    summary = {
+        'run_id': run_id,
+        'topics_found': sorted(current),
+        'topics_relabeled': [],
+        'topics_still_failing': [],
+        'attempts': 0,
+        'prompt_tokens': 0,
+        'rows_upserted': 0
+    }
+    if not current:
+        summary['duration_seconds'] = round(time.perf_counter() - start, 2)
+        return summary
+
+    topic_docs = get_top_documents_for_topics(
+        client,
+        run_id,
+        bigquery_dataset_id,
+        num_docs=labeling_params.get('num_docs_per_topic', 30),
+        max_text_length=labeling_params.get('max_text_length'),
+        token_budget=labeling_params.get('token_budget', prompt_packing.DEFAULT_TOKEN_BUDGET),
+        topic_ids=list(current)
+    )
+
+    def is_good(row):
+        return is_usable_label(row) and row['confidence_score'] >= min_confidence
+
+    best = {}
+    pending = [topic_id for topic_id in current if topic_id in topic_docs]
+    for attempt in range(max_attempts):
+        if not pending:
+            break
+        if attempt:
+            delay = RELABEL_BACKOFF_SECONDS * 2 ** (attempt - 1) * random.uniform(1.0, 1.5)
+            logger.info(f"Retrying labels of {len(pending)} topics of run {run_id} in {delay:.1f}s")
+            time.sleep(delay)
+        summary['attempts'] += 1
+        summary['prompt_tokens'] += sum(topic_docs[topic_id]['prompt_tokens'] for topic_id in pending)
+        with scheduler.resource('labeling'):
+            rows = generate_topic_labels(
+                client, run_id, {topic_id: topic_docs[topic_id] for topic_id in pending}, bigquery_dataset_id,
+                temperature=min(0.2 + 0.2 * attempt, 0.8), store=False
+            )
+        for row in rows:
+            previous = best.get(row['topic_id'])
+            if previous is None or (is_usable_label(row) and (
+                    not is_usable_label(previous) or row['confidence_score'] > previous['confidence_score'])):
+                best[row['topic_id']] = row
+        pending = [topic_id for topic_id in pending if not is_good(best[topic_id])]
+
+    # Keep only rows that improve on what topic_labels already has
+    improved = []
+    for topic_id, row in best.items():
+        old = current[topic_id]
+        if old is None or (is_usable_label(row) and (
+                not is_usable_label(old) or row['confidence_score'] > old['confidence_score'])):
+            improved.append(row)
+    summary['rows_upserted'] = upsert_topic_labels(client, bigquery_dataset_id, improved)
+    summary['topics_relabeled'] = sorted(row['topic_id'] for row in improved if is_usable_label(row))
+    summary['topics_still_failing'] = sorted(topic_id for topic_id in current
+                                             if topic_id not in best or not is_good(best[topic_id]))
+    summary['duration_seconds'] = round(time.perf_counter() - start, 2)
+    logger.info(f"Relabeled {len(summary['topics_relabeled'])} of {len(current)} topics of run {run_id} "
+                f"in {summary['attempts']} attempts ({summary['duration_seconds']}s)")
+    return summary
+
+def fetch_unassigned_documents(client: bigquery.Client, run_id: str, bigquery_dataset_id: str,
+                               unified_ids: list | None = None, since_hours: int = 48,
+                               max_items: int = 50000, encoding: str = 'float64') -> tuple[list[dict], np.ndarray]:
+    """
+    Fetches embeddings and metadata of documents not yet assigned in a run.
+
+    Args:
+        client: BigQuery client
+        run_id: The run whose assignments are checked
+        bigquery_dataset_id: The BigQuery dataset ID
+        unified_ids: Optional explicit list of content IDs; otherwise documents
+            embedded within the last since_hours are used
+        since_hours: Look-back window for newly embedded documents
+        max_items: Maximum number of documents to fetch
+        encoding: Embedding column to read (see embedding_codec.py)
+
+    Returns:
+        Tuple of (list of metadata dicts, numpy array of embeddings)
+    """
+    from embedding_codec import EmbeddingCollector, filter_sql, select_sql
+
+    id_filter = "ec.unified_id IN UNNEST(@unified_id_list)" if unified_ids is not None else \
+        "ec.embedding_generated_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @since_hours HOUR)"
+    query = f"""
+    SELECT
+        ec.unified_id,
+        {select_sql(encoding)},
+        v.source,
+        v.content_type,
+        v.content_timestamp,
+        v.primary_text,
+        ec.sentiment_score,
+        ec.sentiment_magnitude
+    FROM
+        `{PROJECT_ID}.{bigquery_dataset_id}.embeddings_cache` AS ec
+    INNER JOIN
+        `{PROJECT_ID}.{bigquery_dataset_id}.unified_social_content_items` AS v
+        ON v.content_item_id = ec.unified_id
+    LEFT JOIN (
+        SELECT DISTINCT unified_id
+        FROM `{PROJECT_ID}.{bigquery_dataset_id}.document_topic_assignments`
+        WHERE run_id = @run_id
+    ) AS assigned
+        ON assigned.unified_id = ec.unified_id
+    WHERE
+        assigned.unified_id IS NULL
+        AND {id_filter}
+        AND {filter_sql(encoding)}
+    LIMIT @max_items
+    """
+
+    query_parameters = [
+        bigquery.ScalarQueryParameter("run_id", "STRING", run_id),
+        bigquery.ScalarQueryParameter("since_hours", "INT64", since_hours),
+        bigquery.ScalarQueryParameter("max_items", "INT64", max_items),
+    ]
+    if unified_ids is not None:
+        query_parameters.append(bigquery.ArrayQueryParameter("unified_id_list", "STRING", unified_ids))
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=query_parameters,
+        labels={'run_id': run_id, 'job_type': 'kmeans_assign_fetch'}
+    )
+
+    documents = []
+    collector = EmbeddingCollector(encoding)
+    for row in client.query(query, job_config=job_config, location=BIGQUERY_LOCATION).result():
+        documents.append({
+            'unified_id': row.unified_id,
+            'source': row.source,
+            'content_type': row.content_type,
+            'content_timestamp': row.content_timestamp.isoformat() if row.content_timestamp else None,
+            'primary_text': row.primary_text,
+            'sentiment_score': row.sentiment_score,
+            'sentiment_magnitude': row.sentiment_magnitude,
+        })
+        collector.add(row)
+
+    return documents, collector.to_array()
+
+def assign_documents_to_run(client: bigquery.Client, run_id: str, bigquery_dataset_id: str,
+                            unified_ids: list | None = None, since_hours: int = 48,
+                            max_items: int = 50000, encoding: str = 'float64') -> dict:
+    """
+    Assigns documents that are not yet part of a run to the run's nearest
+    centroid and adds them to document_topic_assignments.
+
+    Assign requests overlap (each delivery asks for the last since_hours of
+    embeddings), so rows are loaded into a staging table and MERGEd on
+    (run_id, unified_id): documents another request already assigned in the
+    meantime are not inserted twice.
+
+    Returns:
+        Summary dict with the number of documents assigned and the centroid source.
+    """
+    import numpy as np
+    from centroids import assign_to_centroids, get_run_centroids
+
+    documents, embeddings = fetch_unassigned_documents(
+        client, run_id, bigquery_dataset_id, unified_ids, since_hours, max_items, encoding
+    )
+    if not documents:
+        return {'num_assigned': 0, 'centroid_source': None}
+
+    topic_ids, centroids, source = get_run_centroids(
+        client, PROJECT_ID, bigquery_dataset_id, run_id, BIGQUERY_LOCATION, embedding_dim=embeddings.shape[1]
+    )
+    start = time.perf_counter()
+    nearest, distances = assign_to_centroids(embeddings, centroids)
+    assign_ms = round((time.perf_counter() - start) * 1000, 1)
+
+    current_time = datetime.utcnow().isoformat()
+    rows_to_insert = {}
+    for document, centroid_index, distance in zip(documents, nearest, distances):
+        rows_to_insert.setdefault(document['unified_id'], {
+            **document,
+            'run_id': run_id,
+            'assigned_at': current_time,
+            'topic_id': int(topic_ids[centroid_index]),
+            'assignment_score': float(distance),
+        })
+
+    table_id = f"{PROJECT_ID}.{bigquery_dataset_id}.document_topic_assignments"
+    staging_table_id = f"{PROJECT_ID}.{bigquery_dataset_id}.temp_assignments_{run_id}_{int(time.time() * 1000)}"
+    load_rows(client, staging_table_id, list(rows_to_insert.values()), location=BIGQUERY_LOCATION,
+              schema=client.get_table(table_id).schema,
+              write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    try:
+        merge_sql = f"""
+        MERGE `{table_id}` AS T
+        USING `{staging_table_id}` AS S
+        ON T.run_id = S.run_id AND T.unified_id = S.unified_id
+        WHEN NOT MATCHED THEN
+          INSERT ROW
+        """
+        job_config = bigquery.QueryJobConfig(labels={'run_id': run_id, 'job_type': 'kmeans_assign_merge'})
+        merge_job = client.query(merge_sql, job_config=job_config, location=BIGQUERY_LOCATION)
+        merge_job.result()
+        num_assigned = merge_job.num_dml_affected_rows or 0
+    finally:
+        client.delete_table(staging_table_id, not_found_ok=True)
+    logger.info(f"Assigned {num_assigned} of {len(rows_to_insert)} documents to run {run_id} in {assign_ms} ms "
+                f"(centroids from {source})")
+
+    return {
+        'num_assigned': num_assigned,
+        'centroid_source': source,
+        'assign_ms': assign_ms,
+        'topic_counts': {
+            str(topic_id): int(count)
+            for topic_id, count in zip(*np.unique(topic_ids[nearest], return_counts=True))
+        },
+    }
+
+def update_topic_rollups(client: bigquery.Client, bigquery_dataset_id: str) -> dict:
+    """Refreshes topic_daily_rollup after new assignments; failures are reported, not raised."""
+    from rollups import refresh_topic_rollups
+
+    try:
+        return {'status': 'success', **refresh_topic_rollups(client, PROJECT_ID, bigquery_dataset_id, BIGQUERY_LOCATION)}
+    except Exception as e:
+        logger.error(f"Error refreshing topic rollups: {e}")
+        return {'status': 'error', 'message': str(e)}
+
+def handle_rollup_request(client: bigquery.Client, request_json: dict, bigquery_dataset_id: str):
+    """Handles a perform_kmeans request with "mode": "rollup"."""
+    from rollups import refresh_topic_rollups
+
+    run_ids = request_json.get('run_ids')
+    if run_ids is not None and not isinstance(run_ids, list):
+        return jsonify({
+            'status': 'error',
+            'message': 'run_ids must be a list of strings'
+        }), 400
+
+    try:
+        summary = refresh_topic_rollups(client, PROJECT_ID, bigquery_dataset_id, BIGQUERY_LOCATION, run_ids=run_ids)
+        return jsonify({
+            'status': 'success',
+            'message': f"Recomputed {summary['touched_groups']} run/day groups",
+            'rollup_table': f"{PROJECT_ID}.{bigquery_dataset_id}.topic_daily_rollup",
+            **summary
+        }), 200
+    except Exception as e:
+        logger.error(f"Error refreshing topic rollups: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Error refreshing topic rollups: {str(e)}'
+        }), 500
+
+def handle_align_request(client: bigquery.Client, request_json: dict, bigquery_dataset_id: str):
+    """Handles a perform_kmeans request with "mode": "align"."""
+    from topic_alignment import DEFAULT_MIN_SIMILARITY, DEFAULT_SECONDARY_THRESHOLD, align_runs
+
+    run_ids = request_json.get('run_ids')
+    if not isinstance(run_ids, list) or len(run_ids) < 2:
+        return jsonify({
+            'status': 'error',
+            'message': 'run_ids must be a list of at least two run IDs for mode "align"'
+        }), 400
+
+    try:
+        start = time.perf_counter()
+        pairs = align_runs(
+            client,
+            PROJECT_ID,
+            bigquery_dataset_id,
+            run_ids,
+            BIGQUERY_LOCATION,
+            min_similarity=float(request_json.get('min_similarity', DEFAULT_MIN_SIMILARITY)),
+            secondary_threshold=float(request_json.get('secondary_threshold', DEFAULT_SECONDARY_THRESHOLD)),
+            persist=request_json.get('persist', True)
+        )
+        return jsonify({
+            'status': 'success',
+            'message': f"Aligned {len(pairs)} run pairs",
+            'alignments_table': f"{PROJECT_ID}.{bigquery_dataset_id}.topic_alignments",
+            'pairs': pairs,
+            'duration_seconds': round(time.perf_counter() - start, 2)
+        }), 200
+    except Exception as e:
+        logger.error(f"Error aligning runs {run_ids}: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Error aligning runs: {str(e)}'
+        }), 500
+
+def handle_gc_models_request(client: bigquery.Client, request_json: dict, bigquery_dataset_id: str):
+    """Handles a perform_kmeans request with "mode": "gc_models"."""
+    from run_reuse import gc_temp_models
+
+    try:
+        summary = gc_temp_models(
+            client,
+            PROJECT_ID,
+            bigquery_dataset_id,
+            KMEANS_RUNS_TABLE,
+            BIGQUERY_LOCATION,
+            dry_run=bool(request_json.get('dry_run', False))
+        )
+        return jsonify({
+            'status': 'success',
+            'message': f"{'Found' if summary['dry_run'] else 'Deleted'} {len(summary['deleted'])} unreferenced temp models",
+            **summary
+        }), 200
+    except Exception as e:
+        logger.error(f"Error collecting temp models: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Error collecting temp models: {str(e)}'
+        }), 500
+
+def handle_relabel_request(client: bigquery.Client, request_json: dict, bigquery_dataset_id: str):
+    """Handles a perform_kmeans request with "mode": "relabel"."""
+    run_id = request_json.get('run_id')
+    if not isinstance(run_id, str) or not run_id:
+        return jsonify({
+            'status': 'error',
+            'message': 'run_id is required for mode "relabel"'
+        }), 400
+    topic_ids = request_json.get('topic_ids')
+    if topic_ids is not None and not isinstance(topic_ids, list):
+        return jsonify({
+            'status': 'error',
+            'message': 'topic_ids must be a list of integers'
+        }), 400
+
+    try:
+        summary = relabel_topics(
+            client,
+            run_id,
+            bigquery_dataset_id,
+            min_confidence=float(request_json.get('min_confidence', RELABEL_MIN_CONFIDENCE)),
+            max_attempts=max(1, int(request_json.get('max_attempts', RELABEL_MAX_ATTEMPTS))),
+            labeling_params=request_json.get('labeling_params', {}),
+            topic_ids=[int(topic_id) for topic_id in topic_ids] if topic_ids is not None else None
+        )
+        return jsonify({
+            'status': 'success',
+            'message': f"Relabeled {len(summary['topics_relabeled'])} of {len(summary['topics_found'])} topics",
+            'labels_table': f"{PROJECT_ID}.{bigquery_dataset_id}.topic_labels",
+            **summary
+        }), 200
+    except Exception as e:
+        logger.error(f"Error relabeling run {run_id}: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Error relabeling topics: {str(e)}'
+        }), 500
+
+def handle_status_request():
+    """Handles a perform_kmeans request with "mode": "status"."""
+    return jsonify({
+        'status': 'success',
+        **scheduler.status()
+    }), 200
+
+def handle_multi_k_request(client: bigquery.Client, request_json: dict, bigquery_dataset_id: str):
+    """Handles a perform_kmeans request whose n_clusters is a list."""
+    from multi_k import run_multi_k
+
+    ids = request_json['ids']
+    n_clusters_list = list(dict.fromkeys(request_json['n_clusters']))
+    if not ids or not isinstance(ids, list):
+        return jsonify({
+            'status': 'error',
+            'message': 'ids must be a non-empty list of strings'
+        }), 400
+    if not n_clusters_list or len(n_clusters_list) > MAX_SIBLING_RUNS or \
+            not all(isinstance(k, int) and k >= 2 for k in n_clusters_list):
+        return jsonify({
+            'status': 'error',
+            'message': f'n_clusters must be an integer greater than 1 or a list of up to '
+                       f'{MAX_SIBLING_RUNS} such integers'
+        }), 400
+
+    skip_umap = request_json.get('skip_umap', False)
+    skip_labeling = request_json.get('skip_labeling', False)
+    umap_params = request_json.get('umap_params', {})
+    labeling_params = request_json.get('labeling_params', {})
+    logger.info(f"Received {len(ids)} IDs for processing with n_clusters={n_clusters_list}")
+
+    ticket = None
+    try:
+        start = time.perf_counter()
+        ticket = scheduler.admit(request_json.get('requested_by'), f"multi-k k={n_clusters_list} n={len(ids)}")
+        summary = run_multi_k(
+            client,
+            PROJECT_ID,
+            bigquery_dataset_id,
+            KMEANS_RUNS_TABLE,
+            ids,
+            n_clusters_list,
+            BIGQUERY_LOCATION,
+            EMBEDDING_MODEL,
+            description=request_json.get('description'),
+            force_new=request_json.get('force_new', False),
+            encoding=request_json.get('embedding_encoding', EMBEDDING_ENCODING)
+        )
+        runs = summary['runs']
+        new_run_ids = [run['run_id'] for run in runs if not run['reused']]
+        documents = summary['documents']
+
+        # UMAP depends only on the embeddings, so every sibling shares one layout
+        umap_response = None
+        if new_run_ids and not skip_umap:
+            try:
+                coordinates = perform_umap_reduction(
+                    summary['embeddings'],
+                    n_neighbors=umap_params.get('n_neighbors', 10),
+                    min_dist=umap_params.get('min_dist', 0.0),
+                    metric=umap_params.get('metric', 'cosine'),
+                    n_components=umap_params.get('n_components', 2)
+                )
+                created_at = datetime.utcnow().isoformat()
+                coordinate_rows = [
+                    {
+                        'run_id': run_id,
+                        'unified_id': document['unified_id'],
+                        'umap_x': float(coordinates[i, 0]),
+                        'umap_y': float(coordinates[i, 1]),
+                        'created_at': created_at
+                    }
+                    for run_id in new_run_ids
+                    for i, document in enumerate(documents)
+                ]
+                load_rows(client, f"{PROJECT_ID}.{bigquery_dataset_id}.document_umap_coordinates",
+                          coordinate_rows, BIGQUERY_LOCATION)
+                umap_response = {'status': 'success', 'processed_ids': len(documents)}
+            except Exception as e:
+                logger.error(f"Error in UMAP reduction: {e}")
+                umap_response = {'status': 'error', 'message': str(e)}
+
+        if new_run_ids:
+            update_sql = f"""
+            UPDATE `{KMEANS_RUNS_TABLE}`
+            SET status = 'completed'
+            WHERE run_id IN UNNEST(@run_ids)
+            """
+            update_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ArrayQueryParameter("run_ids", "STRING", new_run_ids)
+            ])
+            client.query(update_sql, job_config=update_config, location=BIGQUERY_LOCATION).result()
+
+        for run in runs:
+            if run['reused'] or skip_labeling:
+                continue
+            try:
+                with scheduler.resource('labeling'):
+                    topic_docs = get_top_documents_for_topics(
+                        client,
+                        run['run_id'],
+                        bigquery_dataset_id,
+                        num_docs=labeling_params.get('num_docs_per_topic', 30),
+                        max_text_length=labeling_params.get('max_text_length'),
+                        token_budget=labeling_params.get('token_budget', prompt_packing.DEFAULT_TOKEN_BUDGET)
+                    )
+                    generate_topic_labels(client, run['run_id'], topic_docs, bigquery_dataset_id)
+                run['topic_labeling'] = {
+                    'status': 'success',
+                    'num_topics_labeled': len(topic_docs),
+                    'prompt_tokens': sum(info['prompt_tokens'] for info in topic_docs.values())
+                }
+            except Exception as e:
+                logger.error(f"Error in topic labeling for run {run['run_id']}: {e}")
+                run['topic_labeling'] = {'status': 'error', 'message': str(e)}
+
+        response_data = {
+            'status': 'success',
+            'message': f"Completed {len(new_run_ids)} K-means runs, reused {len(runs) - len(new_run_ids)}",
+            'runs': runs,
+            'predictions_table': f"{PROJECT_ID}.{bigquery_dataset_id}.document_topic_assignments",
+            'timings': {**summary['timings'], 'total_seconds': round(time.perf_counter() - start, 2)},
+            'scheduling': ticket.summary(),
+            'input_summary': {
+                'num_ids': len(ids),
+                'n_clusters': n_clusters_list
+            }
+        }
+        if new_run_ids:
+            response_data['topic_rollups'] = update_topic_rollups(client, bigquery_dataset_id)
+        if not skip_umap:
+            response_data['umap_reduction'] = umap_response
+        return jsonify(response_data), 200
+
+    except scheduler.AdmissionRejected as e:
+        logger.warning(f"Multi-K run not admitted: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Instance busy, retry later: {str(e)}',
+            'queue': scheduler.status()['admission']
+        }), 429, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        logger.error(f"Error in multi-K request: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Error processing request: {str(e)}'
+        }), 500
+    finally:
+        if ticket is not None:
+            scheduler.release(ticket)
+
+def handle_assign_request(client: bigquery.Client, request_json: dict, bigquery_dataset_id: str):
+    """Handles a perform_kmeans request with "mode": "assign"."""
+    run_id = request_json.get('run_id')
+    if not run_id:
+        return jsonify({
+            'status': 'error',
+            'message': 'run_id is required for mode "assign"'
+        }), 400
+
+    ids = request_json.get('ids')
+    if ids is not None and not isinstance(ids, list):
+        return jsonify({
+            'status': 'error',
+            'message': 'ids must be a list of strings'
+        }), 400
+
+    try:
+        summary = assign_documents_to_run(
+            client,
+            run_id,
+            bigquery_dataset_id,
+            unified_ids=ids,
+            since_hours=int(request_json.get('since_hours', 48)),
+            max_items=int(request_json.get('max_items', 50000)),
+            encoding=request_json.get('embedding_encoding', EMBEDDING_ENCODING)
+        )
+        if summary['num_assigned'] and request_json.get('update_rollups', True):
+            summary['rollups'] = update_topic_rollups(client, bigquery_dataset_id)
+        return jsonify({
+            'status': 'success',
+            'message': f"Assigned {summary['num_assigned']} documents to run {run_id}",
+            'run_id': run_id,
+            'predictions_table': f"{PROJECT_ID}.{bigquery_dataset_id}.document_topic_assignments",
+            **summary
+        }), 200
+    except Exception as e:
+        logger.error(f"Error assigning documents to run {run_id}: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Error assigning documents: {str(e)}'
+        }), 500
+
 @functions_framework.http
 def perform_kmeans(request):
     """
@@ -676,7 +1428,7 @@ def perform_kmeans(request):
     Expected input format (POST request JSON body):
     {
         "ids": ["id1", "id2", "id3", ...],  # Required: List of content IDs to cluster
-        "n_clusters": 5,                     # Optional: Number of clusters (default: 5, min: 2)
+        "n_clusters": 5,                     # Optional: Number of clusters (default: 5, min: 2), or a list
         "wait_for_completion": true,         # Optional: Whether to wait for completion (default: true)
         "skip_umap": false,                  # Optional: Whether to skip UMAP reduction (default: false)
         "skip_labeling": false,              # Optional: Whether to skip topic labeling (default: false)
@@ -687,25 +1439,103 @@ def perform_kmeans(request):
             "n_components": 2
         },
         "labeling_params": {                 # Optional: Topic labeling parameters
-            "num_docs_per_topic": 10,        # Number of top documents to use per topic
-            "max_text_length": 500          # Maximum length of each document text
+            "token_budget": 1000,            # Estimated prompt tokens for each topic's documents
+            "num_docs_per_topic": 30,        # Maximum number of documents per topic
+            "max_text_length": 600           # Maximum characters per document (cut on a sentence boundary)
         },
-        "description": "Optional description for the run"
+        "description": "Optional description for the run",
+        "requested_by": "alice",             # Optional: fair-queueing key when the instance is busy
+        "force_new": false,                  # Optional: train even if an identical run exists
+        "embedding_encoding": "float64"      # Optional: embeddings read for UMAP/multi-K: float64, int8 or float16
+    }
+
+    A request with the same ID set and n_clusters as an earlier completed (or
+    still running) run returns that run with "reused": true instead of
+    training again (see run_reuse.py).
+
+    "n_clusters" may also be a list such as [5, 10, 20]: the embeddings are
+    loaded once, one model per K is fitted concurrently in worker processes,
+    and the results are written as sibling runs sharing one UMAP layout (see
+    multi_k.py). Such requests always wait for completion.
+
+    With "mode": "assign", no new model is trained. Documents not yet in
+    document_topic_assignments for "run_id" - the given "ids", or everything
+    embedded in the last "since_hours" (default 48) - are assigned to the
+    run's nearest centroid (see centroids.py):
+    {
+        "mode": "assign",
+        "run_id": "kmeans_run_...",
+        "ids": ["id1", ...],          # Optional
+        "since_hours": 48,            # Optional
+        "max_items": 50000,           # Optional
+        "embedding_encoding": "int8", # Optional: float64 (default), int8 or float16
+        "update_rollups": true        # Optional: refresh topic_daily_rollup afterwards
+    }
+
+    With "mode": "rollup", topic_daily_rollup is refreshed for assignments
+    made since the last refresh (see rollups.py); "run_ids" optionally limits
+    the refresh to some runs. Completed runs and assignments refresh it too.
+
+    With "mode": "align", the topics of each consecutive pair of runs are
+    mapped onto each other by centroid similarity (see topic_alignment.py)
+    and stored in topic_alignments:
+    {
+        "mode": "align",
+        "run_ids": ["kmeans_run_a", "kmeans_run_b", ...],
+        "min_similarity": 0.5,        # Optional: weaker pairs count as unmatched
+        "secondary_threshold": 0.75,  # Optional: similarity for split/merge notes
+        "persist": true               # Optional
+    }
+
+    With "mode": "gc_models" (for Cloud Scheduler), unreferenced temp models
+    are deleted (see run_reuse.py); "dry_run": true only lists them.
+
+    With "mode": "relabel", only the topics of an existing run whose label is
+    an error placeholder, missing, or below min_confidence are labeled again
+    (with retries), and the better labels are upserted into topic_labels:
+    {
+        "mode": "relabel",
+        "run_id": "kmeans_run_...",
+        "min_confidence": 0.5,   # Optional
+        "max_attempts": 3,       # Optional
+        "topic_ids": [3, 7],     # Optional: restrict to these topics
+        "labeling_params": {}    # Optional: as for clustering requests
     }
+
+    Runs that are waited for (and multi-K requests) are admitted through a
+    per-instance fair queue with limits on concurrent BigQuery, UMAP and
+    labeling work (see scheduler.py). A run that cannot be queued or admitted
+    in time gets a 429 with Retry-After. {"mode": "status"} returns the
+    queue depth, resource usage and wait times of the instance.
     """
     # Get environment variables
     bigquery_dataset_id = os.getenv('BIGQUERY_DATASET_ID')
 
-    # Initialize clients
-    client = bigquery.Client()
+    # Shared client, reused across requests on a warm instance
+    client = get_bigquery_client(PROJECT_ID)
 
     # Get request parameters
     request_json = request.get_json(silent=True)
+    if request_json and request_json.get('mode') == 'assign':
+        return handle_assign_request(client, request_json, bigquery_dataset_id)
+    if request_json and request_json.get('mode') == 'rollup':
+        return handle_rollup_request(client, request_json, bigquery_dataset_id)
+    if request_json and request_json.get('mode') == 'align':
+        return handle_align_request(client, request_json, bigquery_dataset_id)
+    if request_json and request_json.get('mode') == 'gc_models':
+        return handle_gc_models_request(client, request_json, bigquery_dataset_id)
+    if request_json and request_json.get('mode') == 'relabel':
+        return handle_relabel_request(client, request_json, bigquery_dataset_id)
+    if request_json and request_json.get('mode') == 'status':
+        return handle_status_request()
+
     if not request_json or 'ids' not in request_json:
         return jsonify({
             'status': 'error',
             'message': 'Request must include ids list. Example: {"ids": ["id_123", "id_456"]}'
         }), 400
+    if isinstance(request_json.get('n_clusters'), list):
+        return handle_multi_k_request(client, request_json, bigquery_dataset_id)
 
     ids = request_json['ids']
     n_clusters = request_json.get('n_clusters', 5)
@@ -731,16 +1561,47 @@ def perform_kmeans(request):
 
     logger.info(f"Received {len(ids)} IDs for processing with {n_clusters} clusters")
 
+    ticket = None
     try:
+        from run_reuse import find_reusable_run, run_fingerprint
+
+        fingerprint = run_fingerprint(ids, n_clusters, EMBEDDING_MODEL, KMEANS_TRAINING_OPTIONS)
+        if not request_json.get('force_new', False):
+            prior_run = find_reusable_run(client, KMEANS_RUNS_TABLE, fingerprint, BIGQUERY_LOCATION)
+            if prior_run:
+                logger.info(f"Reusing run {prior_run['run_id']} ({prior_run['status']}) for fingerprint {fingerprint}")
+                return jsonify({
+                    'status': 'success',
+                    'message': f"Identical run {prior_run['run_id']} already exists "
+                               f"({prior_run['status']}); pass force_new to train again",
+                    'reused': True,
+                    'run_id': prior_run['run_id'],
+                    'run_status': prior_run['status'],
+                    'created_at': prior_run['created_at'],
+                    'predict_job_id': prior_run['predict_job_id'],
+                    'predictions_table': f"{PROJECT_ID}.{bigquery_dataset_id}.document_topic_assignments",
+                    'fingerprint': fingerprint,
+                    'input_summary': {
+                        'num_ids': len(ids),
+                        'n_clusters': n_clusters
+                    }
+                }), 200
+
+        # A run that is waited for holds one of this instance's run slots
+        # until it finishes; queued runs are admitted fairly (see scheduler.py)
+        if wait_for_completion:
+            ticket = scheduler.admit(request_json.get('requested_by'), f"kmeans k={n_clusters} n={len(ids)}")
+
         # Submit the K-means clustering job
-        result = create_kmeans_model_job(ids, n_clusters, bigquery_dataset_id, description)
+        result = create_kmeans_model_job(ids, n_clusters, bigquery_dataset_id, description, fingerprint)
         run_id = result['run_id']
         model_creation_job_id = result['job_id']
         
         if wait_for_completion:
             # Wait for model creation job to complete
-            model_creation_job = client.get_job(model_creation_job_id, location=BIGQUERY_LOCATION)
-            model_creation_job.result()
+            with scheduler.resource('bigquery'):
+                model_creation_job = client.get_job(model_creation_job_id, location=BIGQUERY_LOCATION)
+                model_creation_job.result()
             
             # Update status to model_created
             update_sql = f"""
@@ -758,12 +1619,13 @@ def perform_kmeans(request):
             update_job = client.query(update_sql, job_config=update_config, location=BIGQUERY_LOCATION)
             update_job.result()
             
-            # Run prediction job
-            predict_job_id = run_prediction_job(client, run_id, ids, bigquery_dataset_id)
-            
-            # Wait for prediction job to complete
-            predict_job = client.get_job(predict_job_id, location=BIGQUERY_LOCATION)
-            predict_job.result()
+            with scheduler.resource('bigquery'):
+                # Run prediction job
+                predict_job_id = run_prediction_job(client, run_id, ids, bigquery_dataset_id)
+
+                # Wait for prediction job to complete
+                predict_job = client.get_job(predict_job_id, location=BIGQUERY_LOCATION)
+                predict_job.result()
             
             # Update status to prediction completed
             update_sql = f"""
@@ -774,13 +1636,20 @@ def perform_kmeans(request):
             
             update_job = client.query(update_sql, job_config=update_config, location=BIGQUERY_LOCATION)
             update_job.result()
+
+            # Bring the dashboard rollups up to date with the new assignments
+            rollup_response = update_topic_rollups(client, bigquery_dataset_id)
             
             # Perform UMAP reduction if not skipped
             umap_response = None
             if not skip_umap:
                 try:
                     # Fetch embeddings
-                    valid_ids, embeddings = fetch_embeddings(client, ids, bigquery_dataset_id)
+                    with scheduler.resource('bigquery'):
+                        valid_ids, embeddings = fetch_embeddings(
+                            client, ids, bigquery_dataset_id,
+                            encoding=request_json.get('embedding_encoding', EMBEDDING_ENCODING)
+                        )
                     
                     if len(valid_ids) < len(ids):
                         logger.warning(f"Only found embeddings for {len(valid_ids)} out of {len(ids)} IDs")
@@ -825,22 +1694,25 @@ def perform_kmeans(request):
             
             if not skip_labeling and wait_for_completion:
                 try:
-                    # Get top documents for each topic
-                    topic_docs = get_top_documents_for_topics(
-                        client, 
-                        run_id, 
-                        bigquery_dataset_id,
-                        num_docs=labeling_params.get('num_docs_per_topic', 10),
-                        max_text_length=labeling_params.get('max_text_length', 500)
-                    )
-                    
-                    # Generate and store topic labels
-                    generate_topic_labels(client, run_id, topic_docs, bigquery_dataset_id)
+                    with scheduler.resource('labeling'):
+                        # Get top documents for each topic
+                        topic_docs = get_top_documents_for_topics(
+                            client,
+                            run_id,
+                            bigquery_dataset_id,
+                            num_docs=labeling_params.get('num_docs_per_topic', 30),
+                            max_text_length=labeling_params.get('max_text_length'),
+                            token_budget=labeling_params.get('token_budget', prompt_packing.DEFAULT_TOKEN_BUDGET)
+                        )
+
+                        # Generate and store topic labels
+                        generate_topic_labels(client, run_id, topic_docs, bigquery_dataset_id)
                     
                     labeling_response = {
                         'status': 'success',
                         'message': 'Topic labeling completed successfully',
-                        'num_topics_labeled': len(topic_docs)
+                        'num_topics_labeled': len(topic_docs),
+                        'prompt_tokens': sum(info['prompt_tokens'] for info in topic_docs.values())
                     }
                     
                 except Exception as e:
@@ -858,6 +1730,8 @@ def perform_kmeans(request):
                 'model_creation_job_id': model_creation_job_id,
                 'predict_job_id': predict_job_id,
                 'predictions_table': f"{PROJECT_ID}.{bigquery_dataset_id}.document_topic_assignments",
+                'topic_rollups': rollup_response,
+                'scheduling': ticket.summary(),
                 'input_summary': {
                     'num_ids': len(ids),
                     'n_clusters': n_clusters
@@ -887,10 +1761,20 @@ def perform_kmeans(request):
             }
         }), 200
 
+    except scheduler.AdmissionRejected as e:
+        logger.warning(f"Run not admitted: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': f'Instance busy, retry later: {str(e)}',
+            'queue': scheduler.status()['admission']
+        }), 429, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         logger.error(f"Error in perform_kmeans: {str(e)}")
         return jsonify({
             'status': 'error',
             'message': f'Error processing request: {str(e)}'
         }), 500
+    finally:
+        if ticket is not None:
+            scheduler.release(ticket)
 
@@ -0,0 +1,199 @@
+"""
+Several K-means runs over the same documents in one request.
+
+For n_clusters: [5, 10, 20] the documents and their embeddings are fetched
+once, the models are fitted concurrently by kmeans_pool.cluster_many, and the
+results are written as sibling runs (kmeans_run_<timestamp>_<K>, sharing the
+timestamp): one load job for all assignments and one for all kmeans_runs rows.
+The fit holds the scheduler's 'cpu' slot, so concurrent multi-K requests do not
+each start a pool of one process per core.
+The models are trained locally rather than with BigQuery ML, so each run's
+centroids are saved as an artifact (see centroids.py) for later assignment and
+alignment.
+"""
+from __future__ import annotations
+
+import logging
+import time
+from datetime import datetime
+
+import numpy as np
+from google.cloud import bigquery
+
+from centroids import save_centroid_artifact
+from embedding_codec import EmbeddingCollector, filter_sql, select_sql
+from kmeans_pool import DEFAULT_MAX_ITER, DEFAULT_N_INIT, cluster_many
+from run_reuse import find_reusable_run, run_fingerprint
+from runtime import load_rows
+import scheduler
+
+logger = logging.getLogger(__name__)
+
+# Training options of locally fitted runs; part of their fingerprints
+LOCAL_TRAINING_OPTIONS = {
+    'engine': 'sklearn',
+    'n_init': DEFAULT_N_INIT,
+    'max_iter': DEFAULT_MAX_ITER,
+    'distance_type': 'COSINE',
+}
+
+
+def fetch_documents(client: bigquery.Client, project_id: str, bigquery_dataset_id: str, unified_ids: list,
+                    location: str, encoding: str = 'float64') -> tuple[list[dict], np.ndarray]:
+    """
+    Fetches assignment metadata and embeddings of the given documents in one query.
+
+    Args:
+        encoding: Embedding column to read (see embedding_codec.py).
+
+    Returns:
+        Tuple of (list of metadata dicts, float32 numpy array of embeddings)
+    """
+    query = f"""
+    SELECT
+        ec.unified_id,
+        {select_sql(encoding)},
+        v.source,
+        v.content_type,
+        v.content_timestamp,
+        v.primary_text,
+        ec.sentiment_score,
+        ec.sentiment_magnitude
+    FROM
+        `{project_id}.{bigquery_dataset_id}.embeddings_cache` AS ec
+    INNER JOIN
+        `{project_id}.{bigquery_dataset_id}.unified_social_content_items` AS v
+        ON v.content_item_id = ec.unified_id
+    WHERE
+        ec.unified_id IN UNNEST(@unified_id_list)
+        AND {filter_sql(encoding)}
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("unified_id_list", "STRING", unified_ids)
+    ])
+
+    documents = []
+    collector = EmbeddingCollector(encoding)
+    seen = set()
+    for row in client.query(query, job_config=job_config, location=location).result():
+        if row.unified_id in seen:
+            continue
+        seen.add(row.unified_id)
+        documents.append({
+            'unified_id': row.unified_id,
+            'source': row.source,
+            'content_type': row.content_type,
+            'content_timestamp': row.content_timestamp.isoformat() if row.content_timestamp else None,
+            'primary_text': row.primary_text,
+            'sentiment_score': row.sentiment_score,
+            'sentiment_magnitude': row.sentiment_magnitude,
+        })
+        collector.add(row)
+
+    return documents, collector.to_array()
+
+
+def run_multi_k(client: bigquery.Client, project_id: str, bigquery_dataset_id: str, runs_table: str,
+                unified_ids: list, n_clusters_list: list[int], location: str, embedding_model: str,
+                description: str | None = None, force_new: bool = False, encoding: str = 'float64') -> dict:
+    """
+    Clusters the documents once per K and writes the results as sibling runs.
+
+    K values with an identical earlier run (same fingerprint) reuse it unless
+    force_new is set. encoding selects the embedding column read (see
+    embedding_codec.py).
+
+    Returns:
+        Dict with 'runs' (one summary per K, in request order), the fetched
+        documents and embeddings (for UMAP) and timings.
+    """
+    timings = {}
+    fingerprints = {
+        k: run_fingerprint(unified_ids, k, embedding_model, {**LOCAL_TRAINING_OPTIONS, 'encoding': encoding})
+        for k in n_clusters_list
+    }
+    reused = {}
+    if not force_new:
+        for k, fingerprint in fingerprints.items():
+            prior_run = find_reusable_run(client, runs_table, fingerprint, location)
+            if prior_run:
+                reused[k] = prior_run
+
+    to_train = [k for k in n_clusters_list if k not in reused]
+    documents, embeddings, results = [], np.empty((0, 0), dtype=np.float32), []
+    if to_train:
+        start = time.perf_counter()
+        documents, embeddings = fetch_documents(client, project_id, bigquery_dataset_id, unified_ids, location,
+                                               encoding)
+        timings['fetch_seconds'] = round(time.perf_counter() - start, 2)
+        if len(documents) <= max(to_train):
+            raise ValueError(f"Found embeddings for {len(documents)} documents; "
+                             f"need more than the largest K ({max(to_train)})")
+
+        start = time.perf_counter()
+        with scheduler.resource('cpu'):
+            results = cluster_many(embeddings, to_train)
+        timings['cluster_seconds'] = round(time.perf_counter() - start, 2)
+
+    group_timestamp = int(time.time())
+    created_at = datetime.utcnow().isoformat()
+    run_rows = []
+    assignment_rows = []
+    runs = {}
+    for result in results:
+        k = result['n_clusters']
+        run_id = f"kmeans_run_{group_timestamp}_{k}"
+        # 1-based topic IDs, as BigQuery ML numbers its centroids
+        topic_ids = np.arange(1, k + 1, dtype=np.int64)
+        try:
+            save_centroid_artifact(run_id, topic_ids, result['centroids'])
+        except Exception as e:
+            # assign and align fall back to the mean embedding of each topic
+            logger.warning(f"Could not save centroid artifact for run {run_id}: {e}")
+        run_rows.append({
+            'run_id': run_id,
+            'created_at': created_at,
+            'num_topics': k,
+            'description': description,
+            'status': 'prediction_completed',
+            'embedding_model': embedding_model,
+            'fingerprint': fingerprints[k],
+        })
+        for document, label, distance in zip(documents, result['labels'], result['distances']):
+            assignment_rows.append({
+                **document,
+                'run_id': run_id,
+                'assigned_at': created_at,
+                'topic_id': int(topic_ids[label]),
+                'assignment_score': float(distance),
+            })
+        runs[k] = {
+            'run_id': run_id,
+            'n_clusters': k,
+            'reused': False,
+            'inertia': result['inertia'],
+            'fit_seconds': result['fit_seconds'],
+        }
+
+    if results:
+        start = time.perf_counter()
+        load_rows(client, f"{project_id}.{bigquery_dataset_id}.document_topic_assignments", assignment_rows,
+                  location)
+        load_rows(client, runs_table, run_rows, location)
+        timings['write_seconds'] = round(time.perf_counter() - start, 2)
+
+    for k, prior_run in reused.items():
+        runs[k] = {
+            'run_id': prior_run['run_id'],
+            'n_clusters': k,
+            'reused': True,
+            'run_status': prior_run['status'],
+        }
+
+    logger.info(f"Multi-K request for K={n_clusters_list}: trained {to_train}, reused {sorted(reused)}; {timings}")
+    return {
+        'runs': [runs[k] for k in n_clusters_list],
+        'documents': documents,
+        'embeddings': embeddings,
+        'timings': timings,
+    }
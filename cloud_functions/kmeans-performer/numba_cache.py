@@ -0,0 +1,51 @@
+"""
+Persistent numba cache for UMAP.
+
+umap and pynndescent JIT-compile their kernels with numba on first use. The
+kernels declared with cache=True can be loaded from disk instead, so
+warmup_numba.py runs a small UMAP fit at build time to fill NUMBA_CACHE_DIR.
+The deployed source directory is read-only at runtime, so the prebuilt cache
+is copied to a writable location on first use.
+"""
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+# Cache directory filled at build time, shipped next to main.py
+BUNDLED_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.numba_cache')
+
+# Writable location used at runtime
+RUNTIME_CACHE_DIR = os.environ.get('NUMBA_RUNTIME_CACHE_DIR', '/tmp/numba_cache')
+
+_configured = False
+
+
+def configure_numba_cache(cache_dir=None):
+    """
+    Sets NUMBA_CACHE_DIR before numba is imported.
+
+    Args:
+        cache_dir: Explicit cache directory (used by the build-time warm-up).
+            Defaults to a writable copy of the bundled cache.
+
+    Returns:
+        The cache directory in use.
+    """
+    global _configured
+    if 'NUMBA_CACHE_DIR' in os.environ and (_configured or cache_dir is None):
+        return os.environ['NUMBA_CACHE_DIR']
+
+    if cache_dir is None:
+        cache_dir = BUNDLED_CACHE_DIR
+        if not os.access(BUNDLED_CACHE_DIR, os.W_OK):
+            cache_dir = RUNTIME_CACHE_DIR
+            if os.path.isdir(BUNDLED_CACHE_DIR) and not os.path.isdir(RUNTIME_CACHE_DIR):
+                shutil.copytree(BUNDLED_CACHE_DIR, RUNTIME_CACHE_DIR)
+                logger.info(f"Copied prebuilt numba cache to {RUNTIME_CACHE_DIR}")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['NUMBA_CACHE_DIR'] = cache_dir
+    _configured = True
+    return cache_dir
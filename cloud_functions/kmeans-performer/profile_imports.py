@@ -0,0 +1,77 @@
+"""
+Import-time profile of the K-means performer.
+
+Runs `python -X importtime` on main.py (and optionally on the heavy lazily
+imported modules) in a fresh interpreter and reports the total import time
+and the slowest top-level packages, so cold-start cost can be tracked as
+dependencies change.
+
+Usage:
+    python profile_imports.py [--top 15] [--json report.json]
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+_LINE_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+# Modules main.py imports only on the code paths that need them
+LAZY_MODULES = ['numpy', 'umap']
+
+
+def profile(module):
+    """Returns (total_us, {top-level package: self time in us}) for importing `module`."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    # Lazy modules are imported the way main.py does it: after pointing numba at its cache
+    code = f'import {module}'
+    if module in LAZY_MODULES:
+        code = f'from numba_cache import configure_numba_cache; configure_numba_cache(); {code}'
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=here, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{completed.stderr[-2000:]}")
+
+    per_package = defaultdict(int)
+    total_us = 0
+    for line in completed.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match.group(1)), int(match.group(2)), match.group(3), match.group(4)
+        per_package[name.split('.')[0]] += self_us
+        if len(indent) == 1:  # top-level import of this interpreter
+            total_us += cumulative_us
+    return total_us, dict(per_package)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--json', help="Write the report to this file")
+    args = parser.parse_args()
+
+    report = {}
+    for module in ['main'] + LAZY_MODULES:
+        total_us, per_package = profile(module)
+        slowest = sorted(per_package.items(), key=lambda item: item[1], reverse=True)[:args.top]
+        report[module] = {'total_ms': round(total_us / 1000, 1),
+                          'slowest_packages_ms': {name: round(us / 1000, 1) for name, us in slowest}}
+
+        label = 'cold start (import main)' if module == 'main' else f'lazy import {module}'
+        print(f"{label}: {total_us / 1000:.0f} ms")
+        for name, us in slowest:
+            print(f"    {name:<32} {us / 1000:8.1f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Token-budgeted packing of topic documents into labeling prompts.
+
+Documents arrive ordered by how representative they are (closest to the
+centroid first). pack_documents walks that order and adds each document
+that is not a duplicate of one already packed, cut on a sentence boundary to
+at most max_doc_tokens, until the per-topic token budget is spent. A topic of
+short comments therefore gets many of them, a topic of long posts gets the
+opening sentences of a few, and every prompt has a known upper bound.
+
+Tokens are estimated from characters (CHARS_PER_TOKEN, about right for
+Gemini on English text); the estimate only has to be consistent, since it is
+used to bound and compare prompts rather than to bill them.
+"""
+from __future__ import annotations
+
+import re
+
+CHARS_PER_TOKEN = 4
+DEFAULT_TOKEN_BUDGET = 1000
+DEFAULT_MAX_DOC_TOKENS = 150
+# Documents that would get fewer tokens than this are not worth adding
+MIN_DOC_TOKENS = 12
+# Documents with fewer words say too little about the topic
+MIN_DOC_WORDS = 3
+# Word-set Jaccard similarity to a packed document above which a document is a
+# near-duplicate (reposts, templated or bot comments)
+NEAR_DUPLICATE_JACCARD = 0.8
+DOCUMENT_SEPARATOR = '\n---\n'
+
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?])["\')\]]*\s+|\n+')
+_WHITESPACE_RE = re.compile(r'\s+')
+_URL_RE = re.compile(r'(?:https?://|www\.)\S+', re.IGNORECASE)
+_WORD_RE = re.compile(r'\w+')
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimated token count of text (at least 1 for non-empty text)."""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def clean_text(text: str) -> str:
+    """Drops URLs and collapses whitespace."""
+    return _WHITESPACE_RE.sub(' ', _URL_RE.sub(' ', text or '')).strip()
+
+
+def truncate_to_sentences(text: str, max_tokens: int) -> tuple[str, bool]:
+    """
+    Cuts text to at most max_tokens on a sentence boundary.
+
+    Falls back to a word boundary (with an ellipsis) when even the first
+    sentence is over the limit.
+
+    Returns:
+        Tuple of (text, whether it was truncated)
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text, False
+
+    cut = 0
+    for match in _SENTENCE_END_RE.finditer(text):
+        if match.start() > max_chars:
+            break
+        cut = match.start()
+    if cut:
+        return text[:cut].rstrip(), True
+
+    head = text[:max_chars - 1]
+    space = head.rfind(' ')
+    return (head[:space] if space > 0 else head).rstrip() + '…', True
+
+
+def pack_documents(documents: list[str], token_budget: int = DEFAULT_TOKEN_BUDGET,
+                   max_doc_tokens: int = DEFAULT_MAX_DOC_TOKENS, max_docs: int | None = None,
+                   min_words: int = MIN_DOC_WORDS) -> dict:
+    """
+    Packs as many distinct documents as fit in token_budget.
+
+    Args:
+        documents: Candidate texts, most representative first
+        token_budget: Estimated tokens available for the documents (separators included)
+        max_doc_tokens: Per-document cap
+        max_docs: Optional cap on the number of documents
+        min_words: Documents with fewer words are skipped (not counted)
+
+    Returns:
+        Dict with 'text' (documents joined by DOCUMENT_SEPARATOR), 'indices'
+        (positions in documents of the packed ones), 'tokens_used',
+        'num_truncated', 'num_duplicates' and 'num_candidates'.
+    """
+    separator_tokens = estimate_tokens(DOCUMENT_SEPARATOR)
+    packed, indices, seen_keys, word_sets = [], [], set(), []
+    tokens_used = num_truncated = num_duplicates = 0
+
+    for index, document in enumerate(documents):
+        if max_docs is not None and len(packed) >= max_docs:
+            break
+        remaining = token_budget - tokens_used - (separator_tokens if packed else 0)
+        if remaining < MIN_DOC_TOKENS:
+            break
+
+        text = clean_text(document)
+        if not text:
+            continue
+        tokens = _WORD_RE.findall(text.lower())
+        key, words = ' '.join(tokens), frozenset(tokens)
+        if len(tokens) < min_words:
+            continue
+        if key in seen_keys or any(
+            len(words & other) >= NEAR_DUPLICATE_JACCARD * len(words | other) for other in word_sets
+        ):
+            num_duplicates += 1
+            continue
+
+        text, truncated = truncate_to_sentences(text, min(max_doc_tokens, remaining))
+        seen_keys.add(key)
+        word_sets.append(words)
+        tokens_used += estimate_tokens(text) + (separator_tokens if packed else 0)
+        num_truncated += truncated
+        packed.append(text)
+        indices.append(index)
+
+    return {
+        'text': DOCUMENT_SEPARATOR.join(packed),
+        'indices': indices,
+        'tokens_used': tokens_used,
+        'num_truncated': num_truncated,
+        'num_duplicates': num_duplicates,
+        'num_candidates': len(documents),
+    }
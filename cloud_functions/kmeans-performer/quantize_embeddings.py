@@ -0,0 +1,119 @@
+"""
+Backfills the compact embedding columns of embeddings_cache.
+
+- int8: one UPDATE that quantizes in BigQuery (the same expression the
+  deliverer MERGE uses for new rows).
+- float16: BigQuery has no half-float type, so rows without embeddings_f16
+  are exported in batches, encoded with embedding_codec, loaded into a
+  staging table and applied with UPDATE ... FROM. Re-run it after new
+  deliveries; it only touches rows that are still missing the column.
+
+Run bigquery/embeddings_cache_quantized.sql first to add the columns.
+
+Usage:
+    python quantize_embeddings.py --dataset social_listening_data --encoding int8
+    python quantize_embeddings.py --dataset social_listening_data --encoding float16 --batch-size 50000
+"""
+import argparse
+import base64
+import time
+
+from google.cloud import bigquery
+
+from embedding_codec import encode_float16
+
+PROJECT_ID = 'social-listening-sense'
+BIGQUERY_LOCATION = 'eu'
+STAGING_TABLE = 'embeddings_f16_staging'
+
+INT8_BACKFILL_SQL = """
+UPDATE `{table}` AS ec
+SET
+  embeddings_int8 = q.embeddings_int8,
+  embeddings_int8_scale = q.embeddings_int8_scale
+FROM (
+  SELECT
+    unified_id,
+    int8_scale AS embeddings_int8_scale,
+    CODE_POINTS_TO_BYTES(ARRAY(
+      SELECT MOD(CAST(ROUND(IFNULL(SAFE_DIVIDE(x, int8_scale), 0)) AS INT64) + 256, 256)
+      FROM UNNEST(embeddings) AS x WITH OFFSET AS i
+      ORDER BY i
+    )) AS embeddings_int8
+  FROM (
+    SELECT unified_id, embeddings, (SELECT MAX(ABS(x)) FROM UNNEST(embeddings) AS x) / 127 AS int8_scale
+    FROM `{table}`
+    WHERE embeddings_int8 IS NULL AND ARRAY_LENGTH(embeddings) > 0
+  )
+) AS q
+WHERE ec.unified_id = q.unified_id
+"""
+
+
+def backfill_int8(client, table):
+    job = client.query(INT8_BACKFILL_SQL.format(table=table), location=BIGQUERY_LOCATION)
+    job.result()
+    print(f"int8: updated {job.num_dml_affected_rows or 0} rows "
+          f"({(job.total_bytes_processed or 0) / 1e9:.2f} GB processed)")
+
+
+def backfill_float16(client, table, staging_table, batch_size):
+    import numpy as np
+
+    total = 0
+    while True:
+        start = time.perf_counter()
+        rows = list(client.query(f"""
+            SELECT unified_id, embeddings
+            FROM `{table}`
+            WHERE embeddings_f16 IS NULL AND ARRAY_LENGTH(embeddings) > 0
+            LIMIT {int(batch_size)}
+        """, location=BIGQUERY_LOCATION).result())
+        if not rows:
+            break
+
+        blobs = encode_float16(np.array([row.embeddings for row in rows], dtype=np.float64))
+        staged = [
+            {'unified_id': row.unified_id, 'embeddings_f16': base64.b64encode(blob).decode('ascii')}
+            for row, blob in zip(rows, blobs)
+        ]
+        job_config = bigquery.LoadJobConfig(
+            schema=[
+                bigquery.SchemaField('unified_id', 'STRING'),
+                bigquery.SchemaField('embeddings_f16', 'BYTES'),
+            ],
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        client.load_table_from_json(staged, staging_table, job_config=job_config,
+                                    location=BIGQUERY_LOCATION).result()
+        client.query(f"""
+            UPDATE `{table}` AS ec
+            SET embeddings_f16 = s.embeddings_f16
+            FROM `{staging_table}` AS s
+            WHERE ec.unified_id = s.unified_id
+        """, location=BIGQUERY_LOCATION).result()
+        total += len(rows)
+        print(f"float16: updated {len(rows)} rows in {time.perf_counter() - start:.1f}s ({total} total)")
+
+    client.delete_table(staging_table, not_found_ok=True)
+    print(f"float16: done, {total} rows updated")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', required=True, help="BigQuery dataset holding embeddings_cache")
+    parser.add_argument('--project', default=PROJECT_ID)
+    parser.add_argument('--encoding', choices=['int8', 'float16', 'all'], default='all')
+    parser.add_argument('--batch-size', type=int, default=50_000, help="Rows per float16 batch")
+    args = parser.parse_args(argv)
+
+    client = bigquery.Client(project=args.project)
+    table = f"{args.project}.{args.dataset}.embeddings_cache"
+    if args.encoding in ('int8', 'all'):
+        backfill_int8(client, table)
+    if args.encoding in ('float16', 'all'):
+        backfill_float16(client, table, f"{args.project}.{args.dataset}.{STAGING_TABLE}", args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+Incremental topic x day rollups of document_topic_assignments.
+
+topic_daily_rollup holds one row per (run_id, topic_id, day, source,
+content_type), where day is the content date (assignment date when the
+content timestamp is missing), with counts, sums and sums of squares of the
+sentiment score, magnitude and engagement. Dashboards derive volume, means and
+variances from these without reading assignment rows or primary_text.
+
+Each refresh finds the (run_id, day) groups that received assignments since
+the watermark ('topic_daily_rollup' in nlp_processing_watermark), recomputes
+those groups in full and MERGEs them, so repeated refreshes are idempotent and
+untouched days are never rewritten. The watermark is re-read with an overlap,
+since a long ML.PREDICT insert commits rows whose assigned_at is its start time.
+"""
+from __future__ import annotations
+
+import logging
+import time
+
+from google.cloud import bigquery
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_NAME = 'topic_daily_rollup'
+# Assignments are re-read this far behind the watermark
+WATERMARK_OVERLAP_MINUTES = 30
+
+REFRESH_SQL = """
+DECLARE watermark TIMESTAMP DEFAULT (
+  SELECT MAX(last_processed_timestamp) FROM `{watermark_table}` WHERE table_name = @watermark_name
+);
+DECLARE new_watermark TIMESTAMP;
+DECLARE min_day DATE;
+DECLARE max_day DATE;
+DECLARE touched_groups INT64 DEFAULT 0;
+
+CREATE TEMP TABLE touched AS
+SELECT DISTINCT
+  run_id,
+  COALESCE(DATE(content_timestamp), DATE(assigned_at)) AS day
+FROM `{assignments_table}`
+WHERE assigned_at > TIMESTAMP_SUB(
+    COALESCE(watermark, TIMESTAMP '1970-01-01 00:00:00 UTC'), INTERVAL {overlap_minutes} MINUTE)
+  AND (ARRAY_LENGTH(@run_ids) = 0 OR run_id IN UNNEST(@run_ids));
+
+SET (new_watermark, min_day, max_day, touched_groups) = (
+  SELECT AS STRUCT
+    (SELECT MAX(assigned_at) FROM `{assignments_table}`
+     WHERE assigned_at > COALESCE(watermark, TIMESTAMP '1970-01-01 00:00:00 UTC')),
+    MIN(day), MAX(day), COUNT(*)
+  FROM touched
+);
+
+IF touched_groups > 0 THEN
+  MERGE `{rollup_table}` T
+  USING (
+    SELECT
+      a.run_id,
+      a.topic_id,
+      t.day,
+      a.source,
+      a.content_type,
+      COUNT(*) AS doc_count,
+      COUNT(a.sentiment_score) AS sentiment_count,
+      SUM(a.sentiment_score) AS sentiment_score_sum,
+      SUM(a.sentiment_score * a.sentiment_score) AS sentiment_score_sq_sum,
+      SUM(a.sentiment_magnitude) AS sentiment_magnitude_sum,
+      SUM(a.sentiment_magnitude * a.sentiment_magnitude) AS sentiment_magnitude_sq_sum,
+      COUNT(v.engagement_score) AS engagement_count,
+      SUM(v.engagement_score) AS engagement_sum,
+      SUM(CAST(v.engagement_score AS FLOAT64) * v.engagement_score) AS engagement_sq_sum,
+      MAX(a.assigned_at) AS last_assigned_at
+    FROM `{assignments_table}` AS a
+    JOIN touched AS t
+      ON a.run_id = t.run_id
+      AND COALESCE(DATE(a.content_timestamp), DATE(a.assigned_at)) = t.day
+    LEFT JOIN `{content_view}` AS v
+      ON v.content_item_id = a.unified_id
+    GROUP BY a.run_id, a.topic_id, t.day, a.source, a.content_type
+  ) S
+  ON T.day BETWEEN min_day AND max_day
+    AND T.run_id = S.run_id
+    AND T.day = S.day
+    AND T.topic_id IS NOT DISTINCT FROM S.topic_id
+    AND T.source IS NOT DISTINCT FROM S.source
+    AND T.content_type IS NOT DISTINCT FROM S.content_type
+  WHEN MATCHED THEN UPDATE SET
+    doc_count = S.doc_count,
+    sentiment_count = S.sentiment_count,
+    sentiment_score_sum = S.sentiment_score_sum,
+    sentiment_score_sq_sum = S.sentiment_score_sq_sum,
+    sentiment_magnitude_sum = S.sentiment_magnitude_sum,
+    sentiment_magnitude_sq_sum = S.sentiment_magnitude_sq_sum,
+    engagement_count = S.engagement_count,
+    engagement_sum = S.engagement_sum,
+    engagement_sq_sum = S.engagement_sq_sum,
+    last_assigned_at = S.last_assigned_at,
+    updated_at = CURRENT_TIMESTAMP()
+  WHEN NOT MATCHED THEN INSERT (
+    run_id, topic_id, day, source, content_type, doc_count,
+    sentiment_count, sentiment_score_sum, sentiment_score_sq_sum,
+    sentiment_magnitude_sum, sentiment_magnitude_sq_sum,
+    engagement_count, engagement_sum, engagement_sq_sum,
+    last_assigned_at, updated_at
+  ) VALUES (
+    S.run_id, S.topic_id, S.day, S.source, S.content_type, S.doc_count,
+    S.sentiment_count, S.sentiment_score_sum, S.sentiment_score_sq_sum,
+    S.sentiment_magnitude_sum, S.sentiment_magnitude_sq_sum,
+    S.engagement_count, S.engagement_sum, S.engagement_sq_sum,
+    S.last_assigned_at, CURRENT_TIMESTAMP()
+  );
+END IF;
+
+-- A refresh scoped to some runs must not move the shared watermark
+IF new_watermark IS NOT NULL AND ARRAY_LENGTH(@run_ids) = 0 THEN
+  MERGE `{watermark_table}` W
+  USING (SELECT @watermark_name AS table_name) S
+  ON W.table_name = S.table_name
+  WHEN MATCHED THEN UPDATE SET last_processed_timestamp = new_watermark, updated_at = CURRENT_TIMESTAMP()
+  WHEN NOT MATCHED THEN INSERT (table_name, last_processed_timestamp, updated_at)
+    VALUES (S.table_name, new_watermark, CURRENT_TIMESTAMP());
+END IF;
+
+SELECT touched_groups, min_day, max_day, watermark, new_watermark;
+"""
+
+
+def refresh_topic_rollups(client: bigquery.Client, project_id: str, bigquery_dataset_id: str,
+                          location: str, run_ids: list[str] | None = None) -> dict:
+    """
+    Recomputes the topic_daily_rollup groups touched by new assignments.
+
+    Args:
+        client: BigQuery client
+        project_id: GCP project ID
+        bigquery_dataset_id: Dataset holding document_topic_assignments and the rollup
+        location: BigQuery location
+        run_ids: Optionally restrict the refresh to these runs. Scoped refreshes
+            do not advance the watermark, so a later full refresh still covers
+            every run.
+
+    Returns:
+        Summary dict with the number of (run_id, day) groups recomputed, their
+        day range and the watermark before and after.
+    """
+    prefix = f"{project_id}.{bigquery_dataset_id}"
+    sql = REFRESH_SQL.format(
+        watermark_table=f"{prefix}.nlp_processing_watermark",
+        assignments_table=f"{prefix}.document_topic_assignments",
+        rollup_table=f"{prefix}.topic_daily_rollup",
+        content_view=f"{prefix}.unified_social_content_items",
+        overlap_minutes=WATERMARK_OVERLAP_MINUTES,
+    )
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("watermark_name", "STRING", WATERMARK_NAME),
+            bigquery.ArrayQueryParameter("run_ids", "STRING", run_ids or []),
+        ],
+        labels={'job_type': 'topic_rollup_refresh'}
+    )
+
+    start = time.perf_counter()
+    job = client.query(sql, job_config=job_config, location=location)
+    row = next(iter(job.result()), None)
+    summary = {
+        'touched_groups': row.touched_groups if row else 0,
+        'min_day': row.min_day.isoformat() if row and row.min_day else None,
+        'max_day': row.max_day.isoformat() if row and row.max_day else None,
+        'previous_watermark': row.watermark.isoformat() if row and row.watermark else None,
+        'watermark': row.new_watermark.isoformat() if row and row.new_watermark else None,
+        'duration_seconds': round(time.perf_counter() - start, 2),
+        'bytes_processed': job.total_bytes_processed,
+    }
+    logger.info(f"Refreshed topic rollups: {summary['touched_groups']} run/day groups "
+                f"({summary['min_day']} to {summary['max_day']}) in {summary['duration_seconds']}s")
+    return summary
@@ -0,0 +1,180 @@
+"""
+Reuse of identical K-means runs and cleanup of their temp models.
+
+A run's fingerprint hashes everything that determines its model: the sorted,
+de-duplicated ID set, n_clusters, the embedding model and the training
+options. perform_kmeans looks the fingerprint up in kmeans_runs before
+training, so a double click or a re-submitted sheet returns the earlier run
+instead of training a second model.
+
+Temp models (temp_topic_model_<run_id>) are only needed until their run's
+centroids are saved, so gc_temp_models deletes those that are unreferenced:
+models of failed or unknown runs, models superseded by a newer run with the
+same fingerprint, and models older than TEMP_MODEL_TTL_HOURS. A completed
+run's centroids are written as an artifact first (see centroids.py), so
+assignment and alignment keep working after its model is gone.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import bigquery
+
+logger = logging.getLogger(__name__)
+
+TEMP_MODEL_PREFIX = 'temp_topic_model_'
+TEMP_MODEL_TTL_HOURS = int(os.environ.get('TEMP_MODEL_TTL_HOURS', '168'))
+# Runs still in progress after this long are considered dead and not reused
+IN_PROGRESS_MAX_AGE_MINUTES = 60
+# BigQuery job states in which an in-progress run is still making progress
+LIVE_JOB_STATES = ('PENDING', 'RUNNING')
+FAILED_MODEL_GRACE_HOURS = 1
+IN_PROGRESS_STATUSES = ('submitted', 'model_created', 'prediction_started', 'prediction_completed')
+
+
+def run_fingerprint(unified_ids: list[str], n_clusters: int, embedding_model: str, training_options: dict) -> str:
+    """Returns the hex sha256 fingerprint of a run's inputs; ID order and duplicates do not matter."""
+    digest = hashlib.sha256()
+    for unified_id in sorted(set(unified_ids)):
+        digest.update(unified_id.encode('utf-8'))
+        digest.update(b'\n')
+    digest.update(json.dumps({
+        'n_clusters': n_clusters,
+        'embedding_model': embedding_model,
+        'training_options': training_options,
+    }, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _run_job_is_live(client: bigquery.Client, row, location: str) -> bool:
+    # The run's current BigQuery job: ML.PREDICT once started, else CREATE MODEL
+    job_id = row.predict_job_id or row.model_creation_job_id
+    if not job_id:
+        return False
+    try:
+        return client.get_job(job_id, location=location).state in LIVE_JOB_STATES
+    except Exception as e:
+        logger.warning(f"Could not check job {job_id} of run {row.run_id}: {e}")
+        return False
+
+
+def find_reusable_run(client: bigquery.Client, runs_table: str, fingerprint: str, location: str) -> dict | None:
+    """
+    Returns the newest completed run with this fingerprint, or else the newest
+    in-progress one (started within IN_PROGRESS_MAX_AGE_MINUTES) whose
+    BigQuery job is still pending or running, or None.
+
+    An in-progress run whose job has finished is not reused: either it failed
+    without updating its status, or the rest of the run (labeling, UMAP)
+    happens in a request that may have died.
+    """
+    query = f"""
+    SELECT run_id, status, created_at, model_name, model_creation_job_id, predict_job_id
+    FROM `{runs_table}`
+    WHERE fingerprint = @fingerprint
+      AND (
+        status = 'completed'
+        OR (status IN UNNEST(@in_progress_statuses)
+            AND created_at >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @max_age_minutes MINUTE))
+      )
+    ORDER BY status = 'completed' DESC, created_at DESC
+    LIMIT 5
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("fingerprint", "STRING", fingerprint),
+        bigquery.ArrayQueryParameter("in_progress_statuses", "STRING", list(IN_PROGRESS_STATUSES)),
+        bigquery.ScalarQueryParameter("max_age_minutes", "INT64", IN_PROGRESS_MAX_AGE_MINUTES),
+    ])
+    for row in client.query(query, job_config=job_config, location=location).result():
+        if row.status != 'completed' and not _run_job_is_live(client, row, location):
+            continue
+        return {
+            'run_id': row.run_id,
+            'status': row.status,
+            'created_at': row.created_at.isoformat() if row.created_at else None,
+            'model_name': row.model_name,
+            'predict_job_id': row.predict_job_id,
+        }
+    return None
+
+
+def _runs_by_id(client: bigquery.Client, runs_table: str, run_ids: list[str], location: str) -> dict:
+    query = f"""
+    SELECT
+        run_id,
+        status,
+        created_at,
+        fingerprint,
+        -- Superseded when a newer completed run has the same fingerprint
+        fingerprint IS NOT NULL AND EXISTS (
+            SELECT 1 FROM `{runs_table}` AS newer
+            WHERE newer.fingerprint = r.fingerprint
+              AND newer.status = 'completed'
+              AND newer.created_at > r.created_at
+        ) AS superseded
+    FROM `{runs_table}` AS r
+    WHERE run_id IN UNNEST(@run_ids)
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("run_ids", "STRING", run_ids),
+    ])
+    return {row.run_id: row for row in client.query(query, job_config=job_config, location=location).result()}
+
+
+def gc_temp_models(client: bigquery.Client, project_id: str, bigquery_dataset_id: str, runs_table: str,
+                   location: str, dry_run: bool = False) -> dict:
+    """
+    Deletes unreferenced temp models (see the module docstring).
+
+    Returns:
+        Summary dict with the deleted (or, on a dry run, deletable) models and
+        the reason for each, plus the number of models kept.
+    """
+    from centroids import load_centroid_artifact, load_centroids_from_model, save_centroid_artifact
+
+    now = datetime.now(timezone.utc)
+    models = [
+        model for model in client.list_models(f"{project_id}.{bigquery_dataset_id}")
+        if model.model_id.startswith(TEMP_MODEL_PREFIX)
+    ]
+    runs = _runs_by_id(client, runs_table, [m.model_id[len(TEMP_MODEL_PREFIX):] for m in models], location)
+
+    deleted = []
+    kept = 0
+    for model in models:
+        run_id = model.model_id[len(TEMP_MODEL_PREFIX):]
+        run = runs.get(run_id)
+        age = now - model.created if model.created else timedelta(0)
+        if run is None:
+            reason = 'no_run_record' if age > timedelta(hours=FAILED_MODEL_GRACE_HOURS) else None
+        elif run.status == 'failed':
+            reason = 'run_failed' if age > timedelta(hours=FAILED_MODEL_GRACE_HOURS) else None
+        elif run.superseded:
+            reason = 'superseded'
+        elif age > timedelta(hours=TEMP_MODEL_TTL_HOURS) and run.status not in IN_PROGRESS_STATUSES:
+            reason = 'expired'
+        else:
+            reason = None
+        if reason is None:
+            kept += 1
+            continue
+
+        if not dry_run:
+            if run is not None and run.status == 'completed':
+                try:
+                    if load_centroid_artifact(run_id) is None:
+                        save_centroid_artifact(run_id, *load_centroids_from_model(
+                            client, project_id, bigquery_dataset_id, run_id, location))
+                except Exception as e:
+                    logger.warning(f"Keeping model {model.model_id}: could not save its centroids: {e}")
+                    kept += 1
+                    continue
+            client.delete_model(model.reference, not_found_ok=True)
+        logger.info(f"{'Would delete' if dry_run else 'Deleted'} model {model.model_id} ({reason})")
+        deleted.append({'model': model.model_id, 'run_id': run_id, 'reason': reason})
+
+    return {'deleted': deleted, 'kept': kept, 'dry_run': dry_run}
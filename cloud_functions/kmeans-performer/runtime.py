@@ -0,0 +1,61 @@
+"""
+Instance-wide BigQuery client for the K-means performer.
+
+Every helper in main.py used to build its own bigquery.Client; they now share
+one client that is created on first use and kept for the life of the instance.
+
+load_rows writes many rows with a single load job: unlike streaming inserts it
+is free, atomic, and leaves no streaming buffer blocking later UPDATE/DELETE.
+"""
+import logging
+import threading
+import time
+
+from google.cloud import bigquery
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_bigquery_clients = {}
+
+# Milliseconds spent creating each client on this instance
+init_timings_ms = {}
+
+
+def get_bigquery_client(project=None):
+    """Returns the shared BigQuery client for `project`, creating it on first use."""
+    client = _bigquery_clients.get(project)
+    if client is None:
+        with _lock:
+            client = _bigquery_clients.get(project)
+            if client is None:
+                start = time.perf_counter()
+                client = bigquery.Client(project=project)
+                init_timings_ms[f"bigquery_client:{project}"] = round((time.perf_counter() - start) * 1000, 1)
+                logger.info(f"Initialized BigQuery client for project {project} in "
+                            f"{init_timings_ms[f'bigquery_client:{project}']} ms")
+                _bigquery_clients[project] = client
+    return client
+
+
+def load_rows(client, table_id, rows, location=None, schema=None, write_disposition=bigquery.WriteDisposition.WRITE_APPEND):
+    """
+    Appends rows (JSON-serializable dicts) to a table in one load job.
+
+    The table's own schema is used, so rows may omit nullable columns. Pass
+    schema (and e.g. WRITE_TRUNCATE) to load into a table that may not exist
+    yet, such as a staging table for a MERGE.
+
+    Returns:
+        The number of rows written.
+    """
+    if not rows:
+        return 0
+    start = time.perf_counter()
+    job_config = bigquery.LoadJobConfig(
+        schema=schema or client.get_table(table_id).schema,
+        write_disposition=write_disposition,
+    )
+    client.load_table_from_json(rows, table_id, job_config=job_config, location=location).result()
+    logger.info(f"Loaded {len(rows)} rows into {table_id} in {time.perf_counter() - start:.1f}s")
+    return len(rows)
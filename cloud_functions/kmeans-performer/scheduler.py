@@ -0,0 +1,312 @@
+"""
+Admission control and resource scheduling for concurrent K-means runs.
+
+With request concurrency above 1, one instance serves several runs at once.
+Without coordination each of them holds a request thread for minutes, runs
+UMAP on that thread, and competes for BigQuery slots and Gemini quota. This
+module adds three layers, all per instance:
+
+- Admission: at most MAX_ACTIVE_RUNS runs execute at once. Others wait in a
+  fair queue (round-robin across requesters, FIFO per requester, so one
+  person queueing ten runs does not starve everyone else). Requests are
+  turned away with AdmissionRejected when the queue is full or the wait
+  exceeds ADMISSION_TIMEOUT_SECONDS.
+- Resources: named semaphores ('bigquery', 'umap', 'cpu', 'labeling') bound
+  how many admitted runs use each resource at the same moment. 'cpu' is held
+  by multi-K fits, which start their own pool of up to one process per core.
+- UMAP process pool: fits run in UMAP_WORKERS spawned processes, so a fit
+  neither blocks the GIL for the other runs nor pays the umap/numba import in
+  every request. The pool lives as long as the instance.
+
+Queue depth, resource usage and wait-time percentiles are available from
+status() (served by the "status" mode of perform_kmeans). Limits apply per
+instance; the fleet-wide bound is max instances x MAX_ACTIVE_RUNS.
+
+This module imports only the standard library at the top, so the spawned
+UMAP workers do not load BigQuery or Flask.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing import get_context
+
+logger = logging.getLogger(__name__)
+
+MAX_ACTIVE_RUNS = int(os.environ.get('MAX_ACTIVE_RUNS', '2'))
+MAX_QUEUED_RUNS = int(os.environ.get('MAX_QUEUED_RUNS', '16'))
+ADMISSION_TIMEOUT_SECONDS = float(os.environ.get('ADMISSION_TIMEOUT_SECONDS', '600'))
+UMAP_WORKERS = int(os.environ.get('UMAP_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+RESOURCE_LIMITS = {
+    'bigquery': int(os.environ.get('BIGQUERY_JOB_SLOTS', '4')),
+    'umap': max(UMAP_WORKERS, 1),
+    'cpu': int(os.environ.get('CLUSTER_SLOTS', '1')),
+    'labeling': int(os.environ.get('LABELING_SLOTS', '2')),
+}
+# Wait-time samples kept per queue or resource for the percentiles in status()
+WAIT_SAMPLES = 500
+
+
+class AdmissionRejected(Exception):
+    """Raised when a run cannot be admitted; retry_after is a hint in seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _WaitStats:
+    def __init__(self):
+        self.samples = deque(maxlen=WAIT_SAMPLES)
+        self.total = 0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.total += 1
+
+    def summary(self) -> dict:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {'count': self.total}
+
+        def percentile(p):
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 3)
+
+        return {
+            'count': self.total,
+            'mean_seconds': round(sum(ordered) / len(ordered), 3),
+            'p50_seconds': percentile(0.5),
+            'p95_seconds': percentile(0.95),
+            'max_seconds': round(ordered[-1], 3),
+        }
+
+
+class Ticket:
+    """One admitted (or waiting) run; collects the run's own wait times."""
+
+    def __init__(self, requester: str, label: str):
+        self.requester = requester
+        self.label = label
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.admission_wait = 0.0
+        self.resource_waits = {}
+
+    def summary(self) -> dict:
+        return {
+            'requester': self.requester,
+            'admission_wait_seconds': round(self.admission_wait, 3),
+            'resource_wait_seconds': {name: round(wait, 3) for name, wait in self.resource_waits.items()},
+        }
+
+
+class FairAdmissionQueue:
+    """
+    Admits at most max_active tickets at once, round-robin across requesters.
+    """
+
+    def __init__(self, max_active: int, max_queued: int):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # requester -> deque of waiting tickets
+        self._active = []
+        self._waiting = 0
+        self.wait_stats = _WaitStats()
+        self.rejected = 0
+
+    def _dispatch(self):
+        # Called with the lock held: grant heads of requester queues in turn
+        while len(self._active) < self.max_active and self._queues:
+            requester, queue = self._queues.popitem(last=False)
+            ticket = queue.popleft()
+            if queue:
+                self._queues[requester] = queue  # back of the rotation
+            ticket.granted = True
+            self._waiting -= 1
+            self._active.append(ticket)
+        self._cond.notify_all()
+
+    def _remove(self, ticket: Ticket):
+        queue = self._queues.get(ticket.requester)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self._waiting -= 1
+            if not queue:
+                del self._queues[ticket.requester]
+
+    def acquire(self, requester: str, label: str, timeout: float) -> Ticket:
+        ticket = Ticket(requester, label)
+        with self._cond:
+            if self._waiting >= self.max_queued:
+                self.rejected += 1
+                raise AdmissionRejected(f"{self._waiting} runs already queued on this instance", retry_after=30)
+            self._queues.setdefault(requester, deque()).append(ticket)
+            self._waiting += 1
+            self._dispatch()
+            deadline = ticket.enqueued_at + timeout
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._remove(ticket)
+                    self.rejected += 1
+                    raise AdmissionRejected(f"Not admitted within {timeout:.0f}s", retry_after=60)
+                self._cond.wait(remaining)
+            ticket.admission_wait = time.monotonic() - ticket.enqueued_at
+            self.wait_stats.add(ticket.admission_wait)
+        return ticket
+
+    def release(self, ticket: Ticket):
+        with self._cond:
+            if ticket in self._active:
+                self._active.remove(ticket)
+            self._dispatch()
+
+    def status(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            return {
+                'max_active': self.max_active,
+                'max_queued': self.max_queued,
+                'active': [{'requester': t.requester, 'label': t.label} for t in self._active],
+                'queue_depth': self._waiting,
+                'queued_by_requester': {requester: len(queue) for requester, queue in self._queues.items()},
+                'oldest_wait_seconds': round(max(
+                    (now - t.enqueued_at for queue in self._queues.values() for t in queue), default=0.0), 3),
+                'rejected': self.rejected,
+                'admission_wait': self.wait_stats.summary(),
+            }
+
+
+class _Resource:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphore = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.waiting = 0
+        self.wait_stats = _WaitStats()
+
+
+_admission = FairAdmissionQueue(MAX_ACTIVE_RUNS, MAX_QUEUED_RUNS)
+_resources = {name: _Resource(limit) for name, limit in RESOURCE_LIMITS.items()}
+_current = threading.local()
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def admit(requester: str | None, label: str = '', timeout: float = ADMISSION_TIMEOUT_SECONDS) -> Ticket:
+    """
+    Waits for one of this instance's run slots; pair with release().
+
+    Raises AdmissionRejected if the queue is full or the wait times out.
+    Returns the Ticket, whose summary() reports the run's own wait times.
+    """
+    ticket = _admission.acquire(requester or 'anonymous', label, timeout)
+    _current.ticket = ticket
+    return ticket
+
+
+def release(ticket: Ticket):
+    """Frees the run slot held by ticket and admits the next queued run."""
+    if getattr(_current, 'ticket', None) is ticket:
+        _current.ticket = None
+    _admission.release(ticket)
+
+
+@contextmanager
+def admitted(requester: str | None, label: str = '', timeout: float = ADMISSION_TIMEOUT_SECONDS):
+    """admit() and release() around the body of a with block."""
+    ticket = admit(requester, label, timeout)
+    try:
+        yield ticket
+    finally:
+        release(ticket)
+
+
+@contextmanager
+def resource(name: str):
+    """Holds one slot of a named resource ('bigquery', 'umap', 'cpu' or 'labeling')."""
+    res = _resources[name]
+    start = time.monotonic()
+    with res.lock:
+        res.waiting += 1
+    res.semaphore.acquire()
+    waited = time.monotonic() - start
+    with res.lock:
+        res.waiting -= 1
+        res.in_use += 1
+    res.wait_stats.add(waited)
+    ticket = getattr(_current, 'ticket', None)
+    if ticket is not None:
+        ticket.resource_waits[name] = ticket.resource_waits.get(name, 0.0) + waited
+    try:
+        yield
+    finally:
+        with res.lock:
+            res.in_use -= 1
+        res.semaphore.release()
+
+
+def _umap_worker(embeddings, params: dict):
+    from numba_cache import configure_numba_cache
+
+    # Point numba at the prebuilt kernel cache before umap compiles anything
+    configure_numba_cache()
+    import umap
+
+    return umap.UMAP(**params).fit_transform(embeddings)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=UMAP_WORKERS, mp_context=get_context('spawn'))
+    return _pool
+
+
+def run_umap(embeddings, **params):
+    """
+    Fits UMAP on embeddings in the worker pool (or in this thread if
+    UMAP_WORKERS is 0), holding a 'umap' slot while it runs.
+    """
+    global _pool
+    with resource('umap'):
+        if UMAP_WORKERS <= 0:
+            return _umap_worker(embeddings, params)
+        pool = _get_pool()
+        try:
+            return pool.submit(_umap_worker, embeddings, params).result()
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory); start a fresh pool for the next run
+            with _pool_lock:
+                if _pool is pool:
+                    _pool = None
+            raise
+
+
+def status() -> dict:
+    """Admission queue and resource usage of this instance."""
+    resources = {}
+    for name, res in _resources.items():
+        with res.lock:
+            resources[name] = {
+                'limit': res.limit,
+                'in_use': res.in_use,
+                'waiting': res.waiting,
+                'wait': res.wait_stats.summary(),
+            }
+    return {
+        'admission': _admission.status(),
+        'resources': resources,
+        'umap_workers': UMAP_WORKERS,
+        'umap_pool_started': _pool is not None,
+    }
@@ -0,0 +1,164 @@
+"""
+Cross-run topic alignment by centroid matching.
+
+Each run numbers its topics independently. Two runs are aligned by the cosine
+similarity of their centroids (see centroids.py for where they come from, so
+no documents are reprocessed): the Hungarian algorithm picks the one-to-one
+topic mapping with the highest total similarity, and pairs below
+min_similarity are treated as unmatched (a topic that vanished from the first
+run or is new in the second).
+
+One-to-one matching hides topics that split or merged, so every topic also
+lists the other topics it is close to (similarity >= secondary_threshold) that
+are closer to it than to anything else on their side:
+
+- split: a first-run topic whose secondary neighbours in the second run have
+  it as their best match (it broke up into several topics),
+- merge: a second-run topic whose secondary neighbours in the first run have
+  it as their best match (several topics collapsed into it).
+"""
+from __future__ import annotations
+
+import logging
+import time
+from datetime import datetime
+
+import numpy as np
+from google.cloud import bigquery
+from scipy.optimize import linear_sum_assignment
+
+from centroids import get_run_centroids, normalize_rows
+from runtime import load_rows
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_SIMILARITY = 0.5
+DEFAULT_SECONDARY_THRESHOLD = 0.75
+
+
+def cosine_similarity_matrix(centroids_a: np.ndarray, centroids_b: np.ndarray) -> np.ndarray:
+    """Returns the (len(a), len(b)) matrix of cosine similarities between centroids."""
+    return normalize_rows(centroids_a) @ normalize_rows(centroids_b).T
+
+
+def align_topics(topic_ids_a: np.ndarray, centroids_a: np.ndarray, topic_ids_b: np.ndarray,
+                 centroids_b: np.ndarray, min_similarity: float = DEFAULT_MIN_SIMILARITY,
+                 secondary_threshold: float = DEFAULT_SECONDARY_THRESHOLD) -> list[dict]:
+    """
+    Maps the topics of run A onto the topics of run B.
+
+    Returns:
+        One dict per topic pair or unmatched topic, with topic_id_a / topic_id_b
+        (None when unmatched), similarity, match_type ('matched', 'vanished'
+        or 'new'), split_into (B topics a matched or vanished A topic split
+        into) and merged_from (A topics merged into a matched or new B topic).
+    """
+    similarities = cosine_similarity_matrix(centroids_a, centroids_b)
+    rows, cols = linear_sum_assignment(similarities, maximize=True)
+    kept = similarities[rows, cols] >= min_similarity
+    partner_of_a = dict(zip(rows[kept].tolist(), cols[kept].tolist()))
+    partner_of_b = {b: a for a, b in partner_of_a.items()}
+
+    # Best counterpart of every topic, for the split/merge notes
+    best_a_for_b = np.argmax(similarities, axis=0)
+    best_b_for_a = np.argmax(similarities, axis=1)
+    close = similarities >= secondary_threshold
+
+    def split_into(a):
+        candidates = np.flatnonzero(close[a] & (best_a_for_b == a))
+        return [int(topic_ids_b[b]) for b in candidates if partner_of_a.get(a) != b]
+
+    def merged_from(b):
+        candidates = np.flatnonzero(close[:, b] & (best_b_for_a == b))
+        return [int(topic_ids_a[a]) for a in candidates if partner_of_b.get(b) != a]
+
+    alignments = []
+    for a in range(len(topic_ids_a)):
+        b = partner_of_a.get(a)
+        alignments.append({
+            'topic_id_a': int(topic_ids_a[a]),
+            'topic_id_b': int(topic_ids_b[b]) if b is not None else None,
+            'similarity': float(similarities[a, b]) if b is not None else float(similarities[a].max()),
+            'match_type': 'matched' if b is not None else 'vanished',
+            'split_into': split_into(a),
+            'merged_from': merged_from(b) if b is not None else [],
+        })
+    for b in range(len(topic_ids_b)):
+        if b in partner_of_b:
+            continue
+        alignments.append({
+            'topic_id_a': None,
+            'topic_id_b': int(topic_ids_b[b]),
+            'similarity': float(similarities[:, b].max()),
+            'match_type': 'new',
+            'split_into': [],
+            'merged_from': merged_from(b),
+        })
+    return alignments
+
+
+def store_alignments(client: bigquery.Client, table_id: str, run_id_a: str, run_id_b: str,
+                     alignments: list[dict], location: str) -> None:
+    """
+    Replaces the stored alignment of a run pair.
+
+    Rows are written with a load job rather than streamed, so a later
+    re-alignment of the same pair can delete them straight away.
+    """
+    delete_sql = f"""
+    DELETE FROM `{table_id}`
+    WHERE run_id_a = @run_id_a AND run_id_b = @run_id_b
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("run_id_a", "STRING", run_id_a),
+        bigquery.ScalarQueryParameter("run_id_b", "STRING", run_id_b),
+    ])
+    client.query(delete_sql, job_config=job_config, location=location).result()
+
+    aligned_at = datetime.utcnow().isoformat()
+    rows = [{'run_id_a': run_id_a, 'run_id_b': run_id_b, 'aligned_at': aligned_at, **a} for a in alignments]
+    load_rows(client, table_id, rows, location)
+
+
+def align_runs(client: bigquery.Client, project_id: str, bigquery_dataset_id: str, run_ids: list[str],
+               location: str, min_similarity: float = DEFAULT_MIN_SIMILARITY,
+               secondary_threshold: float = DEFAULT_SECONDARY_THRESHOLD, persist: bool = True) -> list[dict]:
+    """
+    Aligns each consecutive pair of runs (run_ids[0] -> run_ids[1], ...).
+
+    Returns:
+        One summary dict per run pair with its alignments and timings.
+    """
+    loaded = {
+        run_id: get_run_centroids(client, project_id, bigquery_dataset_id, run_id, location)
+        for run_id in dict.fromkeys(run_ids)
+    }
+    table_id = f"{project_id}.{bigquery_dataset_id}.topic_alignments"
+
+    results = []
+    for run_id_a, run_id_b in zip(run_ids, run_ids[1:]):
+        topic_ids_a, centroids_a, _ = loaded[run_id_a]
+        topic_ids_b, centroids_b, _ = loaded[run_id_b]
+        if centroids_a.shape[1] != centroids_b.shape[1]:
+            raise ValueError(f"Runs {run_id_a} and {run_id_b} have centroids of different dimensions "
+                             f"({centroids_a.shape[1]} vs {centroids_b.shape[1]})")
+
+        start = time.perf_counter()
+        alignments = align_topics(topic_ids_a, centroids_a, topic_ids_b, centroids_b,
+                                  min_similarity, secondary_threshold)
+        alignment_ms = round((time.perf_counter() - start) * 1000, 2)
+        if persist:
+            store_alignments(client, table_id, run_id_a, run_id_b, alignments, location)
+
+        counts = {match_type: sum(1 for a in alignments if a['match_type'] == match_type)
+                  for match_type in ('matched', 'vanished', 'new')}
+        logger.info(f"Aligned {len(topic_ids_a)} topics of {run_id_a} with {len(topic_ids_b)} topics of "
+                    f"{run_id_b} in {alignment_ms} ms: {counts}")
+        results.append({
+            'run_id_a': run_id_a,
+            'run_id_b': run_id_b,
+            'alignment_ms': alignment_ms,
+            'counts': counts,
+            'alignments': alignments,
+        })
+    return results
@@ -0,0 +1,140 @@
+"""
+Routing of SERP organic links to the social scrape initiator.
+
+With auto_scrape enabled, links from the fetched SERP pages are classified as
+Reddit posts or Quora questions, normalized to their canonical URL, deduped
+and sent to the initiator (SOCIAL_SCRAPER_URL) - one call per platform with
+the matching Bright Data dataset_id. The initiator then batches the triggers,
+skips URLs scraped within AUTO_SCRAPE_MAX_AGE_HOURS (sent as max_age; the
+initiator's own check is off by default) and records the scrape_job rows as it
+does for URLs submitted from Sheets.
+"""
+import os
+import re
+from urllib.parse import urlsplit
+
+import requests
+
+REDDIT_DATASET_ID = "gd_lvz8ah06191smkebj4"
+QUORA_DATASET_ID = "gd_lvz1rbj81afv3m6n5y"
+
+SOCIAL_SCRAPER_URL = os.environ.get('SOCIAL_SCRAPER_URL')
+# Send a Google-signed ID token (needed when the initiator does not allow unauthenticated calls)
+SOCIAL_SCRAPER_USE_ID_TOKEN = os.environ.get('SOCIAL_SCRAPER_USE_ID_TOKEN', '').lower() in ('1', 'true')
+SOCIAL_SCRAPER_TIMEOUT_SECONDS = 300
+# Links scraped within this many hours are skipped by the initiator (0 scrapes them again)
+AUTO_SCRAPE_MAX_AGE_HOURS = float(os.environ.get('AUTO_SCRAPE_MAX_AGE_HOURS', '24'))
+
+_REDDIT_POST_PATH = re.compile(r'^/r/([A-Za-z0-9_]+)/comments/([a-z0-9]+)(?:/([^/]+))?', re.IGNORECASE)
+# First path segments on quora.com that are not question slugs
+_QUORA_NON_QUESTION_PATHS = {
+    'profile', 'topic', 'q', 'search', 'spaces', 'answer', 'unanswered', 'about',
+    'contact', 'careers', 'press', 'settings', 'notifications', 'messages', 'login',
+}
+
+
+def classify_link(link):
+    """
+    Classifies a SERP link and returns its canonical form.
+
+    Returns:
+        Tuple (platform, canonical_url) with platform 'reddit' or 'quora', or
+        None for links that are not Reddit posts or Quora questions.
+    """
+    try:
+        parts = urlsplit(link or '')
+    except ValueError:
+        return None
+    host = (parts.hostname or '').lower()
+
+    if host == 'reddit.com' or host.endswith('.reddit.com'):
+        match = _REDDIT_POST_PATH.match(parts.path)
+        if not match:
+            return None
+        subreddit, post_id, slug = match.groups()
+        canonical = f"https://www.reddit.com/r/{subreddit}/comments/{post_id.lower()}/"
+        if slug:
+            canonical += f"{slug}/"
+        return 'reddit', canonical
+
+    if host == 'quora.com' or host == 'www.quora.com':
+        segments = [segment for segment in parts.path.split('/') if segment]
+        if not segments or segments[0].lower() in _QUORA_NON_QUESTION_PATHS:
+            return None
+        # /<question>/answer/<user> links point at an answer; scrape its question
+        return 'quora', f"https://www.quora.com/{segments[0]}"
+
+    return None
+
+
+def route_links(links):
+    """
+    Groups SERP links by platform, keeping the first occurrence of each canonical URL.
+
+    Returns:
+        Dict mapping Bright Data dataset_id to a list of canonical URLs.
+    """
+    routed = {REDDIT_DATASET_ID: [], QUORA_DATASET_ID: []}
+    seen = set()
+    for link in links:
+        classified = classify_link(link)
+        if classified is None or classified[1] in seen:
+            continue
+        seen.add(classified[1])
+        platform, canonical = classified
+        routed[REDDIT_DATASET_ID if platform == 'reddit' else QUORA_DATASET_ID].append(canonical)
+    return routed
+
+
+def _auth_headers():
+    if not SOCIAL_SCRAPER_USE_ID_TOKEN:
+        return {}
+    import google.auth.transport.requests
+    import google.oauth2.id_token
+    token = google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), SOCIAL_SCRAPER_URL)
+    return {'Authorization': f"Bearer {token}"}
+
+
+def auto_scrape(serp_pages):
+    """
+    Sends the Reddit/Quora links of SERP pages to the social scrape initiator.
+
+    Args:
+        serp_pages: Iterable of parsed SERP payloads.
+
+    Returns:
+        Dict keyed by platform dataset_id with the number of URLs sent and the
+        initiator's response summary (or error).
+    """
+    if not SOCIAL_SCRAPER_URL:
+        return {'status': 'error', 'message': 'SOCIAL_SCRAPER_URL environment variable not set'}
+
+    links = [result.get('link') for serp_data in serp_pages for result in serp_data.get('organic', [])]
+    routed = route_links(links)
+    headers = _auth_headers()
+
+    summary = {}
+    for dataset_id, urls in routed.items():
+        if not urls:
+            continue
+        print(f"Auto-scrape: sending {len(urls)} URLs to the initiator for dataset {dataset_id}")
+        try:
+            response = requests.post(
+                SOCIAL_SCRAPER_URL,
+                params={'dataset_id': dataset_id},
+                json={'urls': urls, 'max_age': AUTO_SCRAPE_MAX_AGE_HOURS},
+                headers=headers,
+                timeout=SOCIAL_SCRAPER_TIMEOUT_SECONDS,
+            )
+            body = response.json()
+            summary[dataset_id] = {
+                'urls_sent': len(urls),
+                'status': body.get('status', 'error') if response.ok else 'error',
+                'message': body.get('message'),
+                'snapshots': [snapshot.get('snapshot_id') for snapshot in body.get('snapshots', [])],
+                'skipped_urls': len(body.get('skipped_urls', [])),
+            }
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Auto-scrape call for dataset {dataset_id} failed: {e}")
+            summary[dataset_id] = {'urls_sent': len(urls), 'status': 'error', 'message': str(e)}
+    return summary
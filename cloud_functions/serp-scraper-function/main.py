@@ -7,10 +7,257 @@ from urllib.parse import quote_plus
 from google.cloud import bigquery
 from datetime import datetime
 import json
+import time
+from runtime import get_bigquery_client, get_http_session
+from serp_async import BRIGHT_DATA_REQUEST_URL, build_serp_payload, parse_serp_body, fetch_serp_pages
+from serp_cache import SINGLE_FLIGHT_TIMEOUT_SECONDS, cache_key, get_serp_cache
+from link_router import auto_scrape
+
+# Google returns 10 organic results per page; 'start' advances in steps of 10
+RESULTS_PER_PAGE = 10
+# Limits for multi-query requests
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get('SERP_MAX_CONCURRENCY', '10'))
+MAX_PAGES_PER_REQUEST = int(os.environ.get('SERP_MAX_PAGES_PER_REQUEST', '200'))
+# BigQuery recommends at most 500 rows per streaming insert request
+INSERT_CHUNK_SIZE = 500
+
+
+def build_search_row(search_query, start_page, serp_data):
+    """Builds the serp_search metadata row for one fetched page."""
+    general = serp_data['general']
+    return {
+        'request_id': serp_data['input']['request_id'],
+        'search_query': search_query,
+        'search_engine': general['search_engine'],
+        'results_count': general['results_cnt'],
+        'search_time': general['search_time'],
+        'language': general['language'],
+        'is_mobile': str(general['mobile']),
+        'timestamp': general['timestamp'],
+        'pagination_start': start_page
+    }
+
+
+def build_result_rows(search_query, serp_data):
+    """Builds the serp_results rows for the organic results of one fetched page."""
+    serp_search_request_id = serp_data['input']['request_id']
+    serp_search_timestamp = serp_data['general']['timestamp']
+    rows = []
+    for result in serp_data.get('organic', []):
+        # Generate row data matching the schema
+        rows.append({
+            'id': str(uuid.uuid4()),
+            'query': search_query,
+            'serp_request_id': serp_search_request_id,
+            'link': result.get('link'),
+            'title': result.get('title'),
+            'description': result.get('description',''),
+            'rank': result.get('rank'),
+            'global_rank': result.get('global_rank'),
+            'created_at': serp_search_timestamp
+        })
+    return rows
+
+
+def insert_rows(client, table_ref, rows):
+    """Streams rows into a table in as few insert requests as possible; returns the errors."""
+    errors = []
+    for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+        errors.extend(client.insert_rows_json(table_ref, rows[i:i + INSERT_CHUNK_SIZE]))
+    return errors
+
+
+def parse_batch_request(request_json):
+    """
+    Expands a multi-query request body into the list of pages to fetch.
+
+    Expected JSON body: {"queries": ["q1", "q2", ...], "pages": 5, "start": 0,
+    "max_concurrency": 10, "language": "en", "mobile": false, "auto_scrape": false}.
+    "pages" is the depth per query (default 1) and "start" the offset of the
+    first page (default 0).
+
+    Returns:
+        Tuple (pages, max_concurrency).
+
+    Raises:
+        ValueError: If the body is malformed or asks for too many pages.
+    """
+    queries = request_json.get('queries')
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q.strip() for q in queries):
+        raise ValueError("'queries' must be a non-empty list of strings")
+    try:
+        depth = int(request_json.get('pages', 1))
+        first_start = int(request_json.get('start', 0))
+        max_concurrency = int(request_json.get('max_concurrency', DEFAULT_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        raise ValueError("'pages', 'start' and 'max_concurrency' must be integers")
+    if depth < 1 or first_start < 0 or max_concurrency < 1:
+        raise ValueError("'pages' and 'max_concurrency' must be positive and 'start' non-negative")
+    if len(queries) * depth > MAX_PAGES_PER_REQUEST:
+        raise ValueError(f"Request asks for {len(queries) * depth} pages; the limit is {MAX_PAGES_PER_REQUEST}")
+
+    language = request_json.get('language') or ''
+    mobile = bool(request_json.get('mobile', False))
+    pages = []
+    for query in queries:
+        for i in range(depth):
+            start = str(first_start + i * RESULTS_PER_PAGE)
+            pages.append({
+                'query': query,
+                'encoded_query': quote_plus(query),
+                'start': start,
+                'language': language,
+                'mobile': mobile,
+                'cache_key': cache_key(query, start, language, mobile),
+            })
+    return pages, max_concurrency
+
+
+def handle_batch_request(request_json, bright_data_api_key, client, serp_search_table_ref, serp_results_table_ref):
+    """Fetches every query/page of a multi-query request concurrently and stores them with batched inserts."""
+    try:
+        pages, max_concurrency = parse_batch_request(request_json)
+    except ValueError as e:
+        return jsonify({'error': str(e), 'status': 'error'}), 400
+
+    # Serve pages from the cache, coalesce with identical in-flight fetches on
+    # this instance, and fetch only the remaining distinct pages upstream.
+    cache = get_serp_cache()
+    results = {}
+    leader_pages = []
+    leader_keys = set()
+    follower_futures = {}
+    for page in pages:
+        key = page['cache_key']
+        if key in results or key in follower_futures or key in leader_keys:
+            continue
+        cached = cache.get(key)
+        if cached is not None:
+            results[key] = {'serp_data': cached, 'error': None, 'source': 'cache'}
+            continue
+        future, is_leader = cache.claim(key)
+        if is_leader:
+            leader_pages.append(page)
+            leader_keys.add(key)
+        else:
+            follower_futures[key] = future
+
+    print(f"Fetching {len(leader_pages)} of {len(pages)} SERP pages with concurrency {max_concurrency} "
+          f"({len(results)} cached, {len(follower_futures)} already in flight)")
+    # Followers (here and in other requests) are only told a leader page's
+    # result once it is stored, so they never report rows as uploaded when the
+    # insert failed. Leader pages are settled before this request waits on
+    # its own followers, so two overlapping batches cannot wait on each other.
+    fetch_start = time.perf_counter()
+    try:
+        fetched = fetch_serp_pages(bright_data_api_key, leader_pages, max_concurrency=max_concurrency) if leader_pages else []
+        fetch_seconds = time.perf_counter() - fetch_start
+
+        # Only freshly fetched pages are written; cached and coalesced pages
+        # were stored by the request that fetched them.
+        search_rows = []
+        result_rows = []
+        fetched_pages = []
+        for page in fetched:
+            key = page['cache_key']
+            result = {'serp_data': page['serp_data'], 'error': page['error'], 'source': 'fetched', 'rows': 0}
+            results[key] = result
+            if page['error']:
+                cache.fail(key, RuntimeError(page['error']))
+                continue
+            try:
+                search_row = build_search_row(page['query'], page['start'], page['serp_data'])
+                rows = build_result_rows(page['query'], page['serp_data'])
+            except (KeyError, TypeError) as e:
+                result['error'] = f"Unexpected SERP response shape: missing {e}"
+                cache.fail(key, RuntimeError(result['error']))
+                continue
+            search_rows.append(search_row)
+            result_rows.extend(rows)
+            result['rows'] = len(rows)
+            fetched_pages.append(page)
+
+        insert_error = None
+        errors = insert_rows(client, serp_search_table_ref, search_rows) if search_rows else []
+        if errors:
+            insert_error = f'Failed to insert search metadata into BigQuery: {errors}'
+        elif result_rows:
+            errors = insert_rows(client, serp_results_table_ref, result_rows)
+            if errors:
+                insert_error = f'Failed to insert rows into BigQuery: {errors}'
+    except Exception as e:
+        for page in leader_pages:
+            cache.fail(page['cache_key'], e)
+        raise
+    if insert_error:
+        for page in fetched_pages:
+            cache.fail(page['cache_key'], RuntimeError(insert_error))
+        return jsonify({
+            'error': insert_error,
+            'status': 'error'
+        }), 500
+
+    # Cache pages only once they are stored, so a retry after a failed insert refetches
+    for page in fetched_pages:
+        cache.put(page['cache_key'], page['serp_data'])
+        cache.resolve(page['cache_key'], page['serp_data'])
+
+    for key, future in follower_futures.items():
+        try:
+            results[key] = {'serp_data': future.result(timeout=SINGLE_FLIGHT_TIMEOUT_SECONDS),
+                            'error': None, 'source': 'coalesced', 'rows': 0}
+        except Exception as e:
+            results[key] = {'serp_data': None, 'error': f"Coalesced request failed: {e}",
+                            'source': 'coalesced', 'rows': 0}
+
+    page_summaries = []
+    summarized_keys = set()
+    for page in pages:
+        result = results[page['cache_key']]
+        first = page['cache_key'] not in summarized_keys
+        summarized_keys.add(page['cache_key'])
+        page_summaries.append({'query': page['query'], 'start': page['start'],
+                               'rows': result.get('rows', 0) if first else 0,
+                               'source': result['source'], 'error': result['error']})
+    failed_pages = [summary for summary in page_summaries if summary['error']]
+    print(f"Resolved {len(pages) - len(failed_pages)}/{len(pages)} pages in {fetch_seconds:.2f}s; "
+          f"{len(result_rows)} new result rows")
+
+    if len(failed_pages) == len(pages):
+        return jsonify({
+            'error': 'All SERP requests failed',
+            'status': 'error',
+            'pages': page_summaries
+        }), 502
+
+    auto_scrape_summary = None
+    if request_json.get('auto_scrape'):
+        auto_scrape_summary = auto_scrape(
+            result['serp_data'] for result in results.values() if result['serp_data'] is not None
+        )
+
+    return jsonify({
+        'message': 'Successfully scraped and uploaded to BigQuery',
+        'queries': request_json['queries'],
+        'pages_requested': len(pages),
+        'pages_fetched': len(fetched_pages),
+        'pages_cached': sum(1 for summary in page_summaries if summary['source'] != 'fetched'),
+        'pages_failed': len(failed_pages),
+        'rows_inserted': len(result_rows),
+        'fetch_seconds': round(fetch_seconds, 2),
+        'auto_scrape': auto_scrape_summary,
+        'pages': page_summaries
+    })
+
 
 @functions_framework.http
 def hello_http(request):
     """HTTP Cloud Function.
+
+    Fetches one results page for the 'q' and 'start' query parameters, or -
+    for a JSON body with a "queries" list - every query to the requested page
+    depth concurrently (see parse_batch_request).
+
     Args:
         request (flask.Request): The request object.
         <https://flask.palletsprojects.com/en/1.1.x/api/#incoming-request-data>
@@ -29,113 +276,124 @@ def hello_http(request):
             'status': 'error'
         }), 500
 
-    # Get search query from request args, default to 'pizza' if not provided
-    search_query = request_args.get('q', 'pizza')
-    start_page = request_args.get('start', '0')
-    # URL encode the search query
-    encoded_query = quote_plus(search_query)
-
-    url = "https://api.brightdata.com/request"
-
-    payload = {
-        "zone": "social_listening_serp_api",
-        "url": f"https://www.google.com/search?q={encoded_query}&brd_json=1&start={start_page}",
-        "format": "json",
-        "method": "GET",
-    }
-    headers = {
-        "Authorization": f"Bearer {bright_data_api_key}",
-        "Content-Type": "application/json"
-    }
-
-    response = requests.request("POST", url, json=payload, headers=headers)
-    serp_data = response.json()
-    
-    # Extract the actual SERP data from the body and parse it as JSON
-    serp_data = json.loads(serp_data.get('body', '{}'))
-    
-    # Log the entire serp_data response
-    print("SERP API Response:", serp_data)
-
-    # Initialize BigQuery client
-    client = bigquery.Client()
-    
     # Get dataset and table IDs from environment variables
     dataset_id = os.environ.get('BIGQUERY_DATASET_ID')
     serp_search_table_id = os.environ.get('SERP_SEARCH_TABLE_ID')
     serp_results_table_id = os.environ.get('SERP_RESULTS_TABLE_ID')
-    
+
     if not dataset_id or not serp_search_table_id or not serp_results_table_id:
         return jsonify({
             'error': 'BIGQUERY_DATASET_ID, SERP_SEARCH_TABLE_ID, or SERP_RESULTS_TABLE_ID environment variables not set',
             'status': 'error'
         }), 500
-        
+
+    # Shared BigQuery client (created once per instance)
+    client = get_bigquery_client()
     serp_search_table_ref = f"{client.project}.{dataset_id}.{serp_search_table_id}"
     serp_results_table_ref = f"{client.project}.{dataset_id}.{serp_results_table_id}"
 
-    serp_search_request_id = serp_data['input']['request_id'] 
-    serp_search_search_engine = serp_data['general']['search_engine']
-    serp_search_results_cnt = serp_data['general']['results_cnt']
-    serp_search_search_time = serp_data['general']['search_time']
-    serp_search_language = serp_data['general']['language']
-    serp_search_mobile = serp_data['general']['mobile']
-    serp_search_timestamp = serp_data['general']['timestamp']
-    
-    # Insert search metadata into search table
-    search_row = {
-        'request_id': serp_search_request_id,
-        'search_query': search_query,
-        'search_engine': serp_search_search_engine,
-        'results_count': serp_search_results_cnt,
-        'search_time': serp_search_search_time,
-        'language': serp_search_language,
-        'is_mobile': str(serp_search_mobile),
-        'timestamp': serp_search_timestamp,
-        'pagination_start': start_page
+    if request_json and 'queries' in request_json:
+        return handle_batch_request(request_json, bright_data_api_key, client,
+                                    serp_search_table_ref, serp_results_table_ref)
+
+    # Get search query from request args, default to 'pizza' if not provided
+    search_query = request_args.get('q', 'pizza')
+    start_page = request_args.get('start', '0')
+    try:
+        if int(start_page) < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({
+            'error': "'start' must be a non-negative integer",
+            'status': 'error'
+        }), 400
+    # Canonical form, so '010' and '10' share a cache entry and a Google URL
+    start_page = str(int(start_page))
+    language = request_args.get('hl', '')
+    mobile = request_args.get('mobile', '').lower() in ('1', 'true')
+    # auto_scrape=1 sends the Reddit/Quora links straight to the social scrape initiator
+    auto_scrape_enabled = request_args.get('auto_scrape', '').lower() in ('1', 'true')
+    # URL encode the search query
+    encoded_query = quote_plus(search_query)
+
+    # Identical queries are answered from the cache (already stored in BigQuery
+    # by the request that fetched them) or share an in-flight fetch.
+    cache = get_serp_cache()
+    key = cache_key(search_query, start_page, language, mobile)
+    serp_data = cache.get(key)
+    source = 'cache'
+    if serp_data is None:
+        future, is_leader = cache.claim(key)
+        if not is_leader:
+            try:
+                serp_data = future.result(timeout=SINGLE_FLIGHT_TIMEOUT_SECONDS)
+                source = 'coalesced'
+            except Exception as e:
+                print(f"Coalesced SERP request failed, fetching directly: {e}")
+                is_leader = False
+    if serp_data is not None:
+        print(f"SERP {source} hit for {key}")
+        return jsonify({
+            'message': 'Served from SERP cache; results were already uploaded to BigQuery',
+            'query': search_query,
+            'serp_request_id': serp_data.get('input', {}).get('request_id'),
+            'cached': True,
+            'rows_inserted': 0,
+            'auto_scrape': auto_scrape([serp_data]) if auto_scrape_enabled else None
+        })
+
+    payload = build_serp_payload(encoded_query, start_page, language, mobile)
+    headers = {
+        "Authorization": f"Bearer {bright_data_api_key}",
+        "Content-Type": "application/json"
     }
 
-    errors = client.insert_rows_json(serp_search_table_ref, [search_row])
-    if errors:
+    # Followers are only told the leader's result once it is stored, so they
+    # never report rows as uploaded when the leader's insert failed
+    try:
+        response = get_http_session().post(BRIGHT_DATA_REQUEST_URL, json=payload, headers=headers)
+
+        # Extract the actual SERP data from the body and parse it as JSON
+        serp_data = parse_serp_body(response.json())
+
+        # Log the entire serp_data response
+        print("SERP API Response:", serp_data)
+
+        # Insert search metadata into search table
+        search_row = build_search_row(search_query, start_page, serp_data)
+
+        insert_error = None
+        errors = client.insert_rows_json(serp_search_table_ref, [search_row])
+        if errors:
+            insert_error = f'Failed to insert search metadata into BigQuery: {errors}'
+        else:
+            # Prepare rows for BigQuery from the organic results
+            rows_to_insert = build_result_rows(search_query, serp_data)
+
+            # Upload to BigQuery
+            if rows_to_insert:
+                errors = client.insert_rows_json(serp_results_table_ref, rows_to_insert)
+                if errors:
+                    insert_error = f'Failed to insert rows into BigQuery: {errors}'
+    except Exception as e:
+        if is_leader:
+            cache.fail(key, e)
+        raise
+    if insert_error:
+        if is_leader:
+            cache.fail(key, RuntimeError(insert_error))
         return jsonify({
-            'error': f'Failed to insert search metadata into BigQuery: {errors}',
+            'error': insert_error,
             'status': 'error'
         }), 500
 
-    # Extract results for processing
-    # Prepare rows for BigQuery
-
-    rows_to_insert = []
-    # Process organic results
-    
-    if 'organic' in serp_data:
-        for result in serp_data['organic']:
-
-            # Generate row data matching the schema
-            row = {
-                'id': str(uuid.uuid4()),
-                'query': search_query,
-                'serp_request_id': serp_search_request_id,
-                'link': result.get('link'),
-                'title': result.get('title'),
-                'description': result.get('description',''),
-                'rank': result.get('rank'),
-                'global_rank': result.get('global_rank'),
-                'created_at': serp_search_timestamp
-            }
-            rows_to_insert.append(row)
-
-    # Upload to BigQuery
-    if rows_to_insert:
-        errors = client.insert_rows_json(serp_results_table_ref, rows_to_insert)
-        if errors:
-            return jsonify({
-                'error': f'Failed to insert rows into BigQuery: {errors}',
-                'status': 'error'
-            }), 500
+    cache.put(key, serp_data)
+    if is_leader:
+        cache.resolve(key, serp_data)
 
     return jsonify({
         'message': 'Successfully scraped and uploaded to BigQuery',
         'query': search_query,
-        'rows_inserted': len(rows_to_insert)
+        'rows_inserted': len(rows_to_insert),
+        'auto_scrape': auto_scrape([serp_data]) if auto_scrape_enabled else None
     })
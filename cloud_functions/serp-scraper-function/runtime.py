@@ -0,0 +1,76 @@
+"""
+Instance-wide clients for the SERP scraper.
+
+The BigQuery client, the GCS client (for the optional SERP cache bucket) and a
+pooled requests.Session for the Bright Data SERP API are created lazily on the first request and reused for the lifetime of the
+instance, so warm requests skip client construction and the TLS handshake.
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.cloud import bigquery, storage
+
+_lock = threading.Lock()
+_bigquery_client = None
+_storage_client = None
+_http_session = None
+
+# Milliseconds spent creating each client on this instance
+init_timings_ms = {}
+
+
+def _timed_init(name, factory):
+    start = time.perf_counter()
+    resource = factory()
+    init_timings_ms[name] = round((time.perf_counter() - start) * 1000, 1)
+    print(f"Initialized {name} in {init_timings_ms[name]} ms")
+    return resource
+
+
+def get_bigquery_client():
+    """Returns the instance-wide BigQuery client."""
+    global _bigquery_client
+    if _bigquery_client is None:
+        with _lock:
+            if _bigquery_client is None:
+                _bigquery_client = _timed_init('bigquery_client', bigquery.Client)
+    return _bigquery_client
+
+
+def get_storage_client():
+    """Returns the instance-wide GCS client."""
+    global _storage_client
+    if _storage_client is None:
+        with _lock:
+            if _storage_client is None:
+                _storage_client = _timed_init('storage_client', storage.Client)
+    return _storage_client
+
+
+def _create_http_session():
+    session = requests.Session()
+    # A SERP request has no side effects, so rate limiting and transient
+    # server errors are retried with exponential backoff.
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'GET', 'POST'}),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=32, max_retries=retry)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_http_session():
+    """Returns the instance-wide requests.Session for the Bright Data API."""
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                _http_session = _timed_init('http_session', _create_http_session)
+    return _http_session
@@ -0,0 +1,102 @@
+"""
+Concurrent SERP page fetching for multi-query requests.
+
+All (query, start) pages of a request are fetched from the Bright Data SERP API
+with one httpx.AsyncClient, at most max_concurrency requests in flight. 429 and
+5xx responses are retried with exponential backoff, honouring Retry-After.
+"""
+import asyncio
+import json
+import random
+from urllib.parse import quote_plus
+
+import httpx
+
+BRIGHT_DATA_REQUEST_URL = "https://api.brightdata.com/request"
+SERP_ZONE = "social_listening_serp_api"
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def build_serp_payload(encoded_query, start, language='', mobile=False):
+    """Builds the Bright Data request payload for one Google results page."""
+    url = f"https://www.google.com/search?q={encoded_query}&brd_json=1&start={start}"
+    if language:
+        url += f"&hl={quote_plus(language)}"
+    if mobile:
+        url += "&brd_mobile=1"
+    return {
+        "zone": SERP_ZONE,
+        "url": url,
+        "format": "json",
+        "method": "GET",
+    }
+
+
+def parse_serp_body(response_json):
+    """Extracts the SERP JSON carried as a string in the Bright Data response body."""
+    return json.loads(response_json.get('body', '{}'))
+
+
+async def _fetch_page(client, semaphore, headers, page, max_retries):
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            try:
+                response = await client.post(
+                    BRIGHT_DATA_REQUEST_URL,
+                    json=build_serp_payload(page['encoded_query'], page['start'],
+                                            page.get('language', ''), page.get('mobile', False)),
+                    headers=headers,
+                )
+            except httpx.TransportError as e:
+                if attempt == max_retries:
+                    return {**page, 'serp_data': None, 'error': f"{type(e).__name__}: {e}"}
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+                continue
+
+            if response.status_code in RETRYABLE_STATUS_CODES and attempt < max_retries:
+                retry_after = response.headers.get('Retry-After')
+                try:
+                    delay = float(retry_after) if retry_after else random.uniform(0, 0.5 * 2 ** attempt)
+                except ValueError:
+                    delay = random.uniform(0, 0.5 * 2 ** attempt)
+                await asyncio.sleep(min(delay, 30))
+                continue
+            if response.status_code >= 400:
+                return {**page, 'serp_data': None, 'error': f"HTTP {response.status_code}: {response.text[:200]}"}
+            try:
+                return {**page, 'serp_data': parse_serp_body(response.json()), 'error': None}
+            except ValueError as e:
+                return {**page, 'serp_data': None, 'error': f"Invalid SERP response: {e}"}
+
+
+async def _fetch_all(api_key, pages, max_concurrency, timeout, max_retries):
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        return await asyncio.gather(*(
+            _fetch_page(client, semaphore, headers, page, max_retries) for page in pages
+        ))
+
+
+def fetch_serp_pages(api_key, pages, max_concurrency=10, timeout=60.0, max_retries=3):
+    """
+    Fetches many SERP pages concurrently.
+
+    Args:
+        api_key: Bright Data API key.
+        pages: List of dicts with 'query', 'encoded_query', 'start' and
+            optionally 'language' and 'mobile'.
+        max_concurrency: Maximum number of requests in flight.
+        timeout: Per-request timeout in seconds.
+        max_retries: Retries for 429/5xx responses and connection errors.
+
+    Returns:
+        List of the page dicts, in input order, each extended with 'serp_data'
+        (parsed SERP JSON, or None) and 'error' (None on success).
+    """
+    return asyncio.run(_fetch_all(api_key, pages, max(1, max_concurrency), timeout, max_retries))
@@ -0,0 +1,180 @@
+"""
+Cache of parsed SERP payloads with single-flight request coalescing.
+
+Entries are keyed by the normalized (query, start, language, mobile) tuple and
+expire after SERP_CACHE_TTL_SECONDS. Each instance keeps an LRU of up to
+SERP_CACHE_MAX_ENTRIES payloads; when SERP_CACHE_BUCKET is set, payloads are
+also written to gs://<bucket>/serp_cache/ so other instances (and cold starts)
+can reuse them.
+
+Concurrent identical requests on one instance are coalesced: the first caller
+becomes the leader and fetches, the others wait for the leader's result
+instead of calling Bright Data themselves.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+TTL_SECONDS = int(os.environ.get('SERP_CACHE_TTL_SECONDS', str(6 * 3600)))
+MAX_ENTRIES = int(os.environ.get('SERP_CACHE_MAX_ENTRIES', '2000'))
+CACHE_BUCKET = os.environ.get('SERP_CACHE_BUCKET')
+CACHE_PREFIX = 'serp_cache/'
+# How long a follower waits for the leader's fetch before giving up
+SINGLE_FLIGHT_TIMEOUT_SECONDS = 120
+
+
+def cache_key(query, start, language='', mobile=False):
+    """Returns the cache key for a SERP page; queries differing only in case or spacing share a key."""
+    normalized_query = ' '.join(query.split()).casefold()
+    return (normalized_query, str(int(start or 0)), (language or '').lower(), bool(mobile))
+
+
+def _object_name(key):
+    digest = hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+    return f"{CACHE_PREFIX}{digest}.json"
+
+
+class SerpCache:
+    """LRU + TTL cache of SERP payloads, optionally backed by GCS."""
+
+    def __init__(self, ttl_seconds=TTL_SECONDS, max_entries=MAX_ENTRIES, bucket_name=CACHE_BUCKET,
+                 storage_client_factory=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.bucket_name = bucket_name
+        self._storage_client_factory = storage_client_factory
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'gcs_hits': 0, 'misses': 0, 'coalesced': 0}
+
+    # --- Local LRU ---
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            cached_at, value = entry
+            if time.time() - cached_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _put_local(self, key, value, cached_at):
+        with self._lock:
+            self._entries[key] = (cached_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # --- GCS backing ---
+
+    def _bucket(self):
+        if not self.bucket_name or self._storage_client_factory is None:
+            return None
+        return self._storage_client_factory().bucket(self.bucket_name)
+
+    def _get_remote(self, key):
+        bucket = self._bucket()
+        if bucket is None:
+            return None
+        try:
+            blob = bucket.blob(_object_name(key))
+            document = json.loads(blob.download_as_bytes())
+        except Exception as e:
+            # NotFound is the normal miss; anything else only costs a fetch
+            if type(e).__name__ != 'NotFound':
+                print(f"SERP cache read from GCS failed: {e}")
+            return None
+        if time.time() - document['cached_at'] > self.ttl_seconds:
+            return None
+        self._put_local(key, document['serp_data'], document['cached_at'])
+        return document['serp_data']
+
+    def _put_remote(self, key, value, cached_at):
+        bucket = self._bucket()
+        if bucket is None:
+            return
+        try:
+            bucket.blob(_object_name(key)).upload_from_string(
+                json.dumps({'key': key, 'cached_at': cached_at, 'serp_data': value}),
+                content_type='application/json',
+            )
+        except Exception as e:
+            print(f"SERP cache write to GCS failed: {e}")
+
+    # --- Public API ---
+
+    def get(self, key):
+        """Returns the cached payload for key, or None."""
+        value = self._get_local(key)
+        if value is not None:
+            self.stats['hits'] += 1
+            return value
+        value = self._get_remote(key)
+        if value is not None:
+            self.stats['gcs_hits'] += 1
+            return value
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        """Stores a payload locally and, if configured, in GCS."""
+        cached_at = time.time()
+        self._put_local(key, value, cached_at)
+        self._put_remote(key, value, cached_at)
+
+    def claim(self, key):
+        """
+        Registers interest in fetching key.
+
+        Returns:
+            Tuple (future, is_leader). The leader must call resolve() or fail()
+            for the key; other callers wait on the future.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.stats['coalesced'] += 1
+                return future, False
+            future = Future()
+            self._inflight[key] = future
+            return future, True
+
+    def resolve(self, key, value):
+        """Publishes the leader's result to waiting callers."""
+        with self._lock:
+            future = self._inflight.pop(key, None)
+        if future is not None:
+            future.set_result(value)
+
+    def fail(self, key, error):
+        """Propagates the leader's failure to waiting callers."""
+        with self._lock:
+            future = self._inflight.pop(key, None)
+        if future is not None:
+            future.set_exception(error)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_serp_cache():
+    """Returns the instance-wide SERP cache."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                storage_client_factory = None
+                if CACHE_BUCKET:
+                    from runtime import get_storage_client
+                    storage_client_factory = get_storage_client
+                _cache = SerpCache(storage_client_factory=storage_client_factory)
+    return _cache
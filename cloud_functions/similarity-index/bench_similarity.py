@@ -0,0 +1,92 @@
+"""
+Recall/latency benchmark of the IVF-flat index against exact search.
+
+By default the corpus is synthetic: clustered 768-dimensional vectors (the
+size of text-embedding-004) with noise, which is harder for IVF than real
+topic-clustered embeddings but has the same shape. Pass --index with an index
+saved by the function (a local copy of the GCS .npz) to benchmark real data.
+
+For each n_probe value the script reports mean recall@k against brute-force
+search over the same vectors, and p50/p95 per-query latency.
+
+Usage:
+    python bench_similarity.py
+    python bench_similarity.py --n 200000 --n-lists 512 --n-probe 4 8 16 32
+    python bench_similarity.py --index /tmp/similarity_index.npz
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ivf_index import IVFFlatIndex, normalize
+
+
+def synthetic_corpus(n, dim, n_clusters, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = normalize(rng.standard_normal((n_clusters, dim)))
+    labels = rng.integers(0, n_clusters, n)
+    vectors = centers[labels] + noise * rng.standard_normal((n, dim)).astype(np.float32) / np.sqrt(dim)
+    return [f"item_{i}" for i in range(n)], normalize(vectors)
+
+
+def percentile_ms(samples, q):
+    return float(np.percentile(samples, q) * 1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--index', help="Benchmark a saved index (.npz) instead of a synthetic corpus")
+    parser.add_argument('--n', type=int, default=100_000, help="Synthetic corpus size")
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--clusters', type=int, default=200, help="Synthetic topic clusters")
+    parser.add_argument('--noise', type=float, default=1.0, help="Synthetic within-cluster spread")
+    parser.add_argument('--n-lists', type=int, default=None, help="Inverted lists (default sqrt(n))")
+    parser.add_argument('--n-probe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    if args.index:
+        with open(args.index, 'rb') as f:
+            index = IVFFlatIndex.from_bytes(f.read())
+        print(f"Loaded index: {len(index)} vectors, {index.n_lists} lists")
+    else:
+        ids, vectors = synthetic_corpus(args.n, args.dim, args.clusters, args.noise)
+        start = time.perf_counter()
+        index = IVFFlatIndex.build(ids, vectors, n_lists=args.n_lists)
+        print(f"Built index: {len(index)} vectors x {args.dim} dims, {index.n_lists} lists "
+              f"in {time.perf_counter() - start:.1f}s")
+
+    rng = np.random.default_rng(1)
+    query_ids = [str(index.ids[i]) for i in rng.choice(len(index), args.queries, replace=False)]
+    queries = [index.vector_for(query_id) for query_id in query_ids]
+
+    exact = []
+    exact_times = []
+    for query_id, query in zip(query_ids, queries):
+        start = time.perf_counter()
+        ids, _ = index.exact_search(query, k=args.k + 1)
+        exact_times.append(time.perf_counter() - start)
+        exact.append(set([i for i in ids if i != query_id][:args.k]))
+
+    print(f"\n{'method':<16}{'recall@' + str(args.k):>12}{'p50 ms':>10}{'p95 ms':>10}{'scanned':>10}")
+    print(f"{'exact':<16}{1.0:>12.3f}{percentile_ms(exact_times, 50):>10.2f}"
+          f"{percentile_ms(exact_times, 95):>10.2f}{1.0:>10.1%}")
+
+    list_sizes = np.diff(index.list_offsets)
+    for n_probe in args.n_probe:
+        recalls = []
+        times = []
+        for query_id, query, truth in zip(query_ids, queries, exact):
+            start = time.perf_counter()
+            ids, _ = index.search(query, k=args.k, n_probe=n_probe, exclude=query_id)
+            times.append(time.perf_counter() - start)
+            recalls.append(len(truth.intersection(ids)) / len(truth))
+        scanned = min(1.0, n_probe * list_sizes.mean() / len(index))
+        print(f"{'ivf n_probe=' + str(n_probe):<16}{np.mean(recalls):>12.3f}{percentile_ms(times, 50):>10.2f}"
+              f"{percentile_ms(times, 95):>10.2f}{scanned:>10.1%}")
+
+
+if __name__ == '__main__':
+    main()
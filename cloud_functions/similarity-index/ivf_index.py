@@ -0,0 +1,223 @@
+"""
+IVF-flat nearest-neighbour index over L2-normalized float32 embeddings.
+
+Vectors are partitioned into n_lists clusters by spherical k-means. A query is
+compared with the centroids, and only the vectors of the n_probe closest lists
+are scanned exactly, so a search touches roughly n_probe / n_lists of the data.
+Scores are cosine similarities (dot products of normalized vectors).
+
+Vectors are stored grouped by list (list_offsets delimits each list), so a
+probe is a contiguous slice and a single matrix product.
+"""
+from __future__ import annotations
+
+import io
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Returns float32 row-normalized copies of vectors (zero rows stay zero)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 20, sample_size: int = 100_000,
+                     seed: int = 0) -> np.ndarray:
+    """
+    Trains cosine k-means centroids on (a sample of) normalized vectors.
+
+    Returns:
+        (n_clusters, dim) array of normalized centroids.
+    """
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # Per-cluster sums via one sort + reduceat (np.add.at is far slower)
+        order = np.argsort(assignments, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        nonempty = counts > 0
+        sums[nonempty] = np.add.reduceat(vectors[order], starts[nonempty], axis=0)
+        empty = counts == 0
+        if empty.any():
+            # Reseed empty clusters with random points
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+class IVFFlatIndex:
+    """Inverted-file index with exact (flat) scoring inside each probed list."""
+
+    def __init__(self, centroids: np.ndarray, ids: np.ndarray, vectors: np.ndarray, list_offsets: np.ndarray,
+                 watermark: str | None = None):
+        self.centroids = centroids
+        self.ids = ids
+        self.vectors = vectors
+        self.list_offsets = list_offsets
+        self.watermark = watermark
+        self._positions = {unified_id: i for i, unified_id in enumerate(ids.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    # --- Building ---
+
+    @classmethod
+    def _from_assignments(cls, centroids, ids, vectors, assignments, watermark):
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=len(centroids))
+        list_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(centroids, ids[order], np.ascontiguousarray(vectors[order]), list_offsets, watermark)
+
+    @classmethod
+    def build(cls, ids, vectors, n_lists: int | None = None, n_iter: int = 20,
+              watermark: str | None = None) -> "IVFFlatIndex":
+        """
+        Builds an index from scratch.
+
+        Args:
+            ids: Sequence of unified_ids.
+            vectors: (n, dim) embeddings; normalized here.
+            n_lists: Number of inverted lists (default ~sqrt(n)).
+            n_iter: k-means iterations.
+            watermark: Highest embedding_generated_at included, for incremental refresh.
+        """
+        ids = np.asarray(ids, dtype=str)
+        vectors = normalize(vectors)
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(len(ids))))
+        n_lists = min(n_lists, len(ids))
+        centroids = spherical_kmeans(vectors, n_lists, n_iter=n_iter)
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        return cls._from_assignments(centroids, ids, vectors, assignments, watermark)
+
+    def _assignments(self) -> np.ndarray:
+        return np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets))
+
+    def add(self, ids, vectors, watermark: str | None = None) -> "IVFFlatIndex":
+        """
+        Returns a new index with the given vectors added (replacing existing ids).
+
+        Centroids are kept; rebuild periodically if the data drifts.
+        """
+        ids = np.asarray(ids, dtype=str)
+        vectors = normalize(vectors)
+        keep = np.ones(len(self.ids), dtype=bool)
+        replaced = [self._positions[i] for i in ids.tolist() if i in self._positions]
+        keep[replaced] = False
+
+        new_assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+        all_ids = np.concatenate((self.ids[keep], ids))
+        all_vectors = np.concatenate((self.vectors[keep], vectors))
+        all_assignments = np.concatenate((self._assignments()[keep], new_assignments))
+        return self._from_assignments(self.centroids, all_ids, all_vectors, all_assignments,
+                                      watermark or self.watermark)
+
+    # --- Searching ---
+
+    def vector_for(self, unified_id: str) -> np.ndarray | None:
+        """Returns the stored (normalized) vector of an id, or None."""
+        position = self._positions.get(unified_id)
+        return None if position is None else self.vectors[position]
+
+    def search(self, query: np.ndarray, k: int = 10, n_probe: int = 8,
+               exclude: str | None = None) -> tuple[list[str], list[float]]:
+        """
+        Returns the k most similar ids and their cosine scores.
+
+        Args:
+            query: (dim,) query vector; normalized here.
+            k: Number of neighbours.
+            n_probe: Number of inverted lists scanned.
+            exclude: Optional id to leave out (the query item itself).
+        """
+        query = normalize(query.reshape(1, -1))[0]
+        n_probe = min(n_probe, self.n_lists)
+        centroid_scores = self.centroids @ query
+        probe = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe] if n_probe < self.n_lists \
+            else np.arange(self.n_lists)
+
+        candidate_ids = []
+        candidate_scores = []
+        for list_id in probe:
+            start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            if start == end:
+                continue
+            candidate_scores.append(self.vectors[start:end] @ query)
+            candidate_ids.append(np.arange(start, end))
+        if not candidate_scores:
+            return [], []
+        scores = np.concatenate(candidate_scores)
+        positions = np.concatenate(candidate_ids)
+
+        wanted = k + (1 if exclude is not None else 0)
+        if len(scores) > wanted:
+            top = np.argpartition(-scores, wanted - 1)[:wanted]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+
+        result_ids = []
+        result_scores = []
+        for i in top:
+            unified_id = str(self.ids[positions[i]])
+            if unified_id == exclude:
+                continue
+            result_ids.append(unified_id)
+            result_scores.append(float(scores[i]))
+        return result_ids[:k], result_scores[:k]
+
+    def exact_search(self, query: np.ndarray, k: int = 10) -> tuple[list[str], list[float]]:
+        """Brute-force top-k over every vector (reference for recall measurements)."""
+        query = normalize(query.reshape(1, -1))[0]
+        scores = self.vectors @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [str(self.ids[i]) for i in top], [float(scores[i]) for i in top]
+
+    # --- Persistence ---
+
+    def to_bytes(self) -> bytes:
+        """Serializes the index as an uncompressed .npz (no pickled objects)."""
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            format_version=np.array(FORMAT_VERSION),
+            centroids=self.centroids,
+            ids=self.ids,
+            vectors=self.vectors,
+            list_offsets=self.list_offsets,
+            watermark=np.array(self.watermark or ''),
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "IVFFlatIndex":
+        with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+            if int(archive['format_version']) != FORMAT_VERSION:
+                raise ValueError(f"Unsupported index format {int(archive['format_version'])}")
+            return cls(
+                centroids=archive['centroids'],
+                ids=archive['ids'],
+                vectors=archive['vectors'],
+                list_offsets=archive['list_offsets'],
+                watermark=str(archive['watermark']) or None,
+            )
@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+import functions_framework
+from flask import jsonify
+from google.cloud import bigquery, storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from embedding_codec import EmbeddingCollector, filter_sql, select_sql
+from ivf_index import IVFFlatIndex
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+PROJECT_ID = os.environ.get('GCP_PROJECT', 'social-listening-sense')
+BIGQUERY_LOCATION = 'eu'  # Ensure this matches your dataset location
+INDEX_BUCKET = os.environ.get('SIMILARITY_INDEX_BUCKET')
+INDEX_OBJECT = os.environ.get('SIMILARITY_INDEX_OBJECT', 'similarity_index/index.npz')
+LOCAL_INDEX_PATH = os.environ.get('SIMILARITY_INDEX_LOCAL_PATH', '/tmp/similarity_index.npz')
+# Serving instances check GCS for a newer index at most this often
+RELOAD_CHECK_SECONDS = int(os.environ.get('SIMILARITY_INDEX_RELOAD_SECONDS', '60'))
+DEFAULT_N_PROBE = int(os.environ.get('SIMILARITY_INDEX_N_PROBE', '8'))
+MAX_K = 100
+EXPORT_PAGE_SIZE = 50_000
+# Incremental refreshes re-read embeddings this far behind the index watermark,
+# so rows committed late with an older embedding_generated_at are not missed
+WATERMARK_OVERLAP_MINUTES = 30
+# Embedding column exported: 'float64' or 'int8' (see embedding_codec.py).
+# float16 is not offered: it is backfilled after the MERGE, so an incremental
+# refresh could pass rows before their float16 column is written.
+INDEX_ENCODING = os.environ.get('SIMILARITY_INDEX_ENCODING', 'float64')
+if INDEX_ENCODING not in ('float64', 'int8'):
+    raise ValueError(f"SIMILARITY_INDEX_ENCODING must be float64 or int8, not '{INDEX_ENCODING}'")
+
+_lock = threading.Lock()
+_bigquery_client = None
+_storage_client = None
+_index = None
+_index_generation = None
+_last_reload_check = 0.0
+
+
+def get_bigquery_client() -> bigquery.Client:
+    global _bigquery_client
+    if _bigquery_client is None:
+        _bigquery_client = bigquery.Client(project=PROJECT_ID)
+    return _bigquery_client
+
+
+def get_storage_client() -> storage.Client:
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = storage.Client(project=PROJECT_ID)
+    return _storage_client
+
+
+# --- Export ---
+
+def export_embeddings(bigquery_dataset_id: str, since: str | None = None,
+                      encoding: str = INDEX_ENCODING) -> tuple[list[str], np.ndarray, str | None]:
+    """
+    Exports embeddings from embeddings_cache.
+
+    Args:
+        bigquery_dataset_id: The BigQuery dataset ID.
+        since: Only rows with embedding_generated_at after this ISO timestamp,
+            less WATERMARK_OVERLAP_MINUTES.
+        encoding: Embedding column to read; int8 scans 1/8 of the bytes.
+
+    Returns:
+        Tuple of (unified_ids, float32 embeddings array, highest embedding_generated_at as ISO string).
+    """
+    client = get_bigquery_client()
+    query = f"""
+    SELECT
+        ec.unified_id,
+        {select_sql(encoding)},
+        ec.embedding_generated_at
+    FROM
+        `{PROJECT_ID}.{bigquery_dataset_id}.embeddings_cache` AS ec
+    WHERE
+        {filter_sql(encoding)}
+        AND (@since IS NULL
+             OR ec.embedding_generated_at > TIMESTAMP_SUB(@since, INTERVAL {WATERMARK_OVERLAP_MINUTES} MINUTE))
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('since', 'TIMESTAMP', since),
+    ])
+    start = time.perf_counter()
+    rows = client.query(query, job_config=job_config, location=BIGQUERY_LOCATION).result(page_size=EXPORT_PAGE_SIZE)
+
+    ids = []
+    collector = EmbeddingCollector(encoding)
+    watermark = None
+    for row in rows:
+        ids.append(row.unified_id)
+        collector.add(row)
+        if row.embedding_generated_at is not None and (watermark is None or row.embedding_generated_at > watermark):
+            watermark = row.embedding_generated_at
+
+    embeddings = collector.to_array()
+    logger.info(f"Exported {len(ids)} {encoding} embeddings in {time.perf_counter() - start:.1f}s")
+    return ids, embeddings, watermark.isoformat() if watermark else None
+
+
+# --- Persistence ---
+
+def _index_blob():
+    return get_storage_client().bucket(INDEX_BUCKET).blob(INDEX_OBJECT)
+
+
+def save_index(index: IVFFlatIndex, if_generation_match: int | None = None) -> None:
+    """Writes the index to local disk and, if configured, to GCS."""
+    global _index, _index_generation
+    data = index.to_bytes()
+    tmp_path = f"{LOCAL_INDEX_PATH}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, LOCAL_INDEX_PATH)
+
+    generation = None
+    if INDEX_BUCKET:
+        blob = _index_blob()
+        # Guard against two concurrent refreshes overwriting each other
+        blob.upload_from_string(data, content_type='application/octet-stream',
+                                if_generation_match=if_generation_match)
+        generation = blob.generation
+    _index, _index_generation = index, generation
+    logger.info(f"Saved index with {len(index)} vectors ({len(data) / 1e6:.1f} MB)")
+
+
+def load_index(force_check: bool = False) -> IVFFlatIndex | None:
+    """Returns the current index, reloading it when GCS has a newer generation."""
+    global _index, _index_generation, _last_reload_check
+    with _lock:
+        now = time.monotonic()
+        if _index is not None and not force_check and now - _last_reload_check < RELOAD_CHECK_SECONDS:
+            return _index
+        _last_reload_check = now
+
+        if INDEX_BUCKET:
+            blob = _index_blob()
+            try:
+                blob.reload()
+            except NotFound:
+                return _index
+            if blob.generation != _index_generation:
+                start = time.perf_counter()
+                _index = IVFFlatIndex.from_bytes(blob.download_as_bytes())
+                _index_generation = blob.generation
+                logger.info(f"Loaded index generation {blob.generation} ({len(_index)} vectors) "
+                            f"in {time.perf_counter() - start:.2f}s")
+        elif _index is None and os.path.exists(LOCAL_INDEX_PATH):
+            with open(LOCAL_INDEX_PATH, 'rb') as f:
+                _index = IVFFlatIndex.from_bytes(f.read())
+        return _index
+
+
+# --- Build and refresh ---
+
+def rebuild_index(bigquery_dataset_id: str, n_lists: int | None = None) -> IVFFlatIndex:
+    """Builds the index from a full export of embeddings_cache."""
+    ids, embeddings, watermark = export_embeddings(bigquery_dataset_id)
+    if not ids:
+        raise ValueError("No embeddings found in embeddings_cache")
+    start = time.perf_counter()
+    index = IVFFlatIndex.build(ids, embeddings, n_lists=n_lists, watermark=watermark)
+    logger.info(f"Built index with {index.n_lists} lists over {len(index)} vectors "
+                f"in {time.perf_counter() - start:.1f}s")
+    save_index(index)
+    return index
+
+
+def refresh_index(bigquery_dataset_id: str) -> tuple[IVFFlatIndex, int]:
+    """
+    Adds embeddings generated since the index watermark; builds the index if there is none.
+
+    The export overlaps the previous one, so ids already in the index are
+    re-read; add() replaces them. The index is only rewritten when the export
+    brought new ids or moved the watermark.
+
+    Returns:
+        Tuple of (index, number of ids new to the index).
+    """
+    index = load_index(force_check=True)
+    if index is None:
+        index = rebuild_index(bigquery_dataset_id)
+        return index, len(index)
+    expected_generation = _index_generation
+    ids, embeddings, watermark = export_embeddings(bigquery_dataset_id, since=index.watermark)
+    if index.watermark and (watermark is None or
+                            datetime.fromisoformat(watermark) < datetime.fromisoformat(index.watermark)):
+        watermark = index.watermark
+    added = sum(1 for unified_id in ids if index.vector_for(unified_id) is None)
+    if not added and watermark == index.watermark:
+        return index, 0
+    index = index.add(ids, embeddings, watermark=watermark)
+    save_index(index, if_generation_match=expected_generation)
+    return index, added
+
+
+@functions_framework.http
+def similar_items(request):
+    """
+    HTTP Cloud Function serving nearest-neighbour queries over embeddings_cache.
+
+    Expected JSON payload:
+    {
+        "unified_id": "...",          # item to find neighbours for, or
+        "vector": [0.1, ...],         # a raw query embedding
+        "k": 10,                      # optional, number of neighbours
+        "n_probe": 8,                 # optional, lists scanned (recall/latency trade-off)
+        "action": "search",           # or "refresh" (add new embeddings) / "rebuild"
+        "bigquery_dataset_id": "..."  # required for refresh/rebuild
+    }
+    """
+    request_json = request.get_json(silent=True) or {}
+    action = request_json.get('action', 'search')
+
+    try:
+        if action in ('refresh', 'rebuild'):
+            bigquery_dataset_id = request_json.get('bigquery_dataset_id') or os.environ.get('BIGQUERY_DATASET_ID')
+            if not bigquery_dataset_id:
+                return jsonify({'error': 'bigquery_dataset_id is required'}), 400
+            start = time.perf_counter()
+            if action == 'rebuild':
+                index = rebuild_index(bigquery_dataset_id, n_lists=request_json.get('n_lists'))
+                added = len(index)
+            else:
+                index, added = refresh_index(bigquery_dataset_id)
+            return jsonify({
+                'status': 'success',
+                'action': action,
+                'vectors_added': added,
+                'index_size': len(index),
+                'n_lists': index.n_lists,
+                'watermark': index.watermark,
+                'duration_seconds': round(time.perf_counter() - start, 2)
+            }), 200
+
+        if action != 'search':
+            return jsonify({'error': f"Unknown action '{action}'"}), 400
+
+        start = time.perf_counter()
+        index = load_index()
+        if index is None:
+            return jsonify({'error': 'Similarity index has not been built yet; call with action "rebuild"'}), 503
+
+        k = max(1, min(int(request_json.get('k', 10)), MAX_K))
+        n_probe = max(1, int(request_json.get('n_probe', DEFAULT_N_PROBE)))
+        unified_id = request_json.get('unified_id')
+        if unified_id:
+            query = index.vector_for(unified_id)
+            if query is None:
+                return jsonify({'error': f"unified_id '{unified_id}' is not in the index"}), 404
+        elif request_json.get('vector'):
+            query = np.asarray(request_json['vector'], dtype=np.float32)
+            if query.shape != (index.vectors.shape[1],):
+                return jsonify({'error': f"vector must have {index.vectors.shape[1]} dimensions"}), 400
+        else:
+            return jsonify({'error': 'Provide unified_id or vector'}), 400
+
+        ids, scores = index.search(query, k=k, n_probe=n_probe, exclude=unified_id)
+        return jsonify({
+            'results': [{'unified_id': i, 'score': round(s, 6)} for i, s in zip(ids, scores)],
+            'k': k,
+            'n_probe': n_probe,
+            'index_size': len(index),
+            'latency_ms': round((time.perf_counter() - start) * 1000, 2)
+        }), 200
+
+    except PreconditionFailed:
+        return jsonify({'error': 'The index was updated concurrently; retry the refresh'}), 409
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in similar_items: {e}")
+        return jsonify({'error': str(e)}), 500
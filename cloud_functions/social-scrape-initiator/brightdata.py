@@ -0,0 +1,111 @@
+"""
+Chunked, concurrent triggering of Bright Data dataset collections.
+
+A large URL list is split into batches, and each batch is sent as its own
+trigger call (and so becomes its own snapshot). Calls run on a thread pool
+under a concurrency cap and a shared token-bucket rate limit, and 429/5xx
+responses are retried with exponential backoff and jitter.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Status codes worth retrying: rate limiting and transient server errors
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` acquisitions per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def chunk_urls(urls, batch_size):
+    """Splits the URL list into consecutive batches of at most batch_size URLs."""
+    return [urls[i:i + batch_size] for i in range(0, len(urls), batch_size)]
+
+
+def _retry_delay(response, attempt, base_delay, max_delay):
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return min(max_delay, float(retry_after))
+        except ValueError:
+            pass
+    # Full jitter keeps concurrent batches from retrying in lockstep
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def trigger_collection(session, api_url, payload, headers, rate_limiter,
+                       max_retries=4, base_delay=1.0, max_delay=30.0, timeout=60):
+    """
+    Sends one trigger request, retrying 429/5xx responses with exponential backoff.
+
+    Returns:
+        The decoded Bright Data response.
+
+    Raises:
+        requests.exceptions.RequestException: If the call fails after all retries.
+    """
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+        response = session.post(api_url, json=payload, headers=headers, timeout=timeout)
+        if response.status_code in RETRYABLE_STATUS_CODES and attempt < max_retries:
+            delay = _retry_delay(response, attempt, base_delay, max_delay)
+            print(f"Bright Data returned {response.status_code}; retrying in {delay:.1f}s "
+                  f"(attempt {attempt + 1}/{max_retries})")
+            time.sleep(delay)
+            continue
+        response.raise_for_status()
+        return response.json()
+
+
+def trigger_batches(session, api_url, payloads, headers, max_concurrency=4, rate_per_second=5.0):
+    """
+    Triggers one collection per payload concurrently.
+
+    Args:
+        session: requests.Session used for all calls.
+        api_url: Bright Data trigger URL.
+        payloads: List of trigger payloads, one per URL batch.
+        headers: Request headers (authorization).
+        max_concurrency: Maximum number of trigger calls in flight.
+        rate_per_second: Maximum number of trigger calls started per second.
+
+    Returns:
+        List of dicts, in payload order, with 'batch_index', 'response' and
+        'error' (None on success).
+    """
+    rate_limiter = TokenBucket(rate_per_second)
+
+    def run(index):
+        try:
+            response = trigger_collection(session, api_url, payloads[index], headers, rate_limiter)
+            return {'batch_index': index, 'response': response, 'error': None}
+        except requests.exceptions.RequestException as e:
+            print(f"Error triggering batch {index}: {e}")
+            return {'batch_index': index, 'response': None, 'error': str(e)}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(payloads)))) as pool:
+        return list(pool.map(run, range(len(payloads))))
@@ -4,19 +4,49 @@ import requests
 import os
 from google.cloud import bigquery # Import the BigQuery library
 import datetime # Import datetime to get the current timestamp
+import time
+from runtime import get_bigquery_client, get_http_session, get_table
+from brightdata import chunk_urls, trigger_batches
+from scrape_index import get_scrape_index
 
 # The base URL for the Bright Data API trigger
 BRIGHT_DATA_BASE_URL = "https://api.brightdata.com/datasets/v3/trigger"
 
-# Initialize BigQuery client (can be done outside the function for potential warm starts)
-# However, initializing inside ensures it's ready when the function is invoked.
-# For simplicity and clarity in this example, we'll initialize inside.
+# Fan-out defaults; batch_size and max_concurrency can be overridden per request
+DEFAULT_BATCH_SIZE = int(os.environ.get('BRIGHT_DATA_BATCH_SIZE', '100'))
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get('BRIGHT_DATA_MAX_CONCURRENCY', '4'))
+BRIGHT_DATA_RATE_PER_SECOND = float(os.environ.get('BRIGHT_DATA_RATE_PER_SECOND', '5'))
+
+# URLs scraped within this many hours are skipped; off (0) unless set here or
+# per request with max_age
+DEFAULT_MAX_AGE_HOURS = float(os.environ.get('SCRAPE_MAX_AGE_HOURS', '0'))
+
+# The BigQuery client, the Bright Data HTTP session and the scrape_job table
+# metadata live in runtime.py and are shared across requests on a warm instance.
+
+def build_bright_data_payload(urls, dataset_id, gcp_client_email, gcp_private_key):
+    """Builds the Bright Data trigger payload delivering one batch of URLs to GCS."""
+    return {
+        "deliver": {
+            "type": "gcs",
+            "filename": {"template": "{[snapshot_id]}", "extension": "json"},
+            "bucket":"brightdata-social-raw", # hardcoded bucket name
+            "credentials": {
+                # Use credentials from environment variables
+                "client_email": gcp_client_email,
+                "private_key": gcp_private_key
+            },
+            "directory":dataset_id
+        },
+        "input": [{"url": url} for url in urls] # Use the list of URLs from the request
+    }
 
 @functions_framework.http
 def process_urls(request):
     """
     Cloud Function to process a list of URLs provided in the request body,
-    trigger a Bright Data dataset collection, and record the job in BigQuery.
+    trigger Bright Data dataset collections (one per batch of URLs), and record
+    one scrape_job row per snapshot in BigQuery.
 
     Fetches API key and GCP credentials from environment variables.
     Receives the Bright Data dataset_id as a query parameter.
@@ -25,6 +55,9 @@ def process_urls(request):
         request (flask.Request): The request object.
         Expected query parameter: dataset_id=<your_dataset_id>
         Expected JSON body: {"urls": ["url1", "url2", ...]}
+        Optional JSON fields: "batch_size" (URLs per Bright Data trigger, i.e. per
+        snapshot), "max_concurrency" (trigger calls in flight) and "max_age"
+        (hours; URLs scraped more recently are skipped, 0 disables the check).
 
     Returns:
         A Flask response object indicating the status of the Bright Data API call
@@ -116,24 +149,56 @@ def process_urls(request):
                 if isinstance(urls_list, list):
                     print(f"Received a list of {len(urls_list)} URLs.")
 
-                    # Prepare the input list for the Bright Data API
-                    bright_data_input = [{"url": url} for url in urls_list]
-
-                    # Construct the full payload for the Bright Data API
-                    bright_data_payload = {
-                        "deliver": {
-                            "type": "gcs",
-                            "filename": {"template": "{[snapshot_id]}", "extension": "json"},
-                            "bucket":"brightdata-social-raw", # hardcoded bucket name
-                            "credentials": {
-                                # Use credentials from environment variables
-                                "client_email": gcp_client_email,
-                                "private_key": gcp_private_key
-                            },
-                            "directory":dataset_id_from_param
-                        },
-                        "input": bright_data_input # Use the list of URLs from the request
-                    }
+                    try:
+                        batch_size = int(request_json.get('batch_size', DEFAULT_BATCH_SIZE))
+                        max_concurrency = int(request_json.get('max_concurrency', DEFAULT_MAX_CONCURRENCY))
+                    except (TypeError, ValueError):
+                        return jsonify({
+                            "status": "error",
+                            "message": "'batch_size' and 'max_concurrency' must be integers"
+                        }), 400, headers
+                    if batch_size < 1 or max_concurrency < 1:
+                        return jsonify({
+                            "status": "error",
+                            "message": "'batch_size' and 'max_concurrency' must be positive"
+                        }), 400, headers
+                    try:
+                        max_age_hours = float(request_json.get('max_age', DEFAULT_MAX_AGE_HOURS) or 0)
+                    except (TypeError, ValueError):
+                        return jsonify({
+                            "status": "error",
+                            "message": "'max_age' must be a number of hours"
+                        }), 400, headers
+
+                    # Drop duplicates and URLs that were scraped within max_age
+                    scrape_index = get_scrape_index(bigquery_dataset_id, scrape_job_table_id, get_bigquery_client)
+                    try:
+                        urls_list, skipped_urls = scrape_index.filter_urls(dataset_id_from_param, urls_list, max_age_hours)
+                    except Exception as index_error:
+                        # The index only saves cost; never block a scrape on it
+                        print(f"Scrape index unavailable, scraping all URLs: {index_error}")
+                        skipped_urls = []
+                    if skipped_urls:
+                        print(f"Skipping {len(skipped_urls)} URL(s) already scraped or duplicated; {len(urls_list)} left.")
+
+                    if not urls_list:
+                        return jsonify({
+                            "status": "success",
+                            "message": "All URLs were duplicates or scraped recently; no Bright Data collection triggered",
+                            "bright_data_response": None,
+                            "snapshots": [],
+                            "failed_batches": [],
+                            "skipped_urls": skipped_urls,
+                            "bigquery_insert_status": "not attempted",
+                            "bigquery_insert_errors": None
+                        }), 200, headers
+
+                    # Split the URLs into batches; each batch becomes its own snapshot
+                    url_batches = chunk_urls(urls_list, batch_size)
+                    bright_data_payloads = [
+                        build_bright_data_payload(batch, dataset_id_from_param, gcp_client_email, gcp_private_key)
+                        for batch in url_batches
+                    ]
 
                     # --- Call the Bright Data API ---
                     bright_data_headers = {
@@ -141,89 +206,100 @@ def process_urls(request):
                         "Content-Type": "application/json"
                     }
 
-                    bright_data_response = None # Initialize response variable
                     bigquery_insert_status = "not attempted"
                     bigquery_insert_errors = None
 
-                    print(f"Calling Bright Data API: {bright_data_api_url}")
-                    try:
-                        response = requests.post(
-                            bright_data_api_url, # Use the dynamically constructed URL
-                            json=bright_data_payload,
-                            headers=bright_data_headers
-                        )
-                        response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-
-                        # Bright Data API call was successful
-                        bright_data_response = response.json()
-                        print("Bright Data API call successful.")
-                        print(f"Response: {bright_data_response}")
-
-                        # --- Extract snapshot_id and insert into BigQuery ---
-                        snapshot_id = bright_data_response.get("snapshot_id")
-
+                    print(f"Calling Bright Data API: {bright_data_api_url} with {len(url_batches)} batch(es) "
+                          f"of up to {batch_size} URLs, concurrency {max_concurrency}")
+                    trigger_start = time.perf_counter()
+                    trigger_results = trigger_batches(
+                        get_http_session(),
+                        bright_data_api_url,
+                        bright_data_payloads,
+                        bright_data_headers,
+                        max_concurrency=max_concurrency,
+                        rate_per_second=BRIGHT_DATA_RATE_PER_SECOND,
+                    )
+                    print(f"Triggered {len(url_batches)} batch(es) in {time.perf_counter() - trigger_start:.2f}s")
+
+                    # --- Collect snapshot IDs and record one scrape_job row per snapshot ---
+                    initiated_at = datetime.datetime.now(datetime.timezone.utc).isoformat() # Current UTC timestamp
+                    snapshots = []
+                    failed_batches = []
+                    rows_to_insert = []
+                    for result in trigger_results:
+                        batch_urls = url_batches[result['batch_index']]
+                        if result['error']:
+                            failed_batches.append({
+                                "batch_index": result['batch_index'],
+                                "urls_count": len(batch_urls),
+                                "error": result['error']
+                            })
+                            continue
+
+                        snapshot_id = result['response'].get("snapshot_id")
+                        snapshots.append({
+                            "batch_index": result['batch_index'],
+                            "snapshot_id": snapshot_id,
+                            "urls_count": len(batch_urls)
+                        })
                         if snapshot_id:
-                            print(f"Extracted snapshot_id: {snapshot_id}")
-
-                            # Initialize BigQuery client
-                            client = bigquery.Client()
-
-                            # Construct the table reference
-                            table_ref = client.dataset(bigquery_dataset_id).table(scrape_job_table_id)
-                            table = client.get_table(table_ref) # Get table schema
-
-                            # Prepare the row to insert
-                            row_to_insert = {
+                            scrape_index.record(dataset_id_from_param, batch_urls, snapshot_id,
+                                                datetime.datetime.fromisoformat(initiated_at))
+                            rows_to_insert.append({
                                 "snapshot_id": snapshot_id,
                                 "dataset_id": dataset_id_from_param, # Use the dataset_id from the query parameter
-                                "urls_in_batch": urls_list, # The list of URLs from the request body
-                                "total_urls_count": len(urls_list),
-                                "initiated_at": datetime.datetime.now(datetime.timezone.utc).isoformat() # Current UTC timestamp
-                            }
-
-                            print(f"Inserting row into BigQuery table: {bigquery_dataset_id}.{scrape_job_table_id}")
-                            print(f"Row data: {row_to_insert}")
-
-                            try:
-                                errors = client.insert_rows_json(table, [row_to_insert])
-
-                                if errors:
-                                    bigquery_insert_status = "failed"
-                                    bigquery_insert_errors = errors
-                                    print(f"BigQuery insertion errors: {errors}")
-                                else:
-                                    bigquery_insert_status = "success"
-                                    print("BigQuery insertion successful.")
-
-                            except Exception as bq_error:
-                                bigquery_insert_status = "failed"
-                                bigquery_insert_errors = str(bq_error)
-                                print(f"An error occurred during BigQuery insertion: {bq_error}")
-
+                                "urls_in_batch": batch_urls, # The URLs sent in this batch
+                                "total_urls_count": len(batch_urls),
+                                "initiated_at": initiated_at
+                            })
                         else:
-                            print("Warning: 'snapshot_id' not found in Bright Data API response.")
-                            # Decide how to handle this case - maybe still log to BQ with a different status?
-                            # For now, we'll just note it in the response.
-
+                            print(f"Warning: 'snapshot_id' not found in Bright Data API response for batch {result['batch_index']}.")
 
-                        # Return a success response with API response and BigQuery status
-                        return jsonify({
-                            "status": "success",
-                            "message": "Bright Data API triggered and BigQuery insertion attempted",
-                            "bright_data_response": bright_data_response,
-                            "bigquery_insert_status": bigquery_insert_status,
-                            "bigquery_insert_errors": bigquery_insert_errors
-                        }), 200, headers
-
-                    except requests.exceptions.RequestException as e:
-                        print(f"Error calling Bright Data API: {e}")
-                        # Return an error response if the API call fails
+                    if not snapshots:
+                        # Every batch failed to trigger
                         return jsonify({
                             "status": "error",
-                            "message": f"Failed to trigger Bright Data API: {e}",
-                            "bright_data_error": str(e)
+                            "message": f"Failed to trigger Bright Data API: {failed_batches[0]['error']}",
+                            "bright_data_error": failed_batches[0]['error'],
+                            "failed_batches": failed_batches,
+                            "skipped_urls": skipped_urls
                         }), 500, headers
 
+                    if rows_to_insert:
+                        print(f"Inserting {len(rows_to_insert)} row(s) into BigQuery table: {bigquery_dataset_id}.{scrape_job_table_id}")
+                        try:
+                            # Shared BigQuery client and cached table schema
+                            client = get_bigquery_client()
+                            table = get_table(bigquery_dataset_id, scrape_job_table_id)
+                            errors = client.insert_rows_json(table, rows_to_insert)
+
+                            if errors:
+                                bigquery_insert_status = "failed"
+                                bigquery_insert_errors = errors
+                                print(f"BigQuery insertion errors: {errors}")
+                            else:
+                                bigquery_insert_status = "success"
+                                print("BigQuery insertion successful.")
+
+                        except Exception as bq_error:
+                            bigquery_insert_status = "failed"
+                            bigquery_insert_errors = str(bq_error)
+                            print(f"An error occurred during BigQuery insertion: {bq_error}")
+
+                    # Return a success response with the Bright Data responses and BigQuery status.
+                    # bright_data_response holds the first batch's response for existing callers.
+                    return jsonify({
+                        "status": "success",
+                        "message": "Bright Data API triggered and BigQuery insertion attempted",
+                        "bright_data_response": next(r['response'] for r in trigger_results if not r['error']),
+                        "snapshots": snapshots,
+                        "failed_batches": failed_batches,
+                        "skipped_urls": skipped_urls,
+                        "bigquery_insert_status": bigquery_insert_status,
+                        "bigquery_insert_errors": bigquery_insert_errors
+                    }), 200, headers
+
                 else:
                     return jsonify({
                         "status": "error",
@@ -0,0 +1,79 @@
+"""
+Warm-instance resources for the social scrape initiator.
+
+Cloud Functions reuse an instance for many requests, so the BigQuery client,
+the HTTP session used for Bright Data (with its keep-alive connection pool) and
+table metadata are created once per instance, on first use, and shared by all
+later requests. Creation times are logged so cold-start cost is visible.
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.cloud import bigquery
+
+# Table metadata (schema) is refreshed after this many seconds
+TABLE_CACHE_TTL_SECONDS = 600
+
+_lock = threading.Lock()
+_bigquery_client = None
+_http_session = None
+_table_cache = {}
+
+# Milliseconds spent creating each shared resource on this instance
+init_timings_ms = {}
+
+
+def _timed_init(name, factory):
+    start = time.perf_counter()
+    resource = factory()
+    init_timings_ms[name] = round((time.perf_counter() - start) * 1000, 1)
+    print(f"Initialized {name} in {init_timings_ms[name]} ms (reused by later requests on this instance)")
+    return resource
+
+
+def get_bigquery_client():
+    """Returns the instance-wide BigQuery client, creating it on first use."""
+    global _bigquery_client
+    if _bigquery_client is None:
+        with _lock:
+            if _bigquery_client is None:
+                _bigquery_client = _timed_init('bigquery_client', bigquery.Client)
+    return _bigquery_client
+
+
+def _create_http_session():
+    session = requests.Session()
+    # Only connection failures are retried here: a trigger that reached Bright
+    # Data may have started a collection, so status-based retries are left to
+    # the caller.
+    retry = Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.5)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_http_session():
+    """Returns the instance-wide requests.Session with keep-alive connection pooling."""
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                _http_session = _timed_init('http_session', _create_http_session)
+    return _http_session
+
+
+def get_table(dataset_id, table_id):
+    """Returns table metadata, cached per instance for TABLE_CACHE_TTL_SECONDS."""
+    key = (dataset_id, table_id)
+    cached = _table_cache.get(key)
+    now = time.monotonic()
+    if cached and now - cached[0] < TABLE_CACHE_TTL_SECONDS:
+        return cached[1]
+    client = get_bigquery_client()
+    table = client.get_table(client.dataset(dataset_id).table(table_id))
+    _table_cache[key] = (now, table)
+    return table
@@ -0,0 +1,213 @@
+"""
+In-memory index of recently scraped URLs.
+
+Maps (Bright Data dataset_id, normalized URL) to the most recent initiated_at
+and snapshot_id recorded in scrape_job.urls_in_batch, so process_urls can drop
+URLs that were already collected within a caller-supplied max_age instead of
+paying Bright Data to scrape them again.
+
+The index lives on the warm instance. The first lookup loads the last
+SCRAPE_INDEX_LOOKBACK_HOURS of scrape_job; later lookups only fetch rows newer
+than the highest initiated_at already seen (at most once every
+SCRAPE_INDEX_REFRESH_SECONDS). Snapshots triggered by this instance are added
+immediately. A Bloom filter sits in front of the dict so the common case - a
+URL never scraped before - is answered from a compact bit array.
+"""
+import datetime
+import hashlib
+import math
+import os
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+from google.cloud import bigquery
+
+# How far back the initial load reaches; max_age values beyond this see no older scrapes
+LOOKBACK_HOURS = int(os.environ.get('SCRAPE_INDEX_LOOKBACK_HOURS', '720'))
+# Minimum interval between incremental refreshes from scrape_job
+REFRESH_SECONDS = int(os.environ.get('SCRAPE_INDEX_REFRESH_SECONDS', '60'))
+# Incremental refreshes re-read this far behind the watermark, so rows streamed
+# late by other instances (clock skew, slow inserts) are not missed
+REFRESH_OVERLAP = datetime.timedelta(minutes=5)
+
+# Hosts that serve the same content as their canonical host
+_HOST_ALIASES = {
+    'old.reddit.com': 'reddit.com',
+    'new.reddit.com': 'reddit.com',
+    'np.reddit.com': 'reddit.com',
+    'm.reddit.com': 'reddit.com',
+    'm.quora.com': 'quora.com',
+}
+
+
+def normalize_url(url):
+    """
+    Normalizes a URL so trivially different spellings map to the same key.
+
+    Lowercases the scheme and host, drops 'www.' and mobile/legacy Reddit and
+    Quora host prefixes, the query string, the fragment and any trailing slash.
+    """
+    url = (url or '').strip()
+    try:
+        parts = urlsplit(url if '://' in url else f"https://{url}")
+    except ValueError:
+        return url
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    host = _HOST_ALIASES.get(host, host)
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit(('https', host, path, '', ''))
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings using double hashing of a blake2b digest."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class ScrapeIndex:
+    """Recently scraped URLs for one scrape_job table."""
+
+    def __init__(self, bigquery_dataset_id, scrape_job_table_id, client_factory):
+        self.table = f"{bigquery_dataset_id}.{scrape_job_table_id}"
+        self._client_factory = client_factory
+        self._entries = {}
+        self._bloom = BloomFilter(1024)
+        self._watermark = None
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def _key(self, dataset_id, url):
+        return f"{dataset_id} {normalize_url(url)}"
+
+    def _add(self, key, initiated_at, snapshot_id):
+        current = self._entries.get(key)
+        if current is None:
+            if self._bloom.count >= self._bloom.capacity:
+                self._rebuild_bloom(2 * (len(self._entries) + 1))
+            self._bloom.add(key)
+        elif current[0] >= initiated_at:
+            return
+        self._entries[key] = (initiated_at, snapshot_id)
+
+    def _rebuild_bloom(self, capacity):
+        self._bloom = BloomFilter(capacity)
+        for key in self._entries:
+            self._bloom.add(key)
+
+    def refresh(self, force=False):
+        """Loads scrape_job rows newer than the highest initiated_at seen so far."""
+        with self._lock:
+            if not force and time.monotonic() - self._last_refresh < REFRESH_SECONDS:
+                return
+            since = self._watermark - REFRESH_OVERLAP if self._watermark else (
+                datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=LOOKBACK_HOURS)
+            )
+            query = f"""
+                SELECT dataset_id, url, initiated_at, snapshot_id
+                FROM `{self.table}`, UNNEST(urls_in_batch) AS url
+                WHERE initiated_at > @since
+            """
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ScalarQueryParameter('since', 'TIMESTAMP', since),
+            ])
+            start = time.perf_counter()
+            rows = self._client_factory().query(query, job_config=job_config).result()
+            loaded = 0
+            for row in rows:
+                self._add(self._key(row.dataset_id, row.url), row.initiated_at, row.snapshot_id)
+                if self._watermark is None or row.initiated_at > self._watermark:
+                    self._watermark = row.initiated_at
+                loaded += 1
+            self._last_refresh = time.monotonic()
+            print(f"Scrape index refreshed: {loaded} new URL rows in {time.perf_counter() - start:.2f}s "
+                  f"({len(self._entries)} URLs indexed)")
+
+    def record(self, dataset_id, urls, snapshot_id, initiated_at):
+        """Adds URLs triggered by this instance so repeats are caught before the next refresh."""
+        with self._lock:
+            for url in urls:
+                self._add(self._key(dataset_id, url), initiated_at, snapshot_id)
+
+    def lookup(self, dataset_id, url):
+        """Returns (initiated_at, snapshot_id) of the latest scrape of the URL, or None."""
+        key = self._key(dataset_id, url)
+        if key not in self._bloom:
+            return None
+        return self._entries.get(key)
+
+    def filter_urls(self, dataset_id, urls, max_age_hours):
+        """
+        Splits a URL list into URLs to scrape and URLs to skip.
+
+        Args:
+            dataset_id: Bright Data dataset ID the URLs are sent to.
+            urls: URLs from the request.
+            max_age_hours: URLs scraped within this many hours are skipped;
+                0 or None disables the check (duplicates are still dropped).
+
+        Returns:
+            Tuple (urls_to_scrape, skipped_urls), where each skipped entry has
+            'url', 'reason' ('duplicate_in_request' or 'recently_scraped') and,
+            for recent scrapes, 'snapshot_id' and 'initiated_at'.
+        """
+        if max_age_hours:
+            self.refresh()
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=max_age_hours)
+
+        urls_to_scrape = []
+        skipped_urls = []
+        seen = set()
+        for url in urls:
+            key = self._key(dataset_id, url)
+            if key in seen:
+                skipped_urls.append({'url': url, 'reason': 'duplicate_in_request'})
+                continue
+            seen.add(key)
+            if max_age_hours:
+                entry = self.lookup(dataset_id, url)
+                if entry and entry[0] >= cutoff:
+                    skipped_urls.append({
+                        'url': url,
+                        'reason': 'recently_scraped',
+                        'snapshot_id': entry[1],
+                        'initiated_at': entry[0].isoformat(),
+                    })
+                    continue
+            urls_to_scrape.append(url)
+        return urls_to_scrape, skipped_urls
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_scrape_index(bigquery_dataset_id, scrape_job_table_id, client_factory):
+    """Returns the instance-wide index for a scrape_job table, creating it on first use."""
+    key = (bigquery_dataset_id, scrape_job_table_id)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = ScrapeIndex(bigquery_dataset_id, scrape_job_table_id, client_factory)
+        return _indexes[key]